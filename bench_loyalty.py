@@ -0,0 +1,144 @@
+"""Бенчмарк сценариев бота на fake_sheets: сколько запросов к Sheets, байт и времени уходит
+на открытие кабинета, покупку, списание, бонус за отзыв и историю.
+
+    python bench_loyalty.py                        # 1k / 10k / 100k клиентов
+    python bench_loyalty.py --sizes 1000 --check   # упасть, если сценарий превысил CALL_BUDGET
+
+Сценарии вызываются теми же функциями, что и хендлеры (load_cabinet_by_user, apply_purchase, ...),
+после каждой операции отложенная запись сбрасывается, чтобы запросы засчитывались ей.
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+
+import loyalty_bot as lb
+from fake_sheets import CallLog, FakeClient
+
+# Сколько запросов к Sheets допускается на одну операцию, когда кэши уже прогреты.
+CALL_BUDGET = {
+    "cabinet_open": 0,
+    "purchase": 2,      # batch_update clients + append_rows transactions
+    "redeem": 2,
+    "review_bonus": 2,
+    "history": 0,
+}
+
+TG_LINKS_HEADER = ["user_id", "username", "first_name", "phone", "linked_at"]
+
+
+def phone_of(i: int) -> str:
+    return f"7999{i:07d}"
+
+
+def seed(client: FakeClient, n_clients: int, tx_per_client: int = 2) -> None:
+    sheet = client.spreadsheet
+    sheet.add("clients", lb.CLIENT_COLUMNS, [
+        [phone_of(i), f"Client {i}", "2024-01-01T00:00:00", 1000, 50, "silver"]
+        for i in range(n_clients)
+    ])
+    # операции текущего месяца лежат в его листе, старый лист transactions пуст
+    month = datetime.utcnow().strftime("%Y-%m")
+    sheet.add("transactions", lb.TX_COLUMNS)
+    sheet.add(lb.tx_partition_title(month), lb.TX_COLUMNS, [
+        [phone_of(i), "purchase", 500, 25, f"{month}-{1 + k:02d}T12:00:00", "Покупка в ателье"]
+        for k in range(tx_per_client) for i in range(n_clients)
+    ])
+    sheet.add(lb.TX_PARTITIONS_TITLE, lb.TX_PARTITION_COLUMNS, [
+        [lb.tx_partition_title(month), month, f"{month}-01T00:00:00"],
+    ])
+    sheet.add("tg_links", TG_LINKS_HEADER, [
+        [100000 + i, f"user{i}", f"User {i}", phone_of(i), "2024-01-01T00:00:00"]
+        for i in range(0, n_clients, 2)
+    ])
+
+
+def reset_bot_storage() -> None:
+    if lb.BACKEND is not None:
+        lb.BACKEND.close()
+    lb.BACKEND = None
+    lb.GSCLIENT = None
+
+
+def run_flow(name: str, n_clients: int, rng: random.Random):
+    i = rng.randrange(0, n_clients, 2)  # чётные клиенты привязаны к Telegram
+    phone = phone_of(i)
+    if name == "cabinet_open":
+        lb.load_cabinet_by_user(100000 + i, f"User {i}")
+    elif name == "purchase":
+        lb.apply_purchase(phone, 450)
+    elif name == "redeem":
+        lb.apply_redeem(phone, 1)
+    elif name == "review_bonus":
+        lb.apply_review_bonus(phone)
+    elif name == "history":
+        lb.load_history(phone, 10)
+    lb.flush_writes()
+
+
+def bench_size(n_clients: int, ops: int, seed_value: int = 1) -> dict:
+    reset_bot_storage()
+    log = CallLog()
+    client = FakeClient(log)
+    seed(client, n_clients)
+    lb.WB_FLUSH_INTERVAL = 3600  # сбрасываем вручную после каждой операции
+    lb.SNAPSHOT_INTERVAL = 0  # меряем холодный старт, снимок с диска не поднимаем
+    lb.SCHEDULER = lb.SheetsScheduler(reads_per_min=10 ** 9, writes_per_min=10 ** 9)  # квоты не меряем
+    rng = random.Random(seed_value)
+
+    results = {}
+    t0 = time.perf_counter()
+    lb.init_gs(client=client)
+    lb.init_storage()
+    lb.load_cabinet_by_user(100000, "User 0")
+    lb.load_history(phone_of(0), 10)
+    results["cold_start"] = {**log.summary(), "wall": time.perf_counter() - t0, "ops": 1}
+
+    for name in CALL_BUDGET:
+        log.reset()
+        t0 = time.perf_counter()
+        for _ in range(ops):
+            run_flow(name, n_clients, rng)
+        results[name] = {**log.summary(), "wall": time.perf_counter() - t0, "ops": ops}
+
+    reset_bot_storage()
+    return results
+
+
+def print_report(n_clients: int, results: dict) -> None:
+    print(f"\n== {n_clients} clients ==")
+    print(f"{'flow':<14}{'calls/op':>10}{'KB/op':>10}{'sim ms/op':>12}{'wall ms/op':>12}")
+    for name, r in results.items():
+        ops = r["ops"]
+        print(
+            f"{name:<14}{r['calls'] / ops:>10.2f}{r['bytes'] / 1024 / ops:>10.1f}"
+            f"{r['latency'] * 1000 / ops:>12.1f}{r['wall'] * 1000 / ops:>12.2f}"
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры базы клиентов через запятую")
+    parser.add_argument("--ops", type=int, default=50, help="операций на сценарий")
+    parser.add_argument("--check", action="store_true", help="сверить запросы с CALL_BUDGET")
+    args = parser.parse_args(argv)
+
+    failed = []
+    for n in (int(x) for x in args.sizes.split(",")):
+        results = bench_size(n, args.ops)
+        print_report(n, results)
+        for name, budget in CALL_BUDGET.items():
+            per_op = results[name]["calls"] / results[name]["ops"]
+            if per_op > budget:
+                failed.append(f"{n} clients / {name}: {per_op:.2f} calls per op > {budget}")
+
+    if args.check and failed:
+        print("\nCALL BUDGET EXCEEDED:\n  " + "\n  ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
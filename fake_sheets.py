@@ -0,0 +1,242 @@
+"""In-memory подмена gspread для бенчмарков и локальной отладки без Google.
+
+Повторяет ровно те методы Worksheet/Spreadsheet/Client, которыми пользуется loyalty_bot,
+и записывает каждый вызов в CallLog (операция, лист, строки, байты, симулированная задержка).
+
+    from fake_sheets import FakeClient
+    import loyalty_bot
+    client = FakeClient()
+    loyalty_bot.init_gs(client=client)
+"""
+
+import json
+import re
+import time
+from dataclasses import dataclass, field
+
+import gspread
+from gspread.utils import a1_to_rowcol
+
+
+@dataclass
+class Call:
+    op: str
+    worksheet: str
+    rows: int
+    bytes: int
+    latency: float
+
+
+@dataclass
+class CallLog:
+    """Журнал обращений к «API». latency — модель задержки одного запроса:
+    base секунд + per_kb секунд на каждый килобайт ответа/запроса."""
+
+    base: float = 0.25
+    per_kb: float = 0.002
+    sleep: bool = False  # реально спать на симулированную задержку
+    calls: list[Call] = field(default_factory=list)
+
+    def record(self, op: str, worksheet: str, rows: int, payload) -> None:
+        size = len(json.dumps(payload, ensure_ascii=False, default=str).encode()) if payload is not None else 0
+        latency = self.base + self.per_kb * size / 1024
+        self.calls.append(Call(op, worksheet, rows, size, latency))
+        if self.sleep:
+            time.sleep(latency)
+
+    def reset(self) -> None:
+        self.calls.clear()
+
+    def summary(self) -> dict:
+        return {
+            "calls": len(self.calls),
+            "rows": sum(c.rows for c in self.calls),
+            "bytes": sum(c.bytes for c in self.calls),
+            "latency": sum(c.latency for c in self.calls),
+            "ops": sorted({f"{c.worksheet}.{c.op}" for c in self.calls}),
+        }
+
+
+def _range_bounds(range_name: str) -> tuple[int, int, int | None, int | None]:
+    """"A5:F" / "A5:F10" / "B3" -> (row1, col1, row2 | None, col2 | None)."""
+    range_name = range_name.split("!")[-1]
+    first, _, last = range_name.partition(":")
+    r1, c1 = a1_to_rowcol(first)
+    if not last:
+        return r1, c1, r1, c1
+    m = re.fullmatch(r"([A-Z]+)(\d*)", last)
+    c2 = a1_to_rowcol(f"{m.group(1)}1")[1]
+    r2 = int(m.group(2)) if m.group(2) else None
+    return r1, c1, r2, c2
+
+
+class FakeWorksheet:
+    def __init__(self, title: str, log: CallLog, rows: int = 1000, cols: int = 26):
+        self.title = title
+        self.log = log
+        self.row_count = rows
+        self.col_count = cols
+        self.data: list[list] = []
+
+    # --- вспомогательное (не считается вызовом API) ---
+
+    def load_rows(self, rows: list[list]) -> None:
+        self.data.extend([list(r) for r in rows])
+        self.row_count = max(self.row_count, len(self.data))
+
+    def _ensure(self, row: int) -> list:
+        while len(self.data) < row:
+            self.data.append([])
+        self.row_count = max(self.row_count, len(self.data))
+        return self.data[row - 1]
+
+    def _set(self, row: int, col: int, values: list) -> None:
+        cur = self._ensure(row)
+        while len(cur) < col - 1 + len(values):
+            cur.append("")
+        cur[col - 1:col - 1 + len(values)] = list(values)
+
+    # --- API ---
+
+    def get_all_records(self, **kwargs) -> list[dict]:
+        if not self.data:
+            self.log.record("get_all_records", self.title, 0, [])
+            return []
+        header = self.data[0]
+        res = []
+        for row in self.data[1:]:
+            row = list(row) + [""] * (len(header) - len(row))
+            res.append(dict(zip(header, row)))
+        self.log.record("get_all_records", self.title, len(self.data), self.data)
+        return res
+
+    def get(self, range_name: str | None = None, **kwargs) -> list[list]:
+        if range_name is None:
+            values = [list(r) for r in self.data]
+        else:
+            r1, c1, r2, c2 = _range_bounds(range_name)
+            if r1 > self.row_count:
+                raise gspread.exceptions.APIError(_FakeResponse(400, f"Range ({self.title}!{range_name}) exceeds grid limits"))
+            rows = self.data[r1 - 1:(r2 if r2 is not None else len(self.data))]
+            values = [list(r[c1 - 1:c2]) for r in rows]
+            while values and not any(v not in ("", None) for v in values[-1]):
+                values.pop()
+        self.log.record("get", self.title, len(values), values)
+        return values
+
+    def batch_get(self, ranges: list[str], **kwargs) -> list[list[list]]:
+        res = []
+        for range_name in ranges:
+            r1, c1, r2, c2 = _range_bounds(range_name)
+            rows = self.data[r1 - 1:(r2 if r2 is not None else len(self.data))]
+            res.append([list(r[c1 - 1:c2]) for r in rows])
+        self.log.record("batch_get", self.title, sum(len(v) for v in res), res)
+        return res
+
+    def append_row(self, values, value_input_option=None, **kwargs) -> dict:
+        self.data.append(list(values))
+        self.row_count = max(self.row_count, len(self.data))
+        n = len(self.data)
+        self.log.record("append_row", self.title, 1, values)
+        return {"updates": {"updatedRange": f"{self.title}!A{n}:F{n}", "updatedRows": 1}}
+
+    def append_rows(self, values, value_input_option=None, **kwargs) -> dict:
+        start = len(self.data) + 1
+        self.data.extend([list(v) for v in values])
+        self.row_count = max(self.row_count, len(self.data))
+        self.log.record("append_rows", self.title, len(values), values)
+        return {"updates": {"updatedRange": f"{self.title}!A{start}:F{len(self.data)}", "updatedRows": len(values)}}
+
+    def update(self, values=None, range_name=None, **kwargs) -> dict:
+        if isinstance(values, str):  # старый порядок аргументов: update("A2:F2", [[...]])
+            range_name, values = values, range_name
+        r1, c1, _, _ = _range_bounds(range_name)
+        for i, row in enumerate(values):
+            self._set(r1 + i, c1, row)
+        self.log.record("update", self.title, len(values), values)
+        return {"updatedRange": f"{self.title}!{range_name}"}
+
+    def update_cell(self, row: int, col: int, value) -> dict:
+        self._set(row, col, [value])
+        self.log.record("update_cell", self.title, 1, value)
+        return {}
+
+    def batch_update(self, data, **kwargs) -> dict:
+        rows = 0
+        for item in data:
+            r1, c1, _, _ = _range_bounds(item["range"])
+            for i, row in enumerate(item["values"]):
+                self._set(r1 + i, c1, row)
+            rows += len(item["values"])
+        self.log.record("batch_update", self.title, rows, data)
+        return {"totalUpdatedRows": rows}
+
+    def batch_clear(self, ranges: list[str]) -> dict:
+        for range_name in ranges:
+            r1, c1, r2, c2 = _range_bounds(range_name)
+            for row in self.data[r1 - 1:(r2 if r2 is not None else len(self.data))]:
+                for c in range(c1 - 1, min(c2 or len(row), len(row))):
+                    row[c] = ""
+        self.log.record("batch_clear", self.title, 0, ranges)
+        return {}
+
+    def resize(self, rows: int | None = None, cols: int | None = None) -> dict:
+        if rows is not None:
+            del self.data[rows:]
+            self.row_count = rows
+        if cols is not None:
+            self.col_count = cols
+        self.log.record("resize", self.title, 0, None)
+        return {}
+
+
+class _FakeResponse:
+    """Минимальный ответ для gspread.exceptions.APIError."""
+
+    def __init__(self, status: int, message: str):
+        self.status_code = status
+        self.text = message
+        self._message = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self._message, "status": "INVALID_ARGUMENT"}}
+
+
+class FakeSpreadsheet:
+    def __init__(self, log: CallLog):
+        self.log = log
+        self.sheets: dict[str, FakeWorksheet] = {}
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.log.record("worksheet", title, 0, None)
+        try:
+            return self.sheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title) from None
+
+    def worksheets(self) -> list[FakeWorksheet]:
+        self.log.record("worksheets", "*", 0, None)
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26, **kwargs) -> FakeWorksheet:
+        self.log.record("add_worksheet", title, 0, None)
+        ws = self.sheets[title] = FakeWorksheet(title, self.log, rows=rows, cols=cols)
+        return ws
+
+    def add(self, title: str, header: list[str], rows: list[list] = ()) -> FakeWorksheet:
+        """Подготовить лист с данными без учёта вызовов (для сидирования)."""
+        ws = self.sheets[title] = FakeWorksheet(title, self.log)
+        ws.load_rows([header, *rows])
+        return ws
+
+
+class FakeClient:
+    """Замена gspread.Client: open_by_key всегда отдаёт одну и ту же таблицу."""
+
+    def __init__(self, log: CallLog | None = None):
+        self.log = log or CallLog()
+        self.spreadsheet = FakeSpreadsheet(self.log)
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        self.log.record("open_by_key", "*", 0, None)
+        return self.spreadsheet
@@ -1,5 +1,24 @@
+import io
 import os
+import re
+import sys
+import csv
 import json
+import hashlib
+import pickle
+import time
+import asyncio
+import functools
+import sqlite3
+import threading
+import bisect
+import heapq
+import random
+import signal
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime, timedelta
 
 from telegram import (
@@ -10,17 +29,28 @@ from telegram import (
     KeyboardButton,
 )
 
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    ExtBot,
     MessageHandler,
+    PersistenceInput,
     filters,
 )
 
+import tornado.httpserver
+import tornado.web
+
 import gspread
+import requests
 from gspread.auth import service_account_from_dict
+from gspread.utils import ValueRenderOption
 
 
 # === ENV НАСТРОЙКИ ===
@@ -43,301 +73,3949 @@ GS_SHEET = None
 CLIENTS_WS = None
 TX_WS = None
 TG_LINKS_WS = None  # лист для связок user_id <-> phone
+TX_PARTITIONS_WS = None  # каталог месячных листов transactions_YYYY_MM
+
+# Кэш листа clients (см. ClientStore). Перечитывается целиком не чаще, чем раз в GS_CACHE_TTL секунд,
+# чтобы ручные правки в таблице всё-таки подхватывались.
+GS_CACHE_TTL = int(os.getenv("GS_CACHE_TTL", "600"))
+
+# Кэш листа transactions (см. TxCache): сколько последних операций держим на телефон
+# и как часто дочитываем строки, добавленные в лист мимо бота.
+TX_RING_SIZE = int(os.getenv("TX_RING_SIZE", "50"))
+TX_SYNC_INTERVAL = int(os.getenv("TX_SYNC_INTERVAL", "30"))
+
+# Отложенная запись (см. WriteBehind). WB_FLUSH_INTERVAL=0 — писать в Sheets сразу, как раньше.
+WB_FLUSH_INTERVAL = float(os.getenv("WB_FLUSH_INTERVAL", "2"))
+WB_MAX_PENDING = int(os.getenv("WB_MAX_PENDING", "50"))
+
+# Квоты Google Sheets (запросов в минуту на пользователя) и повторы при 429/5xx (см. SheetsScheduler)
+GS_READS_PER_MIN = int(os.getenv("GS_READS_PER_MIN", "60"))
+GS_WRITES_PER_MIN = int(os.getenv("GS_WRITES_PER_MIN", "60"))
+GS_BURST_SECONDS = float(os.getenv("GS_BURST_SECONDS", "5"))  # сколько секунд квоты можно потратить разом
+GS_MAX_RETRIES = int(os.getenv("GS_MAX_RETRIES", "5"))
+GS_BACKOFF_BASE = float(os.getenv("GS_BACKOFF_BASE", "1"))
+GS_BACKOFF_MAX = float(os.getenv("GS_BACKOFF_MAX", "32"))
+
+# Очередь уведомлений клиентам (см. NotificationDispatcher). Лимиты Telegram: ~30 сообщений/с на бота
+# и не чаще раза в секунду в один чат.
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", "1"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+
+# Число полос блокировок по телефону (см. StripedLocks)
+PHONE_LOCK_STRIPES = int(os.getenv("PHONE_LOCK_STRIPES", "64"))
+
+# Каталог для служебных файлов бота (чекпоинты рассылок и т.п.)
+DATA_DIR = os.getenv("DATA_DIR", ".")
+BROADCAST_STATE_PATH = os.path.join(DATA_DIR, "broadcast_state.json")
+BROADCAST_BLOCKED_PATH = os.path.join(DATA_DIR, "broadcast_blocked.json")
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "25"))
+RECONCILE_CHECKPOINT_PATH = os.path.join(DATA_DIR, "reconcile_checkpoint.json")
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "1000"))
+STATS_CHECKPOINT_PATH = os.path.join(DATA_DIR, "stats_checkpoint.json")
+
+# Сгорание бонусов (см. BonusExpiry): начисление живёт BONUS_TTL_DAYS дней, за BONUS_EXPIRY_NOTICE_DAYS
+# до сгорания клиенту приходит напоминание. BONUS_TTL_DAYS=0 — бонусы не сгорают.
+# BONUS_EXPIRY_SINCE (YYYY-MM-DD) — начисления до этой даты считаются сделанными в неё, чтобы при
+# включении не сгорело сразу всё накопленное за прошлые годы. Если не задано, берётся дата первого
+# запуска, записанная в bonus_lots.json.
+BONUS_TTL_DAYS = int(os.getenv("BONUS_TTL_DAYS", "365"))
+BONUS_EXPIRY_NOTICE_DAYS = int(os.getenv("BONUS_EXPIRY_NOTICE_DAYS", "14"))
+BONUS_EXPIRY_INTERVAL = int(os.getenv("BONUS_EXPIRY_INTERVAL", "3600"))
+BONUS_EXPIRY_SINCE = os.getenv("BONUS_EXPIRY_SINCE", "")
+BONUS_LOTS_PATH = os.path.join(DATA_DIR, "bonus_lots.json")
+
+# Разделитель колонок в выгрузке кассы (см. iter_pos_sales); пусто — определить по заголовку
+POS_CSV_DELIMITER = os.getenv("POS_CSV_DELIMITER", "").replace("\\t", "\t")
+
+# Как часто пересчитывать уровни всех клиентов пакетом (см. recompute_levels)
+LEVELS_RECOMPUTE_INTERVAL = int(os.getenv("LEVELS_RECOMPUTE_INTERVAL", "3600"))
+
+# Снимок индексов Sheets для тёплого старта (см. SnapshotKeeper); SNAPSHOT_INTERVAL=0 — выключить
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", os.path.join(DATA_DIR, "sheets_snapshot.pickle"))
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "300"))
+
+# Состояние диалогов (context.user_data) между рестартами; раз в PERSISTENCE_INTERVAL секунд
+# изменения пишутся в локальную SQLite (см. SqlitePersistence)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(DATA_DIR, "bot_state.db"))
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# Метрики в формате Prometheus отдаются тем же HTTP-сервером, что принимает вебхук
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+# Где живут данные: "sheets" (Google Sheets, как раньше) или "sqlite" (локальная БД).
+# С SQLITE_MIRROR_SHEETS=1 все записи SQLite дублируются в таблицу (та же отложенная запись).
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "loyalty.db")
+SQLITE_MIRROR_SHEETS = os.getenv("SQLITE_MIRROR_SHEETS", "") == "1"
+BACKEND = None
+_INIT_LOCK = threading.Lock()
+
+# Параллельная обработка апдейтов (см. OrderedUpdateProcessor): сколько хендлеров работает одновременно
+# и сколько апдейтов может ждать своей очереди, прежде чем приём новых притормозит
+UPDATES_CONCURRENCY = int(os.getenv("UPDATES_CONCURRENCY", "8"))
+UPDATES_MAX_PENDING = int(os.getenv("UPDATES_MAX_PENDING", "256"))
+
+# Повторные доставки вебхука: сколько update_id и как долго помним (см. RecentIds),
+# и среди скольких последних операций клиента ищем ключ идемпотентности (см. find_operation)
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "3600"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+IDEMPOTENCY_LOOKBACK = int(os.getenv("IDEMPOTENCY_LOOKBACK", "20"))
+
+# Альбом (несколько фото одним сообщением) приходит отдельными апдейтами: ждём ALBUM_DEBOUNCE секунд
+# после последней части и пересылаем альбом целиком (см. AlbumCollector)
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", "1.5"))
+# части, опоздавшие после отправки альбома, ещё ALBUM_LATE_WINDOW секунд досылаются тем же админам
+ALBUM_LATE_WINDOW = float(os.getenv("ALBUM_LATE_WINDOW", "60"))
+# на альбом клиенту отвечаем один раз: ещё ALBUM_REPLY_WINDOW секунд его части ответа не получают
+ALBUM_REPLY_WINDOW = float(os.getenv("ALBUM_REPLY_WINDOW", "600"))
+
+# Пул потоков для блокирующих вызовов gspread (см. AsyncStorage)
+GS_POOL_SIZE = int(os.getenv("GS_POOL_SIZE", "4"))
+GS_TIMEOUT = float(os.getenv("GS_TIMEOUT", "30"))
+
+
+# === МЕТРИКИ ===
+
+class Metrics:
+    """Счётчики и гистограммы с метками + вывод в текстовом формате Prometheus.
+
+    Без внешних зависимостей; обновляется и из event loop, и из потоков пула.
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: dict[str, tuple[str, str]] = {}  # name -> (type, help)
+        self._values: dict[str, dict[tuple, float]] = {}
+        self._hist: dict[str, dict[tuple, list]] = {}  # name -> labels -> [bucket counts..., sum, count]
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    @staticmethod
+    def _key(labels: dict | None) -> tuple:
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict | None = None, value: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, labels: dict | None = None, value: float = 0):
+        with self._lock:
+            self._values.setdefault(name, {})[self._key(labels)] = value
+
+    def observe(self, name: str, labels: dict | None = None, value: float = 0):
+        key = self._key(labels)
+        with self._lock:
+            h = self._hist.setdefault(name, {}).get(key)
+            if h is None:
+                h = self._hist[name][key] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        items = key + extra
+        if not items:
+            return ""
+        body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items)
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(set(self._values) | set(self._hist)):
+                kind, text = self._help.get(name, ("untyped", ""))
+                if text:
+                    lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f"{name}{self._labels(key)} {value:g}")
+                for key, h in sorted(self._hist.get(name, {}).items()):
+                    for i, bound in enumerate(self.LATENCY_BUCKETS):
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', f'{bound:g}'),))} {h[i]}")
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {h[-1]}")
+                    lines.append(f"{name}_sum{self._labels(key)} {h[-2]:g}")
+                    lines.append(f"{name}_count{self._labels(key)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("loyalty_sheets_requests_total", "counter", "Google Sheets API requests")
+METRICS.describe("loyalty_sheets_request_seconds", "histogram", "Google Sheets API request latency")
+METRICS.describe("loyalty_sheets_rows_total", "counter", "Rows read or written via Google Sheets API")
+METRICS.describe("loyalty_sheets_errors_total", "counter", "Failed Google Sheets API requests")
+METRICS.describe("loyalty_telegram_requests_total", "counter", "Telegram Bot API send/forward requests")
+METRICS.describe("loyalty_telegram_request_seconds", "histogram", "Telegram Bot API send/forward latency")
+METRICS.describe("loyalty_telegram_errors_total", "counter", "Failed Telegram Bot API send/forward requests")
+
+
+def _rows_in(op: str, args: tuple, kwargs: dict, result) -> int:
+    """Сколько строк передал запрос к Sheets (для loyalty_sheets_rows_total)."""
+    if op in ("get_all_records", "get"):
+        return len(result or [])
+    if op == "batch_get":
+        return sum(len(v) for v in result or [])
+    if op in ("append_row", "update_cell"):
+        return 1
+    if op == "append_rows":
+        return len(args[0] if args else kwargs.get("values", []))
+    if op == "update":
+        values = kwargs.get("values")
+        if values is None:
+            values = next((a for a in args if isinstance(a, list)), [])
+        return len(values)
+    if op == "batch_update":
+        return sum(len(item.get("values", [])) for item in (args[0] if args else kwargs.get("data", [])))
+    return 0
+
+
+def track_sheets_call(worksheet: str, op: str, fn, *args, **kwargs):
+    """Выполнить запрос к Sheets и записать счётчик, задержку, строки и ошибки."""
+    labels = {"worksheet": worksheet, "op": op}
+    started = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        METRICS.inc("loyalty_sheets_errors_total", labels)
+        raise
+    finally:
+        METRICS.inc("loyalty_sheets_requests_total", labels)
+        METRICS.observe("loyalty_sheets_request_seconds", labels, time.perf_counter() - started)
+    METRICS.inc("loyalty_sheets_rows_total", labels, _rows_in(op, args, kwargs, result))
+    return result
 
 
-# === GOOGLE SHEETS ===
+class TrackedWorksheet:
+    """Обёртка над gspread.Worksheet: все сетевые методы проходят через sheets_call."""
 
-def init_gs():
-    """Инициализация Google Sheets (вызывать перед операциями)."""
-    global GSCLIENT, GS_SHEET, CLIENTS_WS, TX_WS, TG_LINKS_WS
-    if GSCLIENT is not None:
-        return
+    API_METHODS = {
+        "get_all_records", "get", "batch_get", "append_row", "append_rows",
+        "update", "update_cell", "batch_update", "batch_clear", "resize",
+    }
 
-    if not GSSERVICEJSON or not GSSHEETID:
-        print("No GS creds in env (GSSERVICEJSON/GSSHEETID)")
-        return
+    def __init__(self, ws):
+        self._ws = ws
+        self.title = ws.title
+
+    def __getattr__(self, name):
+        attr = getattr(self._ws, name)
+        if name not in self.API_METHODS:
+            return attr
+        return functools.partial(sheets_call, self.title, name, attr)
 
-    info = json.loads(GSSERVICEJSON)
-    client = service_account_from_dict(info)
-    sheet = client.open_by_key(GSSHEETID)
 
+async def track_telegram_call(method: str, coro):
+    labels = {"method": method}
+    started = time.perf_counter()
     try:
-        tg_links_ws = sheet.worksheet("tg_links")
+        return await coro
     except Exception:
-        tg_links_ws = None
-        
+        METRICS.inc("loyalty_telegram_errors_total", labels)
+        raise
+    finally:
+        METRICS.inc("loyalty_telegram_requests_total", labels)
+        METRICS.observe("loyalty_telegram_request_seconds", labels, time.perf_counter() - started)
+
+
+class TrackedBot(ExtBot):
+    """ExtBot с метриками на отправку и пересылку сообщений (в т.ч. Message.forward())."""
+
+    async def send_message(self, *args, **kwargs):
+        return await track_telegram_call("send_message", super().send_message(*args, **kwargs))
+
+    async def forward_message(self, *args, **kwargs):
+        return await track_telegram_call("forward_message", super().forward_message(*args, **kwargs))
+
+    async def forward_messages(self, *args, **kwargs):
+        return await track_telegram_call("forward_messages", super().forward_messages(*args, **kwargs))
+
+    async def copy_message(self, *args, **kwargs):
+        return await track_telegram_call("copy_message", super().copy_message(*args, **kwargs))
+
+    async def copy_messages(self, *args, **kwargs):
+        return await track_telegram_call("copy_messages", super().copy_messages(*args, **kwargs))
+
+
+# === ПЛАНИРОВЩИК ЗАПРОСОВ К SHEETS ===
+# Приоритеты: админские операции у кассы важнее чтений клиентов, фоновые задачи — в последнюю очередь.
+PRIORITY_ADMIN = 0
+PRIORITY_CLIENT = 1
+PRIORITY_BACKGROUND = 2
+
+READ_OPS = {"get_all_records", "get", "batch_get", "open_by_key", "worksheet", "worksheets"}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Дописывание строк не идемпотентно: после 5xx или обрыва соединения строки могли уже попасть в лист,
+# поэтому повторяем его только на 429 (запрос отклонён квотой и точно не выполнен).
+APPEND_OPS = {"append_row", "append_rows"}
+
+
+def write_rejected(e: Exception) -> bool:
+    """Запрос к Sheets точно не выполнен и его можно отправить ещё раз."""
+    return isinstance(e, gspread.exceptions.APIError) and e.code == 429
+
+
+def write_refused(e: Exception) -> bool:
+    """Sheets отказал окончательно (400, 403, 404…): повтор того же запроса упадёт так же."""
+    return isinstance(e, gspread.exceptions.APIError) and e.code not in RETRY_STATUSES
+
+METRICS.describe("loyalty_sheets_queue_depth", "gauge", "Sheets requests waiting for quota")
+METRICS.describe("loyalty_sheets_queue_wait_seconds", "histogram", "Time spent waiting for Sheets quota")
+METRICS.describe("loyalty_sheets_retries_total", "counter", "Sheets requests retried after 429/5xx")
+
+_priority = threading.local()
+
+
+@contextlib.contextmanager
+def sheets_priority(priority: int):
+    """Приоритет запросов к Sheets из текущего потока (можно и как декоратор)."""
+    prev = getattr(_priority, "value", None)
+    _priority.value = priority
     try:
-        clients_ws = sheet.worksheet("clients")
-    except gspread.exceptions.WorksheetNotFound:
-        clients_ws = sheet.add_worksheet("clients", rows=1000, cols=10)
-        clients_ws.append_row(
-            ["phone", "name", "created_at", "turnover", "bonus_balance", "level"],
-            value_input_option="RAW",
+        yield
+    finally:
+        _priority.value = prev
+
+
+def current_sheets_priority() -> int:
+    value = getattr(_priority, "value", None)
+    return PRIORITY_CLIENT if value is None else value
+
+
+class TokenBucket:
+    """Ёмкость — квота за burst_seconds, а не за минуту: Google считает запросы в скользящем окне 60 с,
+    и полная минутная «заначка» после простоя плюс пополнение дали бы в одном окне почти две квоты.
+    Скорость пополнения уменьшена на ёмкость: за любые 60 с уходит не больше per_minute запросов."""
+
+    def __init__(self, per_minute: int, burst_seconds: float = GS_BURST_SECONDS):
+        self.capacity = max(1.0, per_minute * burst_seconds / 60.0)
+        self.rate = max(per_minute - self.capacity, 1.0) / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class SheetsScheduler:
+    """Token bucket перед каждым запросом к Sheets: отдельные квоты на чтение и запись,
+    очередь ожидающих упорядочена по (приоритет, время прихода). 429/5xx повторяются
+    с экспоненциальной задержкой и полным джиттером.
+    """
+
+    def __init__(self, reads_per_min: int = GS_READS_PER_MIN, writes_per_min: int = GS_WRITES_PER_MIN,
+                 max_retries: int = GS_MAX_RETRIES, backoff_base: float = GS_BACKOFF_BASE,
+                 backoff_max: float = GS_BACKOFF_MAX):
+        self.buckets = {"read": TokenBucket(reads_per_min), "write": TokenBucket(writes_per_min)}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queues: dict[str, list] = {"read": [], "write": []}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def queue_depth(self, kind: str) -> int:
+        return len(self._queues[kind])
+
+    def acquire(self, kind: str, priority: int):
+        bucket = self.buckets[kind]
+        queue = self._queues[kind]
+        entry = (priority, next(self._seq))
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(queue, entry)
+            METRICS.set("loyalty_sheets_queue_depth", {"kind": kind}, len(queue))
+            while True:
+                bucket.refill()
+                if queue[0] == entry and bucket.tokens >= 1:
+                    heapq.heappop(queue)
+                    bucket.tokens -= 1
+                    break
+                # голова очереди ждёт ровно до следующего токена, остальные — пока их не разбудят
+                self._cond.wait(bucket.wait_time() if queue[0] == entry else None)
+            METRICS.set("loyalty_sheets_queue_depth", {"kind": kind}, len(queue))
+            self._cond.notify_all()
+        METRICS.observe(
+            "loyalty_sheets_queue_wait_seconds",
+            {"kind": kind, "priority": str(priority)},
+            time.monotonic() - started,
         )
 
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, worksheet: str, op: str, fn, *args, **kwargs):
+        kind = "read" if op in READ_OPS else "write"
+        priority = current_sheets_priority()
+        attempt = 0
+        while True:
+            self.acquire(kind, priority)
+            try:
+                return track_sheets_call(worksheet, op, fn, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.code
+                if status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    raise
+                if op in APPEND_OPS and not write_rejected(e):
+                    raise
+            except requests.exceptions.ConnectionError:
+                status = "conn"
+                if attempt >= self.max_retries or op in APPEND_OPS:
+                    raise
+            METRICS.inc("loyalty_sheets_retries_total", {"worksheet": worksheet, "op": op, "status": str(status)})
+            delay = self.backoff(attempt)
+            print(f"sheets {worksheet}.{op}: {status}, retry in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+SCHEDULER = SheetsScheduler()
+
+
+def sheets_call(worksheet: str, op: str, fn, *args, **kwargs):
+    """Любой запрос к Sheets: квота и приоритет (SCHEDULER) + метрики (track_sheets_call)."""
+    return SCHEDULER.call(worksheet, op, fn, *args, **kwargs)
+
+
+# === ТЕЛЕФОНЫ ===
+# Клиент ищется по каноническому ключу E.164: "8 999 123-45-67", "+79991234567" и "89991234567" —
+# один и тот же человек. Ключ строится при любом вводе телефона и при построении индексов.
+
+def normalize_phone(raw) -> str | None:
+    """Телефон в E.164 ("+79991234567") или None, если это не похоже на номер.
+
+    Российские номера принимаются в привычных записях: 8…, 7…, +7…, 9… (10 цифр).
+    """
+    text = str(raw).strip()
+    if text.endswith(".0"):  # число из листа, прочитанное как float
+        text = text[:-2]
+    digits = re.sub(r"\D", "", text)
+    if len(digits) == 11 and digits[0] in "78":
+        return "+7" + digits[1:]
+    if len(digits) == 10 and digits[0] == "9":
+        return "+7" + digits
+    if text.startswith("+") and 8 <= len(digits) <= 15:
+        return "+" + digits
+    return None
+
+
+def phone_key(raw) -> str:
+    """Ключ индекса: E.164, а для нераспознанного значения — сама строка."""
+    return normalize_phone(raw) or str(raw).strip()
+
+
+def phone_variants(phone) -> list[str]:
+    """Как один номер мог быть записан до нормализации (для поиска по старым данным в SQLite)."""
+    key = phone_key(phone)
+    variants = [key]
+    if key.startswith("+7") and len(key) == 12:
+        digits = key[2:]
+        variants += ["7" + digits, "8" + digits, digits]
+    raw = str(phone).strip()
+    if raw not in variants:
+        variants.append(raw)
+    return variants
+
+
+def merge_client_records(records: list[dict]) -> dict:
+    """Одна запись из дублей клиента: обороты и бонусы складываются, имя — первое непустое."""
+    turnover = sum(float(r.get("turnover", 0) or 0) for r in records)
+    return {
+        "phone": phone_key(records[0].get("phone", "")),
+        "name": next((r.get("name") for r in records if r.get("name")), ""),
+        "created_at": min((str(r["created_at"]) for r in records if r.get("created_at")), default=""),
+        "turnover": turnover,
+        "bonus_balance": sum(float(r.get("bonus_balance", 0) or 0) for r in records),
+        "level": calc_level_and_rate(turnover)[0],
+    }
+
+
+# === GOOGLE SHEETS ===
+
+def open_worksheet(sheet, title: str, header: list[str], rows: int = 1000, cols: int = 10):
+    """Открыть лист (или создать с заголовком) и обернуть его метриками."""
     try:
-        tx_ws = sheet.worksheet("transactions")
+        ws = sheets_call(title, "worksheet", sheet.worksheet, title)
     except gspread.exceptions.WorksheetNotFound:
-        tx_ws = sheet.add_worksheet("transactions", rows=2000, cols=10)
-        tx_ws.append_row(
-            ["phone", "type", "amount", "bonus_delta", "ts", "comment"],
-            value_input_option="RAW",
-        )
+        ws = sheets_call(title, "add_worksheet", sheet.add_worksheet, title, rows=rows, cols=cols)
+        ws.append_row(header, value_input_option="RAW")
+    return TrackedWorksheet(ws)
+
+
+def init_gs(client=None):
+    """Инициализация Google Sheets (вызывать перед операциями).
+
+    client — готовый gspread-клиент (например, fake_sheets.FakeClient для бенчмарков);
+    по умолчанию авторизуемся сервис-аккаунтом из GSSERVICEJSON.
+    """
+    global GSCLIENT, GS_SHEET, CLIENTS_WS, TX_WS, TG_LINKS_WS, TX_PARTITIONS_WS
+    if GSCLIENT is not None:
+        return
+
+    if client is None:
+        if not GSSERVICEJSON or not GSSHEETID:
+            print("No GS creds in env (GSSERVICEJSON/GSSHEETID)")
+            return
+        info = json.loads(GSSERVICEJSON)
+        client = service_account_from_dict(info)
+    sheet = sheets_call("*", "open_by_key", client.open_by_key, GSSHEETID or "")
+
+    try:
+        tg_links_ws = TrackedWorksheet(sheets_call("tg_links", "worksheet", sheet.worksheet, "tg_links"))
+    except Exception:
+        tg_links_ws = None
+
+    clients_ws = open_worksheet(
+        sheet, "clients", ["phone", "name", "created_at", "turnover", "bonus_balance", "level"], rows=1000,
+    )
+    tx_ws = open_worksheet(
+        sheet, "transactions", ["phone", "type", "amount", "bonus_delta", "ts", "comment"], rows=2000,
+    )
+    tx_partitions_ws = open_worksheet(sheet, TX_PARTITIONS_TITLE, TX_PARTITION_COLUMNS, rows=100)
 
     GSCLIENT = client
     GS_SHEET = sheet
     CLIENTS_WS = clients_ws
     TX_WS = tx_ws
     TG_LINKS_WS = tg_links_ws
+    TX_PARTITIONS_WS = tx_partitions_ws
 
     print("Google Sheets initialized")
 
 
+CLIENT_COLUMNS = ["phone", "name", "created_at", "turnover", "bonus_balance", "level"]
+TG_LINKS_COLUMNS = ["user_id", "username", "first_name", "phone", "linked_at"]
+
+
+def read_rows(ws, start: int, end: int | None = None, width: int = 6) -> list[list]:
+    """Строки листа start..end (до конца, если end не задан) без форматирования."""
+    last_col = chr(ord("A") + width - 1)
+    try:
+        return ws.get(f"A{start}:{last_col}{end or ''}", value_render_option=ValueRenderOption.unformatted)
+    except gspread.exceptions.APIError as e:
+        # диапазон за границей сетки — значит, новых строк нет
+        if "exceeds grid limits" not in str(e):
+            raise
+        return []
+
+
+def _row_from_append(resp) -> int | None:
+    """Номер строки, в которую легла запись append_row (из ответа Sheets API)."""
+    try:
+        updated_range = resp["updates"]["updatedRange"]  # например "clients!A12:F12"
+    except (TypeError, KeyError):
+        return None
+    m = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(m.group(1)) if m else None
+
+
+class ClientStore:
+    """In-memory индекс листа clients: phone -> (номер строки, запись).
+
+    Лист читается одним get_all_records() при первом обращении (и повторно после GS_CACHE_TTL),
+    дальше поиск и обновление клиента стоят O(1) запросов к Sheets.
+    Если задан writer (WriteBehind), обновления строк копятся и уходят одним batch_update.
+    """
+
+    def __init__(self, ws, ttl: int = GS_CACHE_TTL, writer=None):
+        self.ws = ws
+        self.ttl = ttl
+        self.writer = writer
+        self._index: dict[str, tuple[int, dict]] = {}
+        self._next_row = 2  # 1 строка — заголовок
+        self._loaded_at = None
+        self._lock = threading.RLock()
+        # отложенные записи: phone -> (строка, значения A:F); последняя запись побеждает
+        self._pending: dict[str, tuple[int, list]] = {}
+        self._inflight: dict[str, tuple[int, list]] = {}
+
+    def load(self):
+        """Загрузить лист целиком и перестроить индекс."""
+        records = self.ws.get_all_records(numericise_ignore=[1])  # телефон — текст, не число
+        index = {}
+        for idx, r in enumerate(records, start=2):  # строка в Sheets = idx
+            phone = phone_key(r.get("phone", ""))
+            if phone and phone not in index:  # как и раньше, берём первое совпадение
+                index[phone] = (idx, r)
+        with self._lock:
+            # ещё не записанные в лист изменения важнее того, что мы только что прочитали
+            for phone, (row_idx, values) in {**self._inflight, **self._pending}.items():
+                index[phone] = (row_idx, dict(zip(CLIENT_COLUMNS, values)))
+            self._index = index
+            self._next_row = len(records) + 2
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or (self.ttl and time.monotonic() - self._loaded_at > self.ttl):
+            self.load()
+
+    def dump(self) -> dict | None:
+        """Состояние индекса для снимка; None, пока есть не записанные в лист изменения."""
+        with self._lock:
+            if self._loaded_at is None or self._pending or self._inflight:
+                return None
+            return {"index": dict(self._index), "next_row": self._next_row}
+
+    def restore(self, state: dict):
+        """Поднять индекс из снимка без чтения листа."""
+        with self._lock:
+            self._index = state["index"]
+            self._next_row = state["next_row"]
+            self._loaded_at = time.monotonic()
+
+    def load_tail(self):
+        """Дочитать строки, дописанные после снимка. Правки старых строк подтянет load() по TTL."""
+        with self._lock:
+            rows = read_rows(self.ws, self._next_row)
+            for idx, row in enumerate(rows, start=self._next_row):
+                record = dict(zip(CLIENT_COLUMNS, list(row) + [""] * (len(CLIENT_COLUMNS) - len(row))))
+                phone = phone_key(record["phone"])
+                if phone and phone not in self._index:
+                    self._index[phone] = (idx, record)
+            self._next_row += len(rows)
+
+    def get(self, phone: str) -> dict | None:
+        """Копия записи клиента или None."""
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._index.get(phone_key(phone))
+            return dict(hit[1]) if hit else None
+
+    def row_of(self, phone: str) -> int | None:
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._index.get(phone_key(phone))
+            return hit[0] if hit else None
+
+    def add(self, record: dict) -> dict:
+        """Дописать нового клиента в конец листа и в индекс.
+
+        Новая строка пишется сразу: номер строки нужен, чтобы адресовать последующие обновления.
+        """
+        phone = phone_key(record.get("phone", ""))
+        row = [record.get(col, "") for col in CLIENT_COLUMNS]
+        with self._lock:
+            self._ensure_loaded()
+            resp = self.ws.append_row(row, value_input_option="RAW")
+            row_idx = _row_from_append(resp) or self._next_row
+            self._next_row = max(self._next_row, row_idx + 1)
+            self._index[phone] = (row_idx, dict(record))
+        return dict(record)
+
+    def add_many(self, records: list[dict]):
+        """Дописать нескольких новых клиентов одним append_rows."""
+        if not records:
+            return
+        rows = [[record.get(col, "") for col in CLIENT_COLUMNS] for record in records]
+        with self._lock:
+            self._ensure_loaded()
+            resp = self.ws.append_rows(rows, value_input_option="RAW")
+            first = _row_from_append(resp) or self._next_row
+            for row_idx, record in enumerate(records, start=first):
+                self._index[phone_key(record.get("phone", ""))] = (row_idx, dict(record))
+            self._next_row = max(self._next_row, first + len(records))
+
+    def _write_row(self, phone: str, row_idx: int, values: list):
+        if self.writer is None:
+            self.ws.update(f"A{row_idx}:F{row_idx}", [values])
+            return
+        self._pending[phone] = (row_idx, values)
+        self.writer.notify()
+
+    def set_name(self, phone: str, name: str):
+        """Обновить только имя (чтобы не трогать оборот/бонусы)."""
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._index.get(phone_key(phone))
+            if hit is None:
+                return
+            row_idx, record = hit
+            if str(record.get("name", "")) == name:
+                return
+            record["name"] = name
+            if self.writer is None:
+                self.ws.update_cell(row_idx, 2, name)
+            else:
+                self._write_row(phone_key(phone), row_idx, [record.get(col, "") for col in CLIENT_COLUMNS])
+
+    def update(self, record: dict) -> bool:
+        """Перезаписать строку клиента A:F по индексу. False — клиента нет в листе."""
+        phone = phone_key(record.get("phone", ""))
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._index.get(phone)
+            if hit is None:
+                return False
+            row_idx, _ = hit
+            values = [
+                phone,
+                record.get("name", ""),
+                record.get("created_at", ""),
+                record.get("turnover", 0),
+                record.get("bonus_balance", 0),
+                record.get("level", "silver"),
+            ]
+            self._index[phone] = (row_idx, dict(zip(CLIENT_COLUMNS, values)))
+            self._write_row(phone, row_idx, values)
+            return True
+
+    def all(self) -> list[dict]:
+        """Копии всех записей (снимок индекса)."""
+        self._ensure_loaded()  # лист по TTL перечитываем, не держа блокировку (load берёт её на подмену)
+        with self._lock:
+            return [dict(r) for _, r in self._index.values()]
+
+    def update_levels(self, levels: dict[str, tuple[float, str]]) -> int:
+        """Записать уровни: phone -> (оборот, по которому посчитан уровень, уровень).
+
+        Строки, оборот которых с тех пор изменился, пропускаются: их уровень уже записала сама
+        операция. С writer строки уходят через _pending, как обычные обновления, — запрос к Sheets
+        делает WriteBehind, а не держатель блокировки. Без writer — ячейки F одним batch_update.
+        """
+        batch, changed = [], 0
+        with self._lock:
+            self._ensure_loaded()
+            for phone, (turnover, level) in levels.items():
+                phone = phone_key(phone)
+                hit = self._index.get(phone)
+                if hit is None or hit[1].get("level") == level or _num(hit[1].get("turnover")) != turnover:
+                    continue
+                record = dict(hit[1], level=level)
+                self._index[phone] = (hit[0], record)
+                changed += 1
+                if self.writer is None:
+                    batch.append({"range": f"F{hit[0]}", "values": [[level]]})
+                else:
+                    # строка, уже отправляемая со старым уровнем (_inflight), перепишется следующим flush
+                    self._pending[phone] = (hit[0], [record.get(col, "") for col in CLIENT_COLUMNS])
+            if batch:  # без writer все записи идут под блокировкой — так они не обгоняют друг друга
+                self.ws.batch_update(batch)
+        if changed and self.writer is not None:
+            self.writer.notify()
+        return changed
+
+    def update_many(self, records: list[dict]):
+        """Перезаписать несколько строк одним batch_update (мимо отложенной записи)."""
+        batch = []
+        with self._lock:
+            self._ensure_loaded()
+            for record in records:
+                phone = phone_key(record.get("phone", ""))
+                hit = self._index.get(phone)
+                if hit is None:
+                    continue
+                values = [record.get(col, "") for col in CLIENT_COLUMNS]
+                batch.append({"range": f"A{hit[0]}:F{hit[0]}", "values": [values]})
+                self._index[phone] = (hit[0], dict(zip(CLIENT_COLUMNS, values)))
+                self._pending.pop(phone, None)  # новее значения уже не будет
+            if batch:
+                self.ws.batch_update(batch)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def flush_pending(self):
+        """Отправить накопленные обновления строк одним batch_update."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            batch = [
+                {"range": f"A{row_idx}:F{row_idx}", "values": [values]}
+                for row_idx, values in self._inflight.values()
+            ]
+        try:
+            self.ws.batch_update(batch)
+        except Exception as e:
+            with self._lock:
+                if write_refused(e):
+                    # повтор не поможет: выбрасываем пачку, индекс перечитаем из листа
+                    print(f"clients: dropped {len(batch)} row updates refused by Sheets: {e}")
+                    self._loaded_at = None
+                else:
+                    # вернём в очередь всё, что не успели перезаписать более свежими значениями
+                    for phone, item in self._inflight.items():
+                        self._pending.setdefault(phone, item)
+                self._inflight = {}
+            raise
+        with self._lock:
+            self._inflight = {}
+
+
+class TgLinksStore:
+    """Двусторонний индекс листа tg_links: user_id -> (строка, phone) и phone -> {user_id}.
+
+    Как и ClientStore, лист читается один раз (и после GS_CACHE_TTL), разрешение user_id <-> phone
+    идёт без сетевых запросов, перепривязка обновляет ровно одну строку.
+    """
+
+    def __init__(self, ws, ttl: int = GS_CACHE_TTL):
+        self.ws = ws
+        self.ttl = ttl
+        self._by_user: dict[int, tuple[int, str]] = {}
+        self._by_phone: dict[str, set[int]] = {}
+        self._next_row = 2
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        records = self.ws.get_all_records(numericise_ignore=[4])
+        by_user, by_phone = {}, {}
+        for idx, r in enumerate(records, start=2):
+            uid_str = str(r.get("user_id", "")).strip()
+            if not uid_str.isdigit():
+                continue
+            uid = int(uid_str)
+            if uid in by_user:  # дубль строки — как и раньше, действует первая
+                continue
+            phone = phone_key(r.get("phone", ""))
+            by_user[uid] = (idx, phone)
+            if phone:
+                by_phone.setdefault(phone, set()).add(uid)
+        with self._lock:
+            self._by_user = by_user
+            self._by_phone = by_phone
+            self._next_row = len(records) + 2
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or (self.ttl and time.monotonic() - self._loaded_at > self.ttl):
+            self.load()
+
+    def dump(self) -> dict | None:
+        with self._lock:
+            if self._loaded_at is None:
+                return None
+            return {"by_user": dict(self._by_user), "next_row": self._next_row}
+
+    def restore(self, state: dict):
+        by_phone = {}
+        for uid, (_, phone) in state["by_user"].items():
+            if phone:
+                by_phone.setdefault(phone, set()).add(uid)
+        with self._lock:
+            self._by_user = state["by_user"]
+            self._by_phone = by_phone
+            self._next_row = state["next_row"]
+            self._loaded_at = time.monotonic()
+
+    def load_tail(self):
+        """Дочитать связки, дописанные после снимка."""
+        with self._lock:
+            rows = read_rows(self.ws, self._next_row, width=len(TG_LINKS_COLUMNS))
+            for idx, row in enumerate(rows, start=self._next_row):
+                record = dict(zip(TG_LINKS_COLUMNS, list(row) + [""] * (len(TG_LINKS_COLUMNS) - len(row))))
+                uid_str = str(record["user_id"]).strip()
+                if not uid_str.isdigit() or int(uid_str) in self._by_user:
+                    continue
+                phone = phone_key(record["phone"])
+                self._by_user[int(uid_str)] = (idx, phone)
+                if phone:
+                    self._by_phone.setdefault(phone, set()).add(int(uid_str))
+            self._next_row += len(rows)
+
+    def phone_of(self, user_id: int) -> str | None:
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._by_user.get(int(user_id))
+            return (hit[1] or None) if hit else None
+
+    def users_of(self, phone: str) -> list[int]:
+        with self._lock:
+            self._ensure_loaded()
+            return sorted(self._by_phone.get(phone_key(phone), ()))
+
+    def user_ids_after(self, after: int | None, limit: int) -> list[int]:
+        """Следующие limit привязанных user_id по возрастанию (для потоковой рассылки)."""
+        with self._lock:
+            self._ensure_loaded()
+            ids = sorted(uid for uid, (_, phone) in self._by_user.items() if phone)
+        start = 0 if after is None else bisect.bisect_right(ids, after)
+        return ids[start:start + limit]
+
+    def count_users(self, exclude=frozenset()) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return sum(1 for uid, (_, phone) in self._by_user.items() if phone and uid not in exclude)
+
+    def link(self, user, phone: str):
+        """Создать или перезаписать строку связки и поправить оба направления индекса."""
+        phone = phone_key(phone)
+        now = datetime.utcnow().isoformat(timespec="seconds")
+        row_values = [
+            str(user.id),
+            user.username or "",
+            user.first_name or "",
+            phone,
+            now,
+        ]
+        with self._lock:
+            self._ensure_loaded()
+            hit = self._by_user.get(user.id)
+            if hit is None:
+                resp = self.ws.append_row(row_values, value_input_option="RAW")
+                row_idx = _row_from_append(resp) or self._next_row
+                self._next_row = max(self._next_row, row_idx + 1)
+            else:
+                row_idx, old_phone = hit
+                self.ws.update(f"A{row_idx}:E{row_idx}", [row_values])
+                users = self._by_phone.get(old_phone)
+                if users is not None:
+                    users.discard(user.id)
+                    if not users:
+                        del self._by_phone[old_phone]
+            self._by_user[user.id] = (row_idx, phone)
+            self._by_phone.setdefault(phone, set()).add(user.id)
+
+
+TX_COLUMNS = ["phone", "type", "amount", "bonus_delta", "ts", "comment"]
+
+
+class TxCache:
+    """Append-only кэш листа transactions с кольцом последних операций на каждый телефон.
+
+    Лист только растёт, поэтому вместо get_all_records() дочитываем хвост: строки после
+    последней синхронизированной. Новые записи из log_transaction попадают в кэш сразу,
+    а в лист — сразу или пачкой через WriteBehind (append_rows).
+    Кроме колец, для каждого телефона хранятся номера его строк в листе: страница истории
+    глубже кольца читается одним batch_get, сколько бы операций ни было до неё.
+    """
+
+    def __init__(self, ws, ring_size: int = TX_RING_SIZE, sync_interval: int = TX_SYNC_INTERVAL, writer=None):
+        self.ws = ws
+        self.ring_size = ring_size
+        self.sync_interval = sync_interval
+        self.writer = writer
+        self._recent: dict[str, deque] = {}
+        self._rows: dict[str, list[int]] = {}  # phone -> номера строк в листе по возрастанию
+        self._synced_rows = 1  # 1 строка — заголовок
+        self._synced_at = None
+        self._pending: list[list] = []
+        # сколько первых строк _pending ушло в append_rows, который упал с неизвестным исходом
+        self._unsure = 0
+        self._lock = threading.RLock()
+
+    def _add(self, record: dict, row: int | None = None, unwritten: dict[str, int] | None = None):
+        """row — номер строки в листе; None, пока запись ждёт отправки.
+
+        Строка, дочитанная из листа, старше наших ещё не записанных операций (unwritten —
+        их число по телефону, см. _count_unwritten) и встаёт в кольцо перед ними.
+        """
+        phone = phone_key(record.get("phone", ""))
+        if not phone:
+            return
+        ring = self._recent.get(phone)
+        if ring is None:
+            ring = self._recent[phone] = deque(maxlen=self.ring_size)
+        tail = unwritten.get(phone, 0) if unwritten else 0
+        if not tail:
+            ring.append(record)
+        elif tail < len(ring) or len(ring) < self.ring_size:
+            if len(ring) == self.ring_size:
+                ring.popleft()
+            ring.insert(max(len(ring) - tail, 0), record)
+        # иначе кольцо целиком из незаписанных, а строка из листа старше их всех — в кольцо не попадает
+        if row is not None:
+            self._rows.setdefault(phone, []).append(row)
+
+    @staticmethod
+    def _count_unwritten(rows: list[list]) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for values in rows:
+            phone = phone_key(values[0])
+            counts[phone] = counts.get(phone, 0) + 1
+        return counts
+
+    def _read_rows(self, start: int, end: int | None = None):
+        return read_rows(self.ws, start, end)
+
+    def sync(self):
+        """Дочитать строки, появившиеся после последней синхронизации."""
+        with self._lock:
+            rows = self._read_rows(self._synced_rows + 1)
+            unwritten = self._count_unwritten(self._pending)
+            for row_idx, row in enumerate(rows, start=self._synced_rows + 1):
+                row = list(row) + [""] * (len(TX_COLUMNS) - len(row))
+                self._add(dict(zip(TX_COLUMNS, row)), row_idx, unwritten)
+            self._synced_rows += len(rows)
+            self._synced_at = time.monotonic()
+
+    def _ensure_synced(self):
+        if self._synced_at is None or time.monotonic() - self._synced_at > self.sync_interval:
+            self.sync()
+
+    def dump(self) -> dict | None:
+        with self._lock:
+            if self._synced_at is None or self._pending:
+                return None
+            return {
+                "recent": {p: list(r) for p, r in self._recent.items()},
+                "rows": {p: list(r) for p, r in self._rows.items()},
+                "synced_rows": self._synced_rows,
+            }
+
+    def restore(self, state: dict):
+        """Поднять кольца из снимка; хвост листа после synced_rows дочитает sync()."""
+        with self._lock:
+            self._recent = {p: deque(r, maxlen=self.ring_size) for p, r in state["recent"].items()}
+            self._rows = state["rows"]
+            self._synced_rows = state["synced_rows"]
+            self._synced_at = time.monotonic()
+
+    def _written(self, resp, values: list[list]):
+        """Сдвинуть курсор после успешной записи наших строк в лист."""
+        first = _row_from_append(resp)
+        if first is not None and first > self._synced_rows + 1:
+            # между синхронизациями в лист писали мимо бота — дочитываем только этот разрыв
+            # (в кольце эти строки встают перед values и ещё не отправленными)
+            unwritten = self._count_unwritten(self._pending + values)
+            for row_idx, row in enumerate(self._read_rows(self._synced_rows + 1, first - 1), start=self._synced_rows + 1):
+                row = list(row) + [""] * (len(TX_COLUMNS) - len(row))
+                self._add(dict(zip(TX_COLUMNS, row)), row_idx, unwritten)
+            self._synced_rows = first - 1
+        for row_idx, row in enumerate(values, start=self._synced_rows + 1):
+            phone = phone_key(row[0])
+            if phone:
+                self._rows.setdefault(phone, []).append(row_idx)
+        self._synced_rows += len(values)
+
+    def append(self, values: list):
+        """Дописать транзакцию в кэш и в лист (сразу или через WriteBehind)."""
+        with self._lock:
+            self._ensure_synced()
+            self._add(dict(zip(TX_COLUMNS, values)))
+            if self.writer is None:
+                resp = self.ws.append_row(values, value_input_option="RAW")
+                self._written(resp, [values])
+                return
+            self._pending.append(values)
+        self.writer.notify()
+
+    def append_many(self, rows: list[list]):
+        """Дописать пачку транзакций одним append_rows, минуя отложенную запись."""
+        with self._lock:
+            self._ensure_synced()
+            self.flush_pending()  # всё, что ждёт отправки, в листе должно оказаться раньше
+            resp = self.ws.append_rows(rows, value_input_option="RAW")
+            for values in rows:
+                self._add(dict(zip(TX_COLUMNS, values)))
+            self._written(resp, rows)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def _resolve_unsure(self):
+        """Прошлая отправка упала с неизвестным исходом: ищем её строки в хвосте листа.
+        Нашлись — считаем записанными и повторно не шлём; нет — отправим как обычно."""
+        batch = self._pending[:self._unsure]
+        tail = [list(r) + [""] * (len(TX_COLUMNS) - len(r)) for r in self._read_rows(self._synced_rows + 1)]
+        for i in range(len(tail) - len(batch) + 1):
+            if all(_same_tx(tail[i + k], values) for k, values in enumerate(batch)):
+                break
+        else:
+            self._unsure = 0
+            return
+        print(f"transactions: {len(batch)} rows from the failed append are already in the sheet")
+        start = self._synced_rows + 1
+        # чужие строки до нашей пачки старше неё, после — старше только оставшихся в очереди
+        before = self._count_unwritten(self._pending)
+        after = self._count_unwritten(self._pending[len(batch):])
+        for row_idx, row in enumerate(tail, start=start):
+            if i <= row_idx - start < i + len(batch):
+                phone = phone_key(row[0])
+                if phone:
+                    self._rows.setdefault(phone, []).append(row_idx)
+            else:  # строки, дописанные мимо бота
+                self._add(dict(zip(TX_COLUMNS, row)), row_idx, before if row_idx - start < i else after)
+        self._synced_rows += len(tail)
+        self._pending = self._pending[len(batch):]
+        self._unsure = 0
+
+    def flush_pending(self):
+        """Отправить накопленные транзакции одним append_rows."""
+        with self._lock:
+            if self._unsure:
+                self._resolve_unsure()
+            if not self._pending:
+                return
+            batch = self._pending
+            try:
+                resp = self.ws.append_rows(batch, value_input_option="RAW")
+            except Exception as e:
+                if write_refused(e):
+                    # повтор не поможет: выбрасываем пачку и из очереди, и из колец
+                    print(f"transactions: dropped {len(batch)} rows refused by Sheets: {e}")
+                    self._pending = []
+                    self._forget(batch)
+                elif not write_rejected(e):
+                    self._unsure = len(batch)
+                raise
+            self._pending = []
+            self._written(resp, batch)
+
+    def page(self, start_row: int, size: int) -> tuple[list[dict], int]:
+        """Строки листа start_row..start_row+size-1 (без кэша) и номер следующей строки."""
+        rows = self._read_rows(start_row, start_row + size - 1)
+        records = [dict(zip(TX_COLUMNS, list(r) + [""] * (len(TX_COLUMNS) - len(r)))) for r in rows]
+        return records, start_row + len(rows)
+
+    def _forget(self, rows: list[list]):
+        """Убрать из колец записи, которые так и не попадут в лист."""
+        for values in rows:
+            ring = self._recent.get(phone_key(values[0]))
+            record = dict(zip(TX_COLUMNS, values))
+            if ring and record in ring:
+                ring.remove(record)
+
+    def _unwritten(self, phone: str) -> int:
+        return sum(1 for values in self._pending if phone_key(values[0]) == phone)
+
+    def count(self, phone: str) -> int:
+        """Сколько операций по телефону в этом листе (вместе с ещё не отправленными)."""
+        with self._lock:
+            self._ensure_synced()
+            phone = phone_key(phone)
+            return len(self._rows.get(phone, ())) + self._unwritten(phone)
+
+    def cached(self, phone: str, limit: int, sync: bool = True) -> list[dict]:
+        """До limit самых новых операций по телефону из кольца, новые первыми; глубже не читаем.
+        sync=False — и хвост листа не дочитываем, отвечаем только из памяти."""
+        with self._lock:
+            if sync:
+                self._ensure_synced()
+            ring = self._recent.get(phone_key(phone)) or ()
+            return [dict(r) for r in list(reversed(ring))[:limit]]
+
+    def recent(self, phone: str, limit: int, offset: int = 0) -> list[dict]:
+        """limit операций по телефону после offset самых новых, новые первыми."""
+        with self._lock:
+            self._ensure_synced()
+            phone = phone_key(phone)
+            ring = self._recent.get(phone) or ()
+            res = [dict(r) for r in list(reversed(ring))[offset:offset + limit]]
+            if len(res) >= limit:
+                return res
+            # глубже кольца: k-я с конца операция — строка rows[-1 - (k - unwritten)]
+            unwritten = self._unwritten(phone)
+            rows = self._rows.get(phone, [])
+            wanted = [
+                rows[-1 - (k - unwritten)]
+                for k in range(max(offset, len(ring)), offset + limit)
+                if 0 <= k - unwritten < len(rows)
+            ]
+            if not wanted:
+                return res
+            values = self.ws.batch_get(
+                [f"A{r}:F{r}" for r in wanted], value_render_option=ValueRenderOption.unformatted,
+            )
+            for v in values:
+                row = list(v[0]) if v else []
+                res.append(dict(zip(TX_COLUMNS, row + [""] * (len(TX_COLUMNS) - len(row)))))
+            return res
+
+
+def _same_tx(row: list, values: list) -> bool:
+    """Строка из листа — это наша транзакция values (числа сравниваем как числа)."""
+    return (
+        phone_key(row[0]) == phone_key(values[0])
+        and str(row[1]) == str(values[1])
+        and _num(row[2]) == _num(values[2])
+        and _num(row[3]) == _num(values[3])
+        and str(row[4]) == str(values[4])
+        and str(row[5]) == str(values[5])
+    )
+
+
+TX_PARTITIONS_TITLE = "tx_partitions"
+TX_PARTITION_COLUMNS = ["title", "month", "created_at"]
+LEGACY_TX_TITLE = "transactions"  # всё, что записано до разбиения по месяцам
+
+
+POS_IMPORTS_TITLE = "pos_imports"  # реестр чеков, проведённых импортом из кассы
+POS_IMPORT_COLUMNS = ["ref", "phone", "amount", "imported_at"]
+
+
+def open_pos_imports(title: str):
+    init_gs()
+    return open_worksheet(GS_SHEET, title, POS_IMPORT_COLUMNS, rows=1000)
+
+
+def tx_partition_title(month: str) -> str:
+    """"2024-05" -> "transactions_2024_05"."""
+    return "transactions_" + month.replace("-", "_")
+
+
+def open_tx_partition(title: str):
+    init_gs()
+    return open_worksheet(GS_SHEET, title, TX_COLUMNS, rows=2000)
+
+
+class TxPartitions:
+    """Журнал транзакций, разбитый по месяцам: листы transactions_YYYY_MM и каталог tx_partitions.
+
+    Первым в списке всегда идёт старый лист transactions. Горячий лист — текущего месяца:
+    в него пишутся новые операции, и при старте синхронизируется только он. Закрытые месяцы
+    больше не меняются, поэтому каждый из них читается один раз, когда до него дошла история.
+    """
+
+    def __init__(self, legacy_ws, catalog_ws=None, writer=None, opener=None):
+        self.catalog_ws = catalog_ws  # None — каталога нет, всё пишется в legacy_ws
+        self.writer = writer
+        self.opener = opener or open_tx_partition
+        self._parts: list[tuple[str, str]] = [(LEGACY_TX_TITLE, "")]  # (лист, месяц) от старых к новым
+        self._caches: dict[str, TxCache] = {LEGACY_TX_TITLE: TxCache(legacy_ws, writer=writer)}
+        self._catalog_loaded = catalog_ws is None
+        self._lock = threading.RLock()
+
+    def _ensure_catalog(self):
+        if self._catalog_loaded:
+            return
+        parts = []
+        for r in self.catalog_ws.get_all_records():
+            title, month = str(r.get("title", "")).strip(), str(r.get("month", "")).strip()
+            if title and month:
+                parts.append((title, month))
+        self._parts = [(LEGACY_TX_TITLE, "")] + sorted(parts, key=lambda p: p[1])
+        self._catalog_loaded = True
+        for title, _ in self._parts[:-1]:
+            if title in self._caches:
+                self._caches[title].sync_interval = float("inf")
+
+    def _current(self) -> str:
+        return self._parts[-1][0]
+
+    def _cache(self, title: str) -> TxCache:
+        cache = self._caches.get(title)
+        if cache is None:
+            # закрытый месяц не пересинхронизируем
+            interval = TX_SYNC_INTERVAL if title == self._current() else float("inf")
+            cache = self._caches[title] = TxCache(
+                LazyWorksheet(title, opener=self.opener), sync_interval=interval, writer=self.writer,
+            )
+        return cache
+
+    def titles(self) -> list[str]:
+        """Листы журнала от старых к новым."""
+        with self._lock:
+            self._ensure_catalog()
+            return [title for title, _ in self._parts]
+
+    def ws_of(self, title: str):
+        with self._lock:
+            return self._cache(title).ws
+
+    def _rotate(self, month: str):
+        """Начать лист нового месяца и записать его в каталог."""
+        prev = self._cache(self._current())
+        prev.flush_pending()  # хвост прошлого месяца дописываем в его лист
+        prev.sync_interval = float("inf")
+        title = tx_partition_title(month)
+        cache = TxCache(self.opener(title), writer=self.writer)
+        now = datetime.utcnow().isoformat(timespec="seconds")
+        self.catalog_ws.append_row([title, month, now], value_input_option="RAW")
+        self._caches[title] = cache
+        self._parts.append((title, month))
+        print(f"transactions: new partition {title}")
+
+    def append(self, values: list):
+        ts = str(values[4])
+        month = ts[:7] if re.match(r"\d{4}-\d{2}", ts) else datetime.utcnow().strftime("%Y-%m")
+        with self._lock:
+            self._ensure_catalog()
+            if self.catalog_ws is not None and month > self._parts[-1][1]:
+                self._rotate(month)
+            cache = self._cache(self._current())
+        cache.append(values)
+
+    def append_many(self, rows: list[list]):
+        """Пачка операций (импорт) — в лист месяца, в котором её записываем."""
+        month = datetime.utcnow().strftime("%Y-%m")
+        with self._lock:
+            self._ensure_catalog()
+            if self.catalog_ws is not None and month > self._parts[-1][1]:
+                self._rotate(month)
+            cache = self._cache(self._current())
+        cache.append_many(rows)
+
+    def recent(self, phone: str, limit: int, offset: int = 0) -> list[dict]:
+        """limit операций после offset самых новых: идём по месяцам от нового к старому,
+        месяцы целиком до offset пропускаем по счётчику, пока не наберём limit."""
+        res = []
+        for title in reversed(self.titles()):
+            with self._lock:
+                cache = self._cache(title)
+            n = cache.count(phone)
+            if offset >= n:
+                offset -= n
+                continue
+            res.extend(cache.recent(phone, limit - len(res), offset))
+            offset = 0
+            if len(res) >= limit:
+                break
+        return res
+
+    def cached(self, phone: str, limit: int) -> list[dict]:
+        """Свежие операции из колец в памяти: текущий месяц и, если его кэш уже поднят,
+        предыдущий (повтор мог прийти сразу после смены месяца). Закрытые листы не читаем."""
+        with self._lock:
+            self._ensure_catalog()
+            current = self._cache(self._current())
+            prev = self._caches.get(self._parts[-2][0]) if len(self._parts) > 1 else None
+        res = current.cached(phone, limit)
+        if prev is not None and len(res) < limit:
+            res.extend(prev.cached(phone, limit - len(res), sync=False))
+        return res
+
+    def sync(self):
+        with self._lock:
+            self._ensure_catalog()
+            cache = self._cache(self._current())
+        cache.sync()
+
+    def page(self, cursor, size: int) -> tuple[list[dict], list[int]]:
+        """Порция строк по всем листам от старых к новым; курсор — [номер листа, строка].
+        Число вместо курсора — строка в старом листе transactions (чекпоинты до разбиения)."""
+        idx, row = cursor if isinstance(cursor, (list, tuple)) else (0, cursor or 2)
+        titles = self.titles()
+        records = []
+        while idx < len(titles):
+            with self._lock:
+                cache = self._cache(titles[idx])
+            chunk, row = cache.page(row, size - len(records))
+            records.extend(chunk)
+            if len(records) >= size or idx == len(titles) - 1:
+                break
+            idx, row = idx + 1, 2
+        return records, [idx, row]
+
+    def pending_count(self) -> int:
+        return sum(cache.pending_count() for cache in list(self._caches.values()))
+
+    def reset(self):
+        """Забыть кэши всех листов (после массовой правки журнала); перечитаются по требованию."""
+        with self._lock:
+            legacy = self._caches[LEGACY_TX_TITLE]
+            self._caches = {LEGACY_TX_TITLE: TxCache(legacy.ws, writer=self.writer)}
+            self._catalog_loaded = self.catalog_ws is None
+
+    def flush_pending(self):
+        for cache in list(self._caches.values()):
+            if cache.pending_count():
+                cache.flush_pending()
+
+    def dump(self) -> dict | None:
+        with self._lock:
+            if not self._catalog_loaded:
+                return None
+            caches = {}
+            for title, cache in self._caches.items():
+                state = cache.dump()
+                if state is None:
+                    if cache.pending_count() or title == self._current():
+                        return None
+                    continue  # закрытый месяц ещё не читали — в снимок не попадает
+                caches[title] = state
+            return {"parts": list(self._parts), "caches": caches}
+
+    def restore(self, state: dict):
+        with self._lock:
+            self._parts = [tuple(p) for p in state["parts"]]
+            self._catalog_loaded = True
+            for title, cache_state in state["caches"].items():
+                cache = self._cache(title)
+                cache.restore(cache_state)
+                if title != self._current():
+                    cache.sync_interval = float("inf")
+
+
+class WriteBehind:
+    """Отложенная запись в Sheets: хранилища копят изменения, а этот объект сбрасывает их
+    раз в WB_FLUSH_INTERVAL секунд или сразу, как только набралось WB_MAX_PENDING записей.
+
+    flush() можно вызвать явно (например, при остановке бота).
+    """
+
+    def __init__(self, interval: float = None, max_pending: int = None):
+        self.interval = WB_FLUSH_INTERVAL if interval is None else interval
+        self.max_pending = WB_MAX_PENDING if max_pending is None else max_pending
+        self.sinks = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def register(self, sink):
+        self.sinks.append(sink)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="gs-write-behind", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        if sum(s.pending_count() for s in self.sinks) >= self.max_pending:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    @sheets_priority(PRIORITY_ADMIN)  # в очереди лежат записи админских операций
+    def flush(self):
+        with self._flush_lock:
+            for sink in self.sinks:
+                try:
+                    sink.flush_pending()
+                except Exception as e:
+                    print(f"write-behind flush error ({type(sink).__name__}): {e}")
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+# === ХРАНИЛИЩЕ ===
+# Все операции бота с данными идут через BACKEND; хендлеры не знают, Sheets под ним или SQLite.
+
+class StorageBackend:
+    """Интерфейс хранилища: ровно те операции, которые выполняет бот."""
+
+    def find_client(self, phone: str) -> dict | None:
+        raise NotImplementedError
+
+    def upsert_client(self, phone: str, name: str | None = None) -> dict | None:
+        raise NotImplementedError
+
+    def update_client(self, client: dict):
+        raise NotImplementedError
+
+    def log_transaction(self, values: list):
+        """values — строка в порядке TX_COLUMNS."""
+        raise NotImplementedError
+
+    def apply_operation(self, client: dict, values: list):
+        """Операция над клиентом: его новое состояние и строка журнала (values) вместе."""
+        self.update_client(client)
+        self.log_transaction(values)
+
+    def list_transactions(self, phone: str, limit: int, offset: int = 0) -> list[dict]:
+        """Операции по телефону, новые первыми: limit штук после offset самых новых."""
+        raise NotImplementedError
+
+    def recent_operations(self, phone: str, limit: int) -> list[dict]:
+        """Самые свежие операции для проверки повторов: дёшево, без чтения старой истории."""
+        return self.list_transactions(phone, limit)
+
+    def link_user(self, user, phone: str):
+        raise NotImplementedError
+
+    def phone_by_user(self, user_id: int) -> str | None:
+        raise NotImplementedError
+
+    def user_ids_by_phone(self, phone: str) -> list[int]:
+        raise NotImplementedError
+
+    def linked_user_ids(self, after: int | None, limit: int) -> list[int]:
+        """Привязанные user_id по возрастанию, начиная после after (курсор рассылки)."""
+        raise NotImplementedError
+
+    def count_linked_users(self, exclude=frozenset()) -> int:
+        """Сколько пользователей привязано к телефону, не считая user_id из exclude."""
+        raise NotImplementedError
+
+    def iter_clients(self):
+        """Все клиенты (для сверки и пакетных задач)."""
+        raise NotImplementedError
+
+    def update_clients(self, clients: list[dict]):
+        """Перезаписать несколько клиентов одной пакетной записью."""
+        raise NotImplementedError
+
+    def update_levels(self, levels: dict[str, tuple[float, str]]) -> int:
+        """Записать только уровни: phone -> (оборот, по которому посчитан уровень, уровень).
+        Клиентов, чей оборот успел измениться, не трогать. Возвращает число изменённых строк."""
+        raise NotImplementedError
+
+    def transaction_page(self, cursor, size: int) -> tuple[list[dict], object]:
+        """Порция транзакций в порядке записи после курсора cursor (None — с начала)
+        и курсор для следующей порции. Пустая порция — дошли до конца."""
+        raise NotImplementedError
+
+    def merge_duplicate_phones(self, apply: bool) -> dict:
+        """Привести телефоны к E.164 и слить дубли клиентов (см. merge_duplicate_phones)."""
+        raise NotImplementedError
+
+    def known_import_refs(self) -> set[str]:
+        """Номера чеков, уже проведённых импортом из кассы."""
+        raise NotImplementedError
+
+    def apply_import(self, new_clients: list[dict], clients: list[dict], tx_rows: list[list], refs: list[list]):
+        """Записать результат импорта: новые и изменённые клиенты, строки журнала
+        и реестр проведённых чеков (refs — строки в порядке POS_IMPORT_COLUMNS)."""
+        raise NotImplementedError
+
+    def apply_batch(self, clients: list[dict], tx_rows: list[list]):
+        """Строки журнала и изменённые клиенты одной пакетной записью."""
+        self.apply_import([], clients, tx_rows, [])
+
+    def flush(self):
+        """Дописать отложенные изменения."""
+
+    def close(self):
+        self.flush()
+
+
+def _new_client(phone: str, name: str | None) -> dict:
+    return {
+        "phone": phone,
+        "name": name or "",
+        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "turnover": 0,
+        "bonus_balance": 0,
+        "level": "silver",
+    }
+
+
+class SheetsBackend(StorageBackend):
+    """Google Sheets через in-memory индексы (ClientStore / TgLinksStore / TxCache)."""
+
+    def __init__(self, clients_ws, tx_ws, tg_links_ws=None, tx_partitions_ws=None):
+        self.writer = WriteBehind() if WB_FLUSH_INTERVAL > 0 else None
+        self.clients = ClientStore(clients_ws, writer=self.writer)
+        self.links = TgLinksStore(tg_links_ws) if tg_links_ws is not None else None
+        self.txs = TxPartitions(tx_ws, tx_partitions_ws, writer=self.writer)
+        self.keeper = None  # SnapshotKeeper, если включён тёплый старт
+        self.pos_imports_ws = LazyWorksheet(POS_IMPORTS_TITLE, opener=open_pos_imports)
+        if self.writer is not None:
+            self.writer.register(self.clients)
+            self.writer.register(self.txs)
+            self.writer.start()
+
+    def find_client(self, phone):
+        return self.clients.get(phone)
+
+    def upsert_client(self, phone, name=None):
+        existing = self.clients.get(phone)
+        if existing is None:
+            # новый клиент
+            return self.clients.add(_new_client(phone, name))
+
+        # обновляем имя, если есть
+        new_name = name or existing.get("name", "")
+        self.clients.set_name(phone, new_name)
+        existing["name"] = new_name
+        return existing
+
+    def update_client(self, client):
+        self.clients.update(client)
+
+    def log_transaction(self, values):
+        self.txs.append(values)
+
+    def list_transactions(self, phone, limit, offset=0):
+        return self.txs.recent(phone, limit, offset)
+
+    def recent_operations(self, phone, limit):
+        return self.txs.cached(phone, limit)
+
+    def link_user(self, user, phone):
+        if self.links is not None:
+            self.links.link(user, phone)
+
+    def phone_by_user(self, user_id):
+        return self.links.phone_of(user_id) if self.links is not None else None
+
+    def user_ids_by_phone(self, phone):
+        return self.links.users_of(phone) if self.links is not None else []
+
+    def linked_user_ids(self, after, limit):
+        return self.links.user_ids_after(after, limit) if self.links is not None else []
+
+    def count_linked_users(self, exclude=frozenset()):
+        return self.links.count_users(exclude) if self.links is not None else 0
+
+    def iter_clients(self):
+        return iter(self.clients.all())
+
+    def update_clients(self, clients):
+        if self.writer is None:
+            self.clients.update_many(clients)
+            return
+        # индекс меняется сразу, в лист строки уйдут одним batch_update из WriteBehind —
+        # вызывающий может держать блокировки телефонов, сеть под ними не нужна
+        for client in clients:
+            self.clients.update(client)
+        self.writer.notify()
+
+    def update_levels(self, levels):
+        return self.clients.update_levels(levels)
+
+    def transaction_page(self, cursor, size):
+        return self.txs.page(cursor, size)  # курсор — [номер листа, строка]
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def known_import_refs(self):
+        values = read_rows(self.pos_imports_ws, 2, width=1)
+        return {str(v[0]).strip() for v in values if v and str(v[0]).strip()}
+
+    def apply_import(self, new_clients, clients, tx_rows, refs):
+        # реестр чеков первым: если дальше что-то упадёт, повторный импорт не начислит бонусы дважды
+        # (чек из реестра без строки «Касса, чек …» в журнале виден); затем журнал — по нему
+        # балансы восстановит /reconcile fix
+        if refs:
+            self.pos_imports_ws.append_rows(refs, value_input_option="RAW")
+        if tx_rows:
+            self.txs.append_many(tx_rows)
+        self.clients.add_many(new_clients)
+        if clients:
+            self.clients.update_many(clients)
+
+    def merge_duplicate_phones(self, apply):
+        self.flush()
+        records = self.clients.ws.get_all_records(numericise_ignore=[1])
+        groups: dict[str, list[tuple[int, dict]]] = {}
+        for idx, r in enumerate(records, start=2):
+            if str(r.get("phone", "")).strip():
+                groups.setdefault(phone_key(r["phone"]), []).append((idx, r))
+
+        batch = []  # один batch_update: слитые клиенты, очищенные дубли, исправленные телефоны
+        duplicates, fixed = [], 0
+        for key, rows in groups.items():
+            if len(rows) > 1 or str(rows[0][1]["phone"]).strip() != key:
+                fixed += 1
+            if len(rows) > 1:
+                duplicates.append([str(r["phone"]) for _, r in rows])
+                merged = merge_client_records([r for _, r in rows])
+                batch.append({"range": f"A{rows[0][0]}:F{rows[0][0]}", "values": [[merged[c] for c in CLIENT_COLUMNS]]})
+                for idx, _ in rows[1:]:
+                    batch.append({"range": f"A{idx}:F{idx}", "values": [[""] * len(CLIENT_COLUMNS)]})
+            elif str(rows[0][1]["phone"]).strip() != key:
+                batch.append({"range": f"A{rows[0][0]}", "values": [[key]]})
+
+        def phone_fixes(ws, col: str) -> list[dict]:
+            values = ws.get(f"{col}2:{col}", value_render_option=ValueRenderOption.unformatted)
+            return [
+                {"range": f"{col}{idx}", "values": [[phone_key(v[0])]]}
+                for idx, v in enumerate(values, start=2)
+                if v and str(v[0]).strip() and phone_key(v[0]) != str(v[0]).strip()
+            ]
+
+        tx_fixes = {title: phone_fixes(self.txs.ws_of(title), "A") for title in self.txs.titles()}
+        link_fixes = phone_fixes(self.links.ws, "D") if self.links is not None else []
+        report = {
+            "duplicates": duplicates,
+            "clients_fixed": fixed,
+            "tx_fixed": sum(len(f) for f in tx_fixes.values()),
+            "links_fixed": len(link_fixes),
+        }
+        if not apply:
+            return report
+
+        # сначала журнал и связки: повторный запуск после сбоя досчитает их, не задев балансы
+        for title, fixes in tx_fixes.items():
+            if fixes:
+                self.txs.ws_of(title).batch_update(fixes)
+        if link_fixes:
+            self.links.ws.batch_update(link_fixes)
+        if batch:
+            self.clients.ws.batch_update(batch)
+        self.clients.load()
+        if self.links is not None:
+            self.links.load()
+        self.txs.reset()
+        return report
+
+    def dump(self) -> dict | None:
+        """Индексы всех листов для снимка или None, если сейчас снимок будет несогласованным."""
+        self.flush()
+        state = {
+            "clients": self.clients.dump(),
+            "txs": self.txs.dump(),
+            "tg_links": self.links.dump() if self.links is not None else None,
+        }
+        if state["clients"] is None or state["txs"] is None or (self.links is not None and state["tg_links"] is None):
+            return None
+        return state
+
+    def restore(self, state: dict):
+        self.clients.restore(state["clients"])
+        self.txs.restore(state["txs"])
+        if self.links is not None and state["tg_links"] is not None:
+            self.links.restore(state["tg_links"])
+
+    def close(self):
+        if self.keeper is not None:
+            self.keeper.close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class SqliteBackend(StorageBackend):
+    """Локальная SQLite-база. Запросы идут по индексам phone, user_id и (phone, ts).
+
+    mirror — необязательный SheetsBackend, куда дублируются все записи (таблица остаётся
+    актуальной для ручного просмотра); ошибки зеркала не мешают основной работе.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clients (
+            phone TEXT PRIMARY KEY,
+            name TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL DEFAULT '',
+            turnover REAL NOT NULL DEFAULT 0,
+            bonus_balance REAL NOT NULL DEFAULT 0,
+            level TEXT NOT NULL DEFAULT 'silver'
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT NOT NULL,
+            type TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            bonus_delta REAL NOT NULL DEFAULT 0,
+            ts TEXT NOT NULL,
+            comment TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS transactions_phone_ts ON transactions (phone, ts);
+        CREATE TABLE IF NOT EXISTS tg_links (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT '',
+            first_name TEXT NOT NULL DEFAULT '',
+            phone TEXT NOT NULL,
+            linked_at TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS tg_links_phone ON tg_links (phone);
+        CREATE TABLE IF NOT EXISTS pos_imports (
+            ref TEXT PRIMARY KEY,
+            phone TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            imported_at TEXT NOT NULL DEFAULT ''
+        );
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, mirror: SheetsBackend | None = None):
+        self.mirror = mirror
+        # соединение одно на процесс; запросы из пула потоков сериализуются self._lock
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.RLock()
+        with self._lock:
+            self.db.executescript(self.SCHEMA)
+
+    def _mirror(self, method: str, *args):
+        if self.mirror is None:
+            return
+        try:
+            getattr(self.mirror, method)(*args)
+        except Exception as e:
+            print(f"sheets mirror {method} error: {e}")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM clients LIMIT 1").fetchone() is None
+
+    def import_from_sheets(self, sheets: SheetsBackend):
+        """Первичная загрузка пустой базы из таблицы (один проход по каждому листу)."""
+        clients = sheets.clients.ws.get_all_records(numericise_ignore=[1])
+        txs = [r for title in sheets.txs.titles() for r in sheets.txs.ws_of(title).get_all_records()]
+        links = sheets.links.ws.get_all_records(numericise_ignore=[4]) if sheets.links is not None else []
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO clients VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (phone_key(r.get("phone", "")), r.get("name", ""), r.get("created_at", ""),
+                         float(r.get("turnover", 0) or 0), float(r.get("bonus_balance", 0) or 0),
+                         r.get("level", "") or "silver")
+                        for r in clients if phone_key(r.get("phone", ""))
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT INTO transactions (phone, type, amount, bonus_delta, ts, comment) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (phone_key(r.get("phone", "")), r.get("type", ""), float(r.get("amount", 0) or 0),
+                         float(r.get("bonus_delta", 0) or 0), str(r.get("ts", "")), r.get("comment", ""))
+                        for r in txs
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO tg_links VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (int(r["user_id"]), r.get("username", ""), r.get("first_name", ""),
+                         phone_key(r.get("phone", "")), r.get("linked_at", ""))
+                        for r in links if str(r.get("user_id", "")).strip().isdigit()
+                    ],
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        print(f"SQLite: imported {len(clients)} clients, {len(txs)} transactions, {len(links)} links from Sheets")
+
+    @staticmethod
+    def _phone_in(phone) -> tuple[str, list[str]]:
+        """Условие по телефону с учётом записей, сделанных до нормализации."""
+        variants = phone_variants(phone)
+        return f"phone IN ({', '.join('?' * len(variants))})", variants
+
+    def find_client(self, phone):
+        cond, params = self._phone_in(phone)
+        with self._lock:
+            row = self.db.execute(f"SELECT * FROM clients WHERE {cond}", params).fetchone()
+        return dict(row) if row else None
+
+    def upsert_client(self, phone, name=None):
+        phone = phone.strip()
+        with self._lock:
+            existing = self.find_client(phone)
+            if existing is None:
+                client = _new_client(phone, name)
+                self.db.execute(
+                    "INSERT INTO clients VALUES (?, ?, ?, ?, ?, ?)",
+                    [client[col] for col in CLIENT_COLUMNS],
+                )
+            else:
+                client = existing
+                new_name = name or existing.get("name", "")
+                if new_name != existing.get("name", ""):
+                    self.db.execute("UPDATE clients SET name = ? WHERE phone = ?", (new_name, existing["phone"]))
+                client["name"] = new_name
+        self._mirror("upsert_client", phone, name)
+        return client
+
+    def _update_client(self, client):
+        self.db.execute(
+            "UPDATE clients SET name = ?, created_at = ?, turnover = ?, bonus_balance = ?, level = ? "
+            "WHERE phone = ?",
+            (
+                client.get("name", ""),
+                client.get("created_at", ""),
+                float(client.get("turnover", 0) or 0),
+                float(client.get("bonus_balance", 0) or 0),
+                client.get("level", "silver"),
+                str(client.get("phone", "")).strip(),
+            ),
+        )
+
+    def _log_transaction(self, values):
+        self.db.execute(
+            "INSERT INTO transactions (phone, type, amount, bonus_delta, ts, comment) VALUES (?, ?, ?, ?, ?, ?)",
+            values,
+        )
+
+    def update_client(self, client):
+        with self._lock:
+            self._update_client(client)
+        self._mirror("update_client", client)
+
+    def log_transaction(self, values):
+        with self._lock:
+            self._log_transaction(values)
+        self._mirror("log_transaction", values)
+
+    def apply_operation(self, client, values):
+        # баланс и строка журнала — одной транзакцией: без строки журнала баланс не изменится
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self._update_client(client)
+                self._log_transaction(values)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        self._mirror("apply_operation", client, values)
+
+    def list_transactions(self, phone, limit, offset=0):
+        cond, params = self._phone_in(phone)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT phone, type, amount, bonus_delta, ts, comment FROM transactions "
+                f"WHERE {cond} ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def link_user(self, user, phone):
+        now = datetime.utcnow().isoformat(timespec="seconds")
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO tg_links VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, "
+                "first_name = excluded.first_name, phone = excluded.phone, linked_at = excluded.linked_at",
+                (user.id, user.username or "", user.first_name or "", phone.strip(), now),
+            )
+        self._mirror("link_user", user, phone)
+
+    def phone_by_user(self, user_id):
+        with self._lock:
+            row = self.db.execute("SELECT phone FROM tg_links WHERE user_id = ?", (int(user_id),)).fetchone()
+        return (row["phone"] or None) if row else None
+
+    def user_ids_by_phone(self, phone):
+        cond, params = self._phone_in(phone)
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT user_id FROM tg_links WHERE {cond} ORDER BY user_id", params
+            ).fetchall()
+        return [r["user_id"] for r in rows]
+
+    def linked_user_ids(self, after, limit):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT user_id FROM tg_links WHERE user_id > ? AND phone != '' ORDER BY user_id LIMIT ?",
+                (-1 if after is None else after, limit),
+            ).fetchall()
+        return [r["user_id"] for r in rows]
+
+    def count_linked_users(self, exclude=frozenset()):
+        exclude = list(exclude)
+        with self._lock:
+            total = self.db.execute("SELECT COUNT(*) FROM tg_links WHERE phone != ''").fetchone()[0]
+            for i in range(0, len(exclude), 500):  # лимит параметров SQLite
+                chunk = exclude[i:i + 500]
+                total -= self.db.execute(
+                    f"SELECT COUNT(*) FROM tg_links WHERE phone != '' AND user_id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchone()[0]
+        return total
+
+    def iter_clients(self):
+        with self._lock:
+            rows = self.db.execute("SELECT * FROM clients ORDER BY phone").fetchall()
+        return (dict(r) for r in rows)
+
+    def update_clients(self, clients):
+        params = [
+            (
+                c.get("name", ""), c.get("created_at", ""), float(c.get("turnover", 0) or 0),
+                float(c.get("bonus_balance", 0) or 0), c.get("level", "silver"), str(c.get("phone", "")).strip(),
+            )
+            for c in clients
+        ]
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "UPDATE clients SET name = ?, created_at = ?, turnover = ?, bonus_balance = ?, level = ? "
+                    "WHERE phone = ?",
+                    params,
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if self.mirror is not None:
+            self._mirror("update_clients", clients)
+
+    def update_levels(self, levels):
+        with self._lock:
+            changed = self.db.total_changes
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "UPDATE clients SET level = ? WHERE phone = ? AND turnover = ? AND level != ?",
+                    [(level, phone, turnover, level) for phone, (turnover, level) in levels.items()],
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            changed = self.db.total_changes - changed
+        self._mirror("update_levels", levels)
+        return changed
+
+    def known_import_refs(self):
+        with self._lock:
+            return {r[0] for r in self.db.execute("SELECT ref FROM pos_imports")}
+
+    def apply_import(self, new_clients, clients, tx_rows, refs):
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT INTO clients VALUES (?, ?, ?, ?, ?, ?)",
+                    [[c[col] for col in CLIENT_COLUMNS] for c in new_clients],
+                )
+                self.db.executemany(
+                    "UPDATE clients SET turnover = ?, bonus_balance = ?, level = ? WHERE phone = ?",
+                    [(c["turnover"], c["bonus_balance"], c["level"], c["phone"]) for c in clients],
+                )
+                self.db.executemany(
+                    "INSERT INTO transactions (phone, type, amount, bonus_delta, ts, comment) VALUES (?, ?, ?, ?, ?, ?)",
+                    tx_rows,
+                )
+                self.db.executemany("INSERT OR IGNORE INTO pos_imports VALUES (?, ?, ?, ?)", refs)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        self._mirror("apply_import", new_clients, clients, tx_rows, refs)
+
+    def merge_duplicate_phones(self, apply):
+        with self._lock:
+            clients = [dict(r) for r in self.db.execute("SELECT * FROM clients ORDER BY rowid")]
+            tx_phones = [r[0] for r in self.db.execute("SELECT DISTINCT phone FROM transactions")]
+            link_phones = [r[0] for r in self.db.execute("SELECT DISTINCT phone FROM tg_links WHERE phone != ''")]
+            groups: dict[str, list[dict]] = {}
+            for c in clients:
+                groups.setdefault(phone_key(c["phone"]), []).append(c)
+            changed = {key: rows for key, rows in groups.items() if len(rows) > 1 or rows[0]["phone"] != key}
+            tx_renames = [(phone_key(p), p) for p in tx_phones if phone_key(p) != p]
+            link_renames = [(phone_key(p), p) for p in link_phones if phone_key(p) != p]
+            report = {
+                "duplicates": [[r["phone"] for r in rows] for rows in changed.values() if len(rows) > 1],
+                "clients_fixed": len(changed),
+                "tx_fixed": 0,
+                "links_fixed": 0,
+            }
+            if not apply:
+                report["tx_fixed"] = sum(
+                    self.db.execute("SELECT COUNT(*) FROM transactions WHERE phone = ?", (p,)).fetchone()[0]
+                    for _, p in tx_renames
+                )
+                report["links_fixed"] = sum(
+                    self.db.execute("SELECT COUNT(*) FROM tg_links WHERE phone = ?", (p,)).fetchone()[0]
+                    for _, p in link_renames
+                )
+                return report
+
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "DELETE FROM clients WHERE phone = ?", [(r["phone"],) for rows in changed.values() for r in rows],
+                )
+                self.db.executemany(
+                    "INSERT INTO clients VALUES (?, ?, ?, ?, ?, ?)",
+                    [[merge_client_records(rows)[c] for c in CLIENT_COLUMNS] for rows in changed.values()],
+                )
+                report["tx_fixed"] = self.db.executemany(
+                    "UPDATE transactions SET phone = ? WHERE phone = ?", tx_renames,
+                ).rowcount
+                report["links_fixed"] = self.db.executemany(
+                    "UPDATE tg_links SET phone = ? WHERE phone = ?", link_renames,
+                ).rowcount
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        self._mirror("merge_duplicate_phones", apply)
+        return report
+
+    def transaction_page(self, cursor, size):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, phone, type, amount, bonus_delta, ts, comment FROM transactions "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (cursor or 0, size),
+            ).fetchall()
+        if not rows:
+            return [], cursor
+        return [dict(r) for r in rows], rows[-1]["id"]  # курсор — id последней строки
+
+    def flush(self):
+        if self.mirror is not None:
+            self.mirror.flush()
+
+    def close(self):
+        if self.mirror is not None:
+            self.mirror.close()
+        with self._lock:
+            self.db.close()
+
+
+# === СНИМОК ДЛЯ ТЁПЛОГО СТАРТА ===
+# После рестарта индексы SheetsBackend поднимаются из файла на диске, а не из полных выгрузок листов:
+# первые запросы обслуживаются из памяти, авторизация и дочитывание хвостов идут в фоне.
+
+SNAPSHOT_VERSION = 3
+
+
+class LazyWorksheet:
+    """Лист, который открывается (init_gs) при первом обращении к API.
+
+    Пока индексы подняты из снимка, для чтения лист не нужен; первым запросом его откроет
+    либо фоновое дочитывание, либо первая запись.
+    """
+
+    _open_lock = threading.Lock()
+
+    def __init__(self, title: str, opener=None):
+        self.title = title
+        self.opener = opener  # для листов, которых нет среди глобальных (месяцы transactions)
+        self._ws = None
+
+    def __getattr__(self, name):
+        if self._ws is None:
+            with self._open_lock:
+                if self._ws is None:
+                    self._ws = self._open()
+            if self._ws is None:
+                raise RuntimeError(f"worksheet {self.title} is not available")
+        return getattr(self._ws, name)
+
+    def _open(self):
+        if self.opener is not None:
+            return self.opener(self.title)
+        init_gs()
+        return {
+            "clients": CLIENTS_WS,
+            "transactions": TX_WS,
+            "tg_links": TG_LINKS_WS,
+            TX_PARTITIONS_TITLE: TX_PARTITIONS_WS,
+        }[self.title]
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> dict | None:
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"snapshot load error: {e}")
+        return None
+    if state.get("version") != SNAPSHOT_VERSION or state.get("sheet_id") != GSSHEETID:
+        return None  # другой формат или другая таблица
+    return state
+
+
+class SnapshotKeeper:
+    """Раз в interval секунд сохраняет снимок индексов backend (и при остановке).
+
+    Формат — pickle: словари загружаются одним вызовом на C без разбора текста.
+    Снимок пишется только когда отложенных записей нет, иначе он разошёлся бы с листом.
+    """
+
+    def __init__(self, backend: "SheetsBackend", path: str = SNAPSHOT_PATH, interval: int = SNAPSHOT_INTERVAL):
+        self.backend = backend
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, restored_at: float | None = None):
+        self._thread = threading.Thread(target=self._run, args=(restored_at,), name="snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    @sheets_priority(PRIORITY_BACKGROUND)
+    def refresh(self, saved_at: float):
+        """Догнать лист после тёплого старта: хвосты всех листов или, если снимок
+        старше GS_CACHE_TTL, полная перезагрузка clients / tg_links."""
+        b = self.backend
+        stale = time.time() - saved_at > GS_CACHE_TTL
+        try:
+            for store in (b.clients, b.links):
+                if store is not None:
+                    store.load() if stale else store.load_tail()
+            b.txs.sync()
+        except Exception as e:
+            print(f"snapshot refresh error: {e}")
+
+    def save(self) -> bool:
+        try:
+            state = self.backend.dump()
+            if state is None:
+                return False
+            state.update(version=SNAPSHOT_VERSION, sheet_id=GSSHEETID, saved_at=time.time())
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+            return True
+        except Exception as e:
+            print(f"snapshot save error: {e}")
+            return False
+
+    def _run(self, restored_at):
+        if restored_at is not None:
+            self.refresh(restored_at)
+        while not self._stop.wait(self.interval):
+            self.save()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.save()
+
+
+def init_storage():
+    """Поднять BACKEND по STORAGE_BACKEND (вызывать перед операциями)."""
+    global BACKEND
+    if BACKEND is not None:
+        return
+    with _INIT_LOCK:
+        if BACKEND is None:
+            BACKEND = _create_backend()
+
+
+def _create_backend() -> StorageBackend | None:
+    if STORAGE_BACKEND == "sqlite":
+        mirror = None
+        if SQLITE_MIRROR_SHEETS:
+            init_gs()
+            if CLIENTS_WS is not None:
+                mirror = SheetsBackend(CLIENTS_WS, TX_WS, TG_LINKS_WS, TX_PARTITIONS_WS)
+        backend = SqliteBackend(SQLITE_PATH, mirror=mirror)
+        if mirror is not None and backend.is_empty():
+            backend.import_from_sheets(mirror)
+        print(f"SQLite storage initialized ({SQLITE_PATH})")
+        return backend
+
+    state = load_snapshot(SNAPSHOT_PATH) if SNAPSHOT_INTERVAL > 0 else None
+    if state is not None:
+        backend = SheetsBackend(
+            LazyWorksheet("clients"),
+            LazyWorksheet("transactions"),
+            LazyWorksheet("tg_links") if state["tg_links"] is not None else None,
+            LazyWorksheet(TX_PARTITIONS_TITLE),
+        )
+        backend.restore(state)
+        print(f"Warm start from snapshot ({len(state['clients']['index'])} clients, "
+              f"{time.time() - state['saved_at']:.0f}s old)")
+    else:
+        init_gs()
+        if CLIENTS_WS is None:
+            return None
+        backend = SheetsBackend(CLIENTS_WS, TX_WS, TG_LINKS_WS, TX_PARTITIONS_WS)
+    if SNAPSHOT_INTERVAL > 0:
+        backend.keeper = SnapshotKeeper(backend, SNAPSHOT_PATH, SNAPSHOT_INTERVAL).start(state["saved_at"] if state is not None else None)
+    return backend
+
+
 def find_client_by_phone(phone: str):
-    """Поиск клиента в листе clients по телефону."""
-    if CLIENTS_WS is None:
+    """Поиск клиента по телефону."""
+    if BACKEND is None:
         return None
-    records = CLIENTS_WS.get_all_records()
-    for r in records:
-        if str(r.get("phone", "")).strip() == phone.strip():
-            return r
-    return None
+    return BACKEND.find_client(phone_key(phone))
 
 def get_phone_by_user_id(user_id: int) -> str | None:
-    """Возвращает телефон, привязанный к Telegram user_id, из листа tg_links."""
-    if TG_LINKS_WS is None:
+    """Возвращает телефон, привязанный к Telegram user_id."""
+    if BACKEND is None:
         return None
     try:
-        records = TG_LINKS_WS.get_all_records()
-        for r in records:
-            uid = str(r.get("user_id", "")).strip()
-            if uid == str(user_id):
-                phone = str(r.get("phone", "")).strip()
-                return phone or None
+        return BACKEND.phone_by_user(user_id)
     except Exception as e:
         print(f"get_phone_by_user_id error: {e}")
     return None
 
 def get_user_ids_by_phone(phone: str) -> list[int]:
     """Ищет всех Telegram user_id, привязанных к данному телефону."""
-    if TG_LINKS_WS is None:
+    if BACKEND is None:
         return []
     try:
-        records = TG_LINKS_WS.get_all_records()
-        res = []
-        for r in records:
-            if str(r.get("phone", "")).strip() == phone.strip():
-                uid_str = str(r.get("user_id", "")).strip()
-                if uid_str.isdigit():
-                    res.append(int(uid_str))
-        return res
+        return BACKEND.user_ids_by_phone(phone_key(phone))
     except Exception as e:
         print(f"get_user_ids_by_phone error: {e}")
         return []
 
+def linked_user_ids(after: int | None, limit: int) -> list[int]:
+    """Порция привязанных user_id после курсора after."""
+    if BACKEND is None:
+        return []
+    return BACKEND.linked_user_ids(after, limit)
+
+def count_linked_users(exclude=frozenset()) -> int:
+    """Привязанные пользователи без exclude (например, заблокировавших бота)."""
+    if BACKEND is None:
+        return 0
+    return BACKEND.count_linked_users(exclude)
+
 def link_user_to_phone(user, phone: str):
-    """Создаёт или обновляет связь user_id <-> phone в листе tg_links."""
-    if TG_LINKS_WS is None:
+    """Создаёт или обновляет связь user_id <-> phone."""
+    if BACKEND is None:
         return
     try:
-        records = TG_LINKS_WS.get_all_records()
-        user_id_str = str(user.id)
-        row_index = None
-        for idx, r in enumerate(records, start=2):
-            if str(r.get("user_id", "")).strip() == user_id_str:
-                row_index = idx
-                break
-
-        now = datetime.utcnow().isoformat(timespec="seconds")
-        row_values = [
-            user_id_str,
-            user.username or "",
-            user.first_name or "",
-            phone,
-            now,
-        ]
-
-        if row_index is None:
-            TG_LINKS_WS.append_row(row_values, value_input_option="RAW")
-        else:
-            TG_LINKS_WS.update(f"A{row_index}:E{row_index}", [row_values])
+        BACKEND.link_user(user, phone_key(phone))
     except Exception as e:
         print(f"link_user_to_phone error: {e}")
 
-
 def upsert_client(phone: str, name: str | None = None):
     """Создать или обновить клиента (имя можно обновлять)."""
-    if CLIENTS_WS is None:
+    if BACKEND is None:
         return None
-
-    records = CLIENTS_WS.get_all_records()
-    row_idx = None
-    for idx, r in enumerate(records, start=2):  # 1 строка — заголовок
-        if str(r.get("phone", "")).strip() == phone.strip():
-            row_idx = idx
-            break
-
-    now = datetime.utcnow().isoformat(timespec="seconds")
-
-    if row_idx is None:
-        # новый клиент
-        row = [
-            phone,
-            name or "",
-            now,
-            0,          # turnover
-            0,          # bonus_balance
-            "silver",     # level
-        ]
-        CLIENTS_WS.append_row(row, value_input_option="RAW")
-        return {
-            "phone": phone,
-            "name": name or "",
-            "created_at": now,
-            "turnover": 0,
-            "bonus_balance": 0,
-            "level": "silver",
-        }
-    else:
-        # обновляем имя, если есть
-        existing = records[row_idx - 2]
-        new_name = name or existing.get("name", "")
-        # обновление только имени (чтобы не трогать оборот/бонусы)
-        CLIENTS_WS.update_cell(row_idx, 2, new_name)
-        existing["name"] = new_name
-        return existing
+    client = BACKEND.upsert_client(phone_key(phone), name)
+    if client:
+        STATS.on_client(client)
+    return client
 
 def update_client_row(client_dict):
-    """Полностью обновить строку клиента по phone."""
-    if CLIENTS_WS is None:
+    """Полностью обновить запись клиента по phone."""
+    if BACKEND is None:
         return
     phone = str(client_dict.get("phone", "")).strip()
     if not phone:
         return
-    records = CLIENTS_WS.get_all_records()
-    for idx, r in enumerate(records, start=2):  # строка в Sheets = idx
-        if str(r.get("phone", "")).strip() == phone:
-            # обновляем диапазон A:F в найденной строке
-            CLIENTS_WS.update(
-                f"A{idx}:F{idx}",
-                [[
-                    phone,
-                    client_dict.get("name", ""),
-                    client_dict.get("created_at", ""),
-                    client_dict.get("turnover", 0),
-                    client_dict.get("bonus_balance", 0),
-                    client_dict.get("level", "silver"),
-                ]],
+    BACKEND.update_client(client_dict)
+    STATS.on_client(client_dict)
+
+def log_transaction(phone: str, tx_type: str, amount: float, bonus_delta: float, comment: str = ""):
+    """Запись транзакции."""
+    if BACKEND is None:
+        return
+    ts = datetime.utcnow().isoformat(timespec="seconds")
+    row = [phone_key(phone), tx_type, amount, bonus_delta, ts, comment]
+    BACKEND.log_transaction(row)
+    STATS.on_transaction(row)
+
+def record_operation(phone: str, client: dict, tx_type: str, amount: float, bonus_delta: float, comment: str = ""):
+    """Новое состояние клиента и строка журнала по операции одной записью хранилища
+    (на SQLite — одной транзакцией)."""
+    if BACKEND is None:
+        return
+    ts = datetime.utcnow().isoformat(timespec="seconds")
+    row = [phone_key(phone), tx_type, amount, bonus_delta, ts, comment]
+    BACKEND.apply_operation(client, row)
+    STATS.on_client(client)
+    STATS.on_transaction(row)
+
+def flush_writes():
+    """Сбросить всё, что ждёт отложенной записи."""
+    if BACKEND is not None:
+        BACKEND.flush()
+
+def get_transactions_for_phone(phone: str, limit: int = 10, offset: int = 0) -> list[dict]:
+    """Возвращает операции по телефону, новые первыми (offset — сколько самых новых пропустить)."""
+    if BACKEND is None:
+        return []
+    return BACKEND.list_transactions(phone_key(phone), limit, offset)
+
+
+# === ЛОГИКА УРОВНЕЙ И БОНУСОВ ===
+
+# Уровни программы по возрастанию порога оборота: процент начисления, доля покупки,
+# которую можно оплатить бонусами, и тексты для кабинета. Новый уровень — новая строка здесь.
+LEVELS = [
+    {
+        "level": "silver", "threshold": 0, "rate": 0.05, "redeem_cap": 0.10,
+        "title": "Серебро 💎", "upper": "СЕРЕБРО",
+        "pitch": "С каждого заказа Вы получаете {rate:.0%} в виде бонусов.",
+    },
+    {
+        "level": "gold", "threshold": 10000, "rate": 0.07, "redeem_cap": 0.20,
+        "title": "Золото ⭐️", "upper": "ЗОЛОТО",
+        "pitch": "Вы уже в числе наших любимых клиентов: {rate:.0%} от каждой покупки возвращаются на бонусный счёт.",
+    },
+    {
+        "level": "platinum", "threshold": 30000, "rate": 0.10, "redeem_cap": 0.30,
+        "title": "Платинум ✨", "upper": "ПЛАТИНУМ",
+        "pitch": "Вы — VIP гость нашего фото-ателье: {rate:.0%} от каждой покупки возвращаются к Вам в виде бонусов.",
+    },
+]
+LEVEL_THRESHOLDS = [t["threshold"] for t in LEVELS]
+LEVELS_BY_NAME = {t["level"]: t for t in LEVELS}
+
+
+def level_tier(turnover: float) -> dict:
+    """Строка LEVELS, в которую попадает оборот."""
+    return LEVELS[max(0, bisect.bisect_right(LEVEL_THRESHOLDS, turnover) - 1)]
+
+def calc_level_and_rate(turnover: float) -> tuple[str, float]:
+    """Возвращает (уровень, процент_начисления_бонусов)."""
+    tier = level_tier(turnover)
+    return tier["level"], tier["rate"]
+
+def client_level(client) -> str:
+    """Уровень по текущему обороту клиента (в листе он может отставать до пересчёта recompute_levels)."""
+    return calc_level_and_rate(float(client.get("turnover", 0) or 0))[0]
+
+def describe_level(level: str) -> str:
+    """Описание уровня для клиента (мотивационный текст)."""
+    tier = LEVELS_BY_NAME.get(level, LEVELS[0])
+    return (
+        f"Ваш уровень: {tier['title']}\n"
+        f"{tier['pitch'].format(rate=tier['rate'])}\n"
+        f"Бонусами можно оплатить до {tier['redeem_cap']:.0%} суммы следующей покупки."
+    )
+
+
+def format_client_cabinet(client, phone: str) -> str:
+    """Текст личного кабинета для клиента."""
+    name = client.get("name") or "Клиент"
+    turnover = float(client.get("turnover", 0) or 0)
+    bonus = float(client.get("bonus_balance", 0) or 0)
+    tier = level_tier(turnover)
+
+    lvl_text = describe_level(tier["level"])
+
+    # сколько до следующего уровня
+    i = LEVELS.index(tier)
+    if i == len(LEVELS) - 1:
+        next_level_line = f"Вы уже на максимальном уровне программы лояльности - {tier['upper']}."
+    else:
+        nxt = LEVELS[i + 1]
+        need = max(0, nxt["threshold"] - turnover)
+        next_level_line = f"Следующий уровень — {nxt['upper']} (осталось потратить {need:.0f} рублей)."
+
+    text = (
+        f"{name}, добро пожаловать в ваш личный кабинет программы лояльности 📸\n\n"
+        f"Телефон: {phone}\n"
+        f"Всего покупок на сумму: {turnover:.0f}₽\n"
+        f"Бонусный счёт: {bonus:.0f} бонусов\n\n"
+        f"{lvl_text}\n"
+        f"{next_level_line}\n\n"
+        "Каждая печать фото, ксерокс, скан или другая услуга в ателье — это ещё один шаг к новым бонусам.\n"
+        "Вы можете копить их и списывать частично за услуги 😉"
+    )
+    return text
+
+def get_cabinet_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton("📜 История", callback_data="history")],
+        [InlineKeyboardButton("📸 Перейти в канал", url="https://t.me/photo_himki_life")],
+        [InlineKeyboardButton("📂 Отправить файл", callback_data="send_file")],
+        [InlineKeyboardButton("💬 Оставить отзыв — +100 бонусов", callback_data="leave_review")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_client_reply_keyboard() -> ReplyKeyboardMarkup:
+    buttons = [[KeyboardButton("Личный кабинет")]]
+    return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+
+# Страница истории: клиенту по 10 операций, админу по 20
+HISTORY_PAGE_SIZE = 10
+ADMIN_HISTORY_PAGE_SIZE = 20
+
+def format_tx_line(r: dict) -> str:
+    ts_raw = r.get("ts", "")
+    try:
+        dt_utc = datetime.fromisoformat(ts_raw)
+        dt_msk = dt_utc + timedelta(hours=3)
+        ts_str = dt_msk.strftime("🗓%Y-%m-%d 🕟 %H:%M:%S")
+    except Exception:
+        ts_str = ts_raw
+
+    tx_type = r.get("type", "")
+    amount = float(r.get("amount", 0) or 0)
+    bonus_delta = float(r.get("bonus_delta", 0) or 0)
+
+    if tx_type == "purchase":
+        return (
+            f"{ts_str}: Покупка на {amount:.0f}₽, "
+            f"начислено бонусов: {bonus_delta:.0f}."
+        )
+    if tx_type == "redeem":
+        return f"{ts_str}: Списание бонусов: {abs(bonus_delta):.0f}."
+    if tx_type == "promo_review":
+        return f"{ts_str}: Отзыв, бонусы: {bonus_delta:.0f}."
+    if tx_type == "bonus_expire":
+        return f"{ts_str}: Сгорели бонусы: {abs(bonus_delta):.0f}."
+    return f"{ts_str}: {tx_type}, сумма {amount:.0f}, бонусы {bonus_delta:.0f}."
+
+def format_history(title: str, txs: list[dict]) -> str:
+    return "\n".join([title] + [format_tx_line(r) for r in txs])
+
+def get_history_keyboard(prefix: str, offset: int, page_size: int, has_more: bool) -> InlineKeyboardMarkup | None:
+    """Кнопки листания; callback_data — "<prefix>:<offset>"."""
+    row = []
+    if has_more:
+        row.append(InlineKeyboardButton("◀ Раньше", callback_data=f"{prefix}:{offset + page_size}"))
+    if offset > 0:
+        row.append(InlineKeyboardButton("Позже ▶", callback_data=f"{prefix}:{max(0, offset - page_size)}"))
+    return InlineKeyboardMarkup([row]) if row else None
+
+# === ОПЕРАЦИИ С ДАННЫМИ ===
+# Синхронные сценарии целиком (поиск клиента, пересчёт, запись, список уведомляемых) —
+# хендлеры выполняют каждый за один переход в пул потоков через STORAGE.run().
+
+class StripedLocks:
+    """Блокировки по ключу на фиксированном наборе полос: операции с одним телефоном идут
+    строго по очереди, с разными — параллельно (кроме редких совпадений полосы)."""
+
+    def __init__(self, stripes: int = PHONE_LOCK_STRIPES):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def hold(self, key: str) -> threading.RLock:
+        return self._locks[hash(phone_key(key)) % len(self._locks)]
+
+    @contextlib.contextmanager
+    def hold_many(self, keys):
+        """Держать блокировки всех перечисленных телефонов (полосы берутся по порядку — без дедлоков)."""
+        stripes = sorted({hash(phone_key(k)) % len(self._locks) for k in keys})
+        for i in stripes:
+            self._locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self._locks[i].release()
+
+    @contextlib.contextmanager
+    def hold_all(self):
+        """Остановить все операции с клиентами (для пакетных исправлений)."""
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+
+PHONE_LOCKS = StripedLocks()
+
+
+def with_phone_lock(fn):
+    """Выполнить чтение-изменение-запись клиента под блокировкой его телефона (первый аргумент)."""
+    @functools.wraps(fn)
+    def wrapper(phone, *args, **kwargs):
+        with PHONE_LOCKS.hold(phone):
+            return fn(phone, *args, **kwargs)
+    return wrapper
+
+
+def load_cabinet_by_user(user_id: int, name: str):
+    """(phone, client) для привязанного пользователя или None, если привязки нет."""
+    init_storage()
+    linked_phone = get_phone_by_user_id(user_id)
+    if not linked_phone:
+        return None
+    client = find_client_by_phone(linked_phone)
+    if not client:
+        client = upsert_client(linked_phone, name)
+    return linked_phone, client
+
+def load_cabinet_by_phone(user, phone: str):
+    """Найти/создать клиента по введённому телефону и привязать к нему user_id."""
+    init_storage()
+    client = find_client_by_phone(phone)
+    if not client:
+        client = upsert_client(phone, user.full_name or "")
+    link_user_to_phone(user, phone)
+    return client
+
+@sheets_priority(PRIORITY_ADMIN)
+def load_client_for_admin(phone: str):
+    """Профиль клиента для админа (создаётся, если телефона ещё нет)."""
+    init_storage()
+    client = find_client_by_phone(phone)
+    if not client:
+        client = upsert_client(phone, "")
+    return client
+
+def load_history(phone: str, limit: int, offset: int = 0) -> list[dict]:
+    init_storage()
+    return get_transactions_for_phone(phone, limit=limit, offset=offset)
+
+def op_comment(comment: str, op_id: str | None) -> str:
+    """Комментарий операции с ключом идемпотентности: по нему find_operation узнаёт повтор."""
+    return f"{comment} [op:{op_id}]" if op_id else comment
+
+def find_operation(phone: str, op_id: str | None) -> dict | None:
+    """Операция с этим ключом среди последних IDEMPOTENCY_LOOKBACK операций клиента.
+    Повторы приходят в пределах минут, так что хватает свежих операций. На Sheets смотрим только
+    кольцо в памяти (текущий месяц и уже поднятый предыдущий): закрытые листы не читаются,
+    запрос бывает лишь при плановом дочитывании хвоста горячего листа (TX_SYNC_INTERVAL)."""
+    if not op_id or BACKEND is None:
+        return None
+    marker = f"[op:{op_id}]"
+    for tx in BACKEND.recent_operations(phone_key(phone), IDEMPOTENCY_LOOKBACK):
+        if str(tx.get("comment", "")).endswith(marker):
+            return tx
+    return None
+
+@sheets_priority(PRIORITY_ADMIN)
+@with_phone_lock
+def apply_purchase(phone: str, amount: float, op_id: str | None = None):
+    """Провести покупку. None — клиент не найден; duplicate=True — операция с op_id уже проведена."""
+    init_storage()
+    client = find_client_by_phone(phone)
+    if not client:
+        return None
+
+    done = find_operation(phone, op_id)
+    if done is not None:
+        return {
+            "duplicate": True,
+            "bonus_delta": _num(done.get("bonus_delta")),
+            "new_balance": _num(client.get("bonus_balance")),
+            "level": client_level(client),
+            "user_ids": [],
+        }
+
+    turnover = float(client.get("turnover", 0) or 0)
+    bonus_balance = float(client.get("bonus_balance", 0) or 0)
+
+    new_turnover = turnover + amount
+    level, rate = calc_level_and_rate(new_turnover)
+    bonus_delta = round(amount * rate)
+    new_bonus_balance = bonus_balance + bonus_delta
+
+    client["turnover"] = new_turnover
+    client["bonus_balance"] = new_bonus_balance
+    client["level"] = level
+    record_operation(phone, client, "purchase", amount, bonus_delta, op_comment("Покупка в ателье", op_id))
+    return {
+        "duplicate": False,
+        "bonus_delta": bonus_delta,
+        "new_balance": new_bonus_balance,
+        "level": level,
+        "user_ids": get_user_ids_by_phone(phone),
+    }
+
+@sheets_priority(PRIORITY_ADMIN)
+@with_phone_lock
+def apply_redeem(phone: str, redeem: float, op_id: str | None = None):
+    """Списать бонусы. None — клиент не найден; ok=False — не хватает бонусов;
+    duplicate=True — операция с op_id уже проведена."""
+    init_storage()
+    client = find_client_by_phone(phone)
+    if not client:
+        return None
+
+    bonus_balance = float(client.get("bonus_balance", 0) or 0)
+    if find_operation(phone, op_id) is not None:
+        return {"ok": True, "duplicate": True, "new_balance": bonus_balance, "user_ids": []}
+    if redeem > bonus_balance:
+        return {"ok": False, "balance": bonus_balance}
+
+    new_balance = bonus_balance - redeem
+    client["bonus_balance"] = new_balance
+    record_operation(phone, client, "redeem", 0, -redeem, op_comment("Списание бонусов", op_id))
+    return {
+        "ok": True,
+        "duplicate": False,
+        "new_balance": new_balance,
+        "user_ids": get_user_ids_by_phone(phone),
+    }
+
+@sheets_priority(PRIORITY_ADMIN)
+@with_phone_lock
+def apply_review_bonus(phone: str, bonus_delta: float = 100.0, op_id: str | None = None):
+    """Начислить бонус за отзыв. None — клиент не найден; duplicate=True — операция с op_id уже проведена."""
+    init_storage()
+    client = find_client_by_phone(phone)
+    if not client:
+        return None
+
+    bonus_balance = float(client.get("bonus_balance", 0) or 0)
+    done = find_operation(phone, op_id)
+    if done is not None:
+        return {"duplicate": True, "bonus_delta": _num(done.get("bonus_delta")), "new_balance": bonus_balance, "user_ids": []}
+    new_balance = bonus_balance + bonus_delta
+
+    client["bonus_balance"] = new_balance
+    # логируем как отдельный тип операции
+    record_operation(
+        phone, client, "promo_review", 0, bonus_delta, op_comment("Бонус за отзыв на Яндекс.Картах", op_id),
+    )
+    return {
+        "duplicate": False,
+        "bonus_delta": bonus_delta,
+        "new_balance": new_balance,
+        "user_ids": get_user_ids_by_phone(phone),
+    }
+
+@sheets_priority(PRIORITY_BACKGROUND)
+def recompute_levels() -> int:
+    """Пересчитать уровни всех клиентов по LEVELS за один проход и записать только изменившиеся
+    (на Sheets — ячейки F одним batch_update). Кабинет и профиль для админа уровень больше не пишут:
+    показывают посчитанный по обороту, а в таблицу он попадает здесь. Возвращает число изменённых."""
+    init_storage()
+    # без блокировок телефонов: покупка, прошедшая посреди прохода, меняет оборот, и update_levels
+    # такого клиента пропустит — уровень по новому обороту она записала сама
+    changed = {}
+    for c in BACKEND.iter_clients():
+        turnover = _num(c.get("turnover"))
+        level = level_tier(turnover)["level"]
+        if c.get("level") != level:
+            changed[c["phone"]] = (turnover, level)
+    return BACKEND.update_levels(changed) if changed else 0
+
+
+class AsyncStorage:
+    """Асинхронный фасад над синхронным gspread: вызовы идут в ограниченный пул потоков,
+    event loop PTB в это время обслуживает остальные апдейты.
+
+    По таймауту ожидание отменяется; если задача ещё стояла в очереди пула, она не запустится.
+    """
+
+    def __init__(self, max_workers: int = GS_POOL_SIZE, timeout: float = GS_TIMEOUT):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gs")
+
+    async def run(self, fn, *args, timeout: float | None = None, **kwargs):
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        return await asyncio.wait_for(fut, timeout or self.timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+STORAGE = AsyncStorage()
+
+
+# === УВЕДОМЛЕНИЯ ===
+
+METRICS.describe("loyalty_notify_queue_depth", "gauge", "Notifications waiting to be sent")
+METRICS.describe("loyalty_notify_total", "counter", "Notifications by outcome")
+
+NOTIFY_OK = "ok"
+NOTIFY_BLOCKED = "blocked"  # пользователь заблокировал бота / удалён
+NOTIFY_FAILED = "failed"
+
+
+class NotificationDispatcher:
+    """Фоновая очередь сообщений клиентам: хендлер кладёт сообщение и сразу отвечает админу,
+    а воркеры отправляют параллельно в пределах лимитов Telegram.
+
+    Общий лимит — NOTIFY_GLOBAL_RATE сообщений в секунду, в один чат — не чаще NOTIFY_CHAT_INTERVAL.
+    RetryAfter придерживает всю отправку на retry_after, сетевые ошибки повторяются с паузой.
+    """
+
+    def __init__(self, workers: int = NOTIFY_WORKERS, global_rate: float = NOTIFY_GLOBAL_RATE,
+                 chat_interval: float = NOTIFY_CHAT_INTERVAL, max_retries: int = NOTIFY_MAX_RETRIES):
+        self.workers = workers
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.bot = None
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._global_next = 0.0
+        self._chat_next: dict[int, float] = {}
+
+    async def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Дождаться отправки того, что уже в очереди (не дольше timeout), и остановить воркеров."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"notify: {self._queue.qsize()} messages dropped on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, chat_id: int, text: str, tag: str = "notify", **kwargs) -> asyncio.Future:
+        """Поставить сообщение в очередь. Future завершится NOTIFY_OK / NOTIFY_BLOCKED / NOTIFY_FAILED."""
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, text, tag, kwargs, fut))
+        METRICS.set("loyalty_notify_queue_depth", None, self._queue.qsize())
+        return fut
+
+    def notify_many(self, chat_ids: list[int], text: str, tag: str = "notify") -> list[asyncio.Future]:
+        return [self.enqueue(chat_id, text, tag) for chat_id in chat_ids]
+
+    async def _wait_turn(self, chat_id: int):
+        """Занять ближайший слот с учётом общего лимита и лимита чата."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._global_next, self._chat_next.get(chat_id, 0.0))
+        self._global_next = max(self._global_next, slot) + self.global_interval
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if len(self._chat_next) > 10000:  # не копим чаты, у которых слот давно прошёл
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, chat_id: int, text: str, tag: str, kwargs: dict) -> str:
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return NOTIFY_OK
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                print(f"{tag}: flood control, retry after {delay:.0f}s")
+                self._global_next = max(self._global_next, asyncio.get_running_loop().time() + delay)
+            except Forbidden as e:
+                print(f"{tag} error to {chat_id}: {e}")
+                return NOTIFY_BLOCKED
+            except BadRequest as e:
+                if "chat not found" in str(e).lower() or "deactivated" in str(e).lower():
+                    print(f"{tag} error to {chat_id}: {e}")
+                    return NOTIFY_BLOCKED
+                print(f"{tag} error to {chat_id}: {e}")
+                return NOTIFY_FAILED
+            except NetworkError as e:  # в т.ч. TimedOut
+                print(f"{tag} error to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
+            except TelegramError as e:
+                print(f"{tag} error to {chat_id}: {e}")
+                return NOTIFY_FAILED
+        return NOTIFY_FAILED
+
+    async def _worker(self):
+        while True:
+            chat_id, text, tag, kwargs, fut = await self._queue.get()
+            try:
+                result = await self._send(chat_id, text, tag, kwargs)
+            except Exception as e:
+                print(f"{tag} error to {chat_id}: {e}")
+                result = NOTIFY_FAILED
+            finally:
+                self._queue.task_done()
+                METRICS.set("loyalty_notify_queue_depth", None, self._queue.qsize())
+            METRICS.inc("loyalty_notify_total", {"tag": tag, "result": result})
+            if not fut.done():
+                fut.set_result(result)
+
+
+NOTIFIER = NotificationDispatcher()
+
+
+# === РАССЫЛКИ ===
+
+def _read_json(path: str, default):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"read {path} error: {e}")
+        return default
+
+
+def _write_json(path: str, data):
+    """Атомарная запись: временный файл + os.replace, чтобы рестарт не оставил половину JSON."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class Broadcaster:
+    """Рассылка всем привязанным клиентам.
+
+    Получатели читаются из tg_links порциями по BROADCAST_BATCH в порядке user_id, отправка идёт
+    через NOTIFIER (его лимиты Telegram). После каждой порции курсор и счётчики сохраняются
+    в BROADCAST_STATE_PATH — после рестарта рассылка продолжается с курсора; повторно может уйти
+    не больше одной порции, прерванной на середине. Заблокировавшие бота попадают
+    в BROADCAST_BLOCKED_PATH и пропускаются в следующих рассылках.
+    """
+
+    def __init__(self, state_path: str = BROADCAST_STATE_PATH, blocked_path: str = BROADCAST_BLOCKED_PATH,
+                 batch: int = BROADCAST_BATCH):
+        self.state_path = state_path
+        self.blocked_path = blocked_path
+        self.batch = batch
+        self.state = _read_json(state_path, None)
+        self.blocked = set(_read_json(blocked_path, []))
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _save(self):
+        _write_json(self.state_path, self.state)
+
+    async def start(self, bot, text: str, chat_id: int, message_id: int):
+        self.state = {
+            "id": datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+            "text": text,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "cursor": None,
+            "total": await STORAGE.run(count_linked_users, frozenset(self.blocked)),
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "skipped": 0,
+            "status": "running",
+        }
+        await STORAGE.run(self._save)
+        self._task = asyncio.create_task(self._run(bot))
+
+    def resume(self, bot):
+        """Продолжить незавершённую рассылку после рестарта."""
+        if self.state and self.state.get("status") == "running" and not self.running:
+            print(f"broadcast {self.state['id']}: resuming after user_id {self.state['cursor']}")
+            self._task = asyncio.create_task(self._run(bot))
+
+    def unblock(self, user_id: int):
+        """Пользователь снова пишет боту — значит, разблокировал его."""
+        if user_id in self.blocked:
+            self.blocked.discard(user_id)
+            _write_json(self.blocked_path, sorted(self.blocked))
+
+    def cancel(self):
+        if self.state and self.state.get("status") == "running":
+            self.state["status"] = "cancelled"
+
+    def progress_text(self) -> str:
+        st = self.state
+        titles = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}
+        # заблокировавшие раньше (skipped) в total не входят
+        done = st["sent"] + st["failed"] + st["blocked"]
+        return (
+            f"📣 Рассылка {titles.get(st['status'], st['status'])}: {done} из {st['total']}\n"
+            f"✅ Доставлено: {st['sent']}\n"
+            f"⚠️ Ошибок: {st['failed']}\n"
+            f"🚫 Заблокировали бота: {st['blocked']} (пропущено заблокировавших раньше: {st['skipped']})"
+        )
+
+    async def _report(self, bot):
+        st = self.state
+        markup = None
+        if st["status"] == "running":
+            markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить", callback_data="broadcast_stop")]])
+        try:
+            await bot.edit_message_text(
+                self.progress_text(), chat_id=st["chat_id"], message_id=st["message_id"], reply_markup=markup,
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                print(f"broadcast progress error: {e}")
+        except TelegramError as e:
+            print(f"broadcast progress error: {e}")
+
+    async def _run(self, bot):
+        st = self.state
+        try:
+            while st["status"] == "running":
+                user_ids = await STORAGE.run(linked_user_ids, st["cursor"], self.batch)
+                if not user_ids:
+                    st["status"] = "done"
+                    break
+                targets = [uid for uid in user_ids if uid not in self.blocked]
+                st["skipped"] += len(user_ids) - len(targets)
+                results = await asyncio.gather(*(
+                    NOTIFIER.enqueue(uid, st["text"], tag="broadcast") for uid in targets
+                ))
+                newly_blocked = False
+                for uid, result in zip(targets, results):
+                    if result == NOTIFY_OK:
+                        st["sent"] += 1
+                    elif result == NOTIFY_BLOCKED:
+                        st["blocked"] += 1
+                        self.blocked.add(uid)
+                        newly_blocked = True
+                    else:
+                        st["failed"] += 1
+                st["cursor"] = user_ids[-1]
+                await STORAGE.run(self._save)
+                if newly_blocked:
+                    await STORAGE.run(_write_json, self.blocked_path, sorted(self.blocked))
+                await self._report(bot)
+        except Exception as e:
+            print(f"broadcast {st['id']} error: {e}")
+            raise
+        await STORAGE.run(self._save)
+        await self._report(bot)
+        print(f"broadcast {st['id']} {st['status']}: {self.progress_text()!r}")
+
+
+BROADCASTER = None
+
+
+def get_broadcaster() -> Broadcaster:
+    global BROADCASTER
+    if BROADCASTER is None:
+        BROADCASTER = Broadcaster()
+    return BROADCASTER
+
+
+# === СВЕРКА БАЛАНСОВ С ЖУРНАЛОМ ===
+
+def _num(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class JournalFold:
+    """Свёртка журнала transactions с чекпоинтом: состояние и курсор лежат в JSON-файле,
+    catch_up дочитывает страницами по page_size только строки после курсора.
+    Общая основа для сверки, статистики и сгорания бонусов."""
+
+    def __init__(self, path: str, page_size: int = RECONCILE_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+
+    def load(self, full: bool = False, **empty) -> dict:
+        """Состояние из чекпоинта; с full, без файла или при смене хранилища — пустое (поля из empty)."""
+        backend = type(BACKEND).__name__
+        state = None if full else _read_json(self.path, None)
+        if not state or state.get("backend") != backend:
+            state = {"backend": backend, "cursor": None, "rows": 0, **empty}
+        return state
+
+    def catch_up(self, state: dict, fold) -> int:
+        """fold(row) для каждой строки после курсора. Возвращает число новых строк."""
+        added = 0
+        while True:
+            rows, cursor = BACKEND.transaction_page(state["cursor"], self.page_size)
+            if not rows:
+                break
+            for r in rows:
+                fold(r)
+            state["cursor"] = cursor
+            state["rows"] += len(rows)
+            added += len(rows)
+            if len(rows) < self.page_size:
+                break
+        return added
+
+    def save(self, state: dict):
+        _write_json(self.path, state)
+
+
+class Reconciler:
+    """Сверка turnover / bonus_balance в clients с журналом transactions.
+
+    Журнал читается страницами по RECONCILE_PAGE_SIZE строк и сворачивается в агрегаты
+    phone -> [оборот по покупкам, сумма bonus_delta]; в памяти одна страница плюс агрегаты.
+    Агрегаты и курсор сохраняются в RECONCILE_CHECKPOINT_PATH, следующий запуск дочитывает
+    только новые строки. Исправления считаются под блокировками, а в лист уходят
+    отложенной записью (одним batch_update) уже после них.
+    """
+
+    TOLERANCE = 0.5  # округления при начислении бонусов
+
+    def __init__(self, path: str = RECONCILE_CHECKPOINT_PATH, page_size: int = RECONCILE_PAGE_SIZE):
+        self.journal = JournalFold(path, page_size)
+
+    def _load(self, full: bool) -> dict:
+        return self.journal.load(full, aggregates={})
+
+    def catch_up(self, state: dict) -> int:
+        """Дочитать журнал после курсора и добавить в агрегаты. Возвращает число новых строк."""
+        aggregates = state["aggregates"]
+
+        def fold(r):
+            phone = phone_key(r.get("phone", ""))
+            if not phone:
+                return
+            agg = aggregates.setdefault(phone, [0.0, 0.0])
+            if r.get("type") == "purchase":
+                agg[0] += _num(r.get("amount"))
+            agg[1] += _num(r.get("bonus_delta"))
+
+        return self.journal.catch_up(state, fold)
+
+    def drift(self, state: dict) -> tuple[list[dict], list[str]]:
+        """(расхождения по клиентам, телефоны из журнала без строки в clients)."""
+        aggregates = state["aggregates"]
+        res, seen = [], set()
+        for client in BACKEND.iter_clients():
+            phone = phone_key(client.get("phone", ""))
+            seen.add(phone)
+            exp_turnover, exp_bonus = aggregates.get(phone, (0.0, 0.0))
+            turnover, bonus = _num(client.get("turnover")), _num(client.get("bonus_balance"))
+            if abs(turnover - exp_turnover) > self.TOLERANCE or abs(bonus - exp_bonus) > self.TOLERANCE:
+                res.append({
+                    "client": client,
+                    "turnover": turnover, "expected_turnover": exp_turnover,
+                    "bonus": bonus, "expected_bonus": exp_bonus,
+                })
+        missing = sorted(p for p in aggregates if p not in seen)
+        return res, missing
+
+    @sheets_priority(PRIORITY_BACKGROUND)
+    def run(self, fix: bool = False, full: bool = False) -> dict:
+        init_storage()
+        state = self._load(full)
+        # основной объём читаем без блокировок, операции с клиентами в это время работают
+        self.catch_up(state)
+        with PHONE_LOCKS.hold_all():
+            # отложенные транзакции должны попасть в журнал, иначе исправление их «откатит»
+            flush_writes()
+            self.catch_up(state)
+            drifted, missing = self.drift(state)
+            fixed = 0
+            if fix and drifted:
+                updates = []
+                for d in drifted:
+                    client = dict(d["client"])
+                    client["turnover"] = d["expected_turnover"]
+                    client["bonus_balance"] = d["expected_bonus"]
+                    client["level"] = calc_level_and_rate(d["expected_turnover"])[0]
+                    updates.append(client)
+                BACKEND.update_clients(updates)
+                STATS.on_clients(updates)
+                fixed = len(updates)
+        if fixed:
+            flush_writes()  # исправления — в лист, когда операции с клиентами уже не ждут
+        self.journal.save(state)
+        return {"rows": state["rows"], "clients_drift": drifted, "missing": missing, "fixed": fixed}
+
+
+def format_reconcile_report(report: dict, limit: int = 20) -> str:
+    drifted = report["clients_drift"]
+    lines = [
+        f"🧾 Сверка с журналом операций ({report['rows']} строк)",
+        f"Расхождений: {len(drifted)}",
+    ]
+    for d in drifted[:limit]:
+        phone = d["client"].get("phone", "")
+        lines.append(
+            f"{phone}: оборот {d['turnover']:.0f} → {d['expected_turnover']:.0f}, "
+            f"бонусы {d['bonus']:.0f} → {d['expected_bonus']:.0f}"
+        )
+    if len(drifted) > limit:
+        lines.append(f"… и ещё {len(drifted) - limit}")
+    if report["missing"]:
+        lines.append(f"Телефоны из журнала без карточки клиента: {', '.join(report['missing'][:limit])}")
+    if report["fixed"]:
+        lines.append(f"✅ Исправлено клиентов: {report['fixed']}")
+    elif drifted:
+        lines.append("Исправить: /reconcile fix")
+    return "\n".join(lines)
+
+
+@sheets_priority(PRIORITY_BACKGROUND)
+def merge_duplicate_phones(apply: bool = False) -> dict:
+    """Разовая миграция к E.164: телефоны клиентов, журнала и связок переписываются в канонический
+    вид, дубли одного номера сливаются в одного клиента (обороты и бонусы складываются).
+    Без apply — только отчёт. Операции с клиентами на время миграции останавливаются."""
+    init_storage()
+    with PHONE_LOCKS.hold_all():
+        report = BACKEND.merge_duplicate_phones(apply)
+        if apply:
+            STATS.reset()  # телефоны сменились — агрегаты по клиентам пересоберутся при следующем /stats
+        return report
+
+
+def format_merge_report(report: dict, applied: bool, limit: int = 20) -> str:
+    lines = [
+        f"Дублей клиентов: {len(report['duplicates'])}",
+        *(" = ".join(group) for group in report["duplicates"][:limit]),
+        f"Карточек клиентов к правке: {report['clients_fixed']}",
+        f"Строк журнала с неканоничным телефоном: {report['tx_fixed']}",
+        f"Связок Telegram с неканоничным телефоном: {report['links_fixed']}",
+        "✅ Применено" if applied else "Применить: python loyalty_bot.py merge-phones --apply",
+    ]
+    return "\n".join(lines)
+
+
+def merge_phones_cli(args: list[str]) -> int:
+    """python loyalty_bot.py merge-phones [--apply]"""
+    apply = "--apply" in args
+    print(format_merge_report(merge_duplicate_phones(apply), apply))
+    if BACKEND is not None:
+        BACKEND.close()
+    return 0
+
+
+# === СТАТИСТИКА ===
+# Агрегаты для /stats держатся в памяти и обновляются на каждой записи клиента и операции
+# (record_operation, update_client_row, log_transaction, импорт, сверка), так что отчёт не читает листы.
+# Полный проход по клиентам и журналу — только при первом /stats после старта или по /stats rebuild;
+# свёртка журнала по дням сохраняется в STATS_CHECKPOINT_PATH вместе с курсором, после рестарта
+# дочитываются только новые строки.
+
+def _msk_day(ts) -> str:
+    """UTC ISO из журнала -> дата по Москве (YYYY-MM-DD)."""
+    try:
+        return (datetime.fromisoformat(str(ts)[:19]) + timedelta(hours=3)).date().isoformat()
+    except ValueError:
+        return ""
+
+
+class LiveStats:
+    """Уровни и бонусные обязательства по клиентам + оборот, начисления и списания по дням."""
+
+    def __init__(self, path: str = STATS_CHECKPOINT_PATH, page_size: int = RECONCILE_PAGE_SIZE):
+        self.journal = JournalFold(path, page_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.ready = False
+            self.clients: dict[str, tuple[str, float]] = {}  # phone -> (уровень, баланс)
+            self.levels: dict[str, int] = {}
+            self.liability = 0.0
+            # день -> [оборот, покупок, начислено бонусов, списано бонусов]
+            self.days: dict[str, list[float]] = {}
+
+    # --- инкрементальные обновления (вызываются под блокировкой телефона) ---
+
+    def _put_client(self, client: dict):
+        phone = phone_key(client.get("phone", ""))
+        if not phone:
+            return
+        level = calc_level_and_rate(_num(client.get("turnover")))[0]
+        bonus = _num(client.get("bonus_balance"))
+        old = self.clients.get(phone)
+        if old is not None:
+            self.levels[old[0]] -= 1
+            self.liability -= old[1]
+        self.clients[phone] = (level, bonus)
+        self.levels[level] = self.levels.get(level, 0) + 1
+        self.liability += bonus
+
+    def _put_transaction(self, tx_type, amount, bonus_delta, ts):
+        self._fold_day(self.days, tx_type, amount, bonus_delta, ts)
+
+    @staticmethod
+    def _fold_day(days: dict, tx_type, amount, bonus_delta, ts):
+        day = days.setdefault(_msk_day(ts), [0.0, 0, 0.0, 0.0])
+        if tx_type == "purchase":
+            day[0] += _num(amount)
+            day[1] += 1
+        bonus_delta = _num(bonus_delta)
+        if bonus_delta > 0:
+            day[2] += bonus_delta
+        elif tx_type == "redeem":
+            day[3] -= bonus_delta
+
+    def on_client(self, client: dict):
+        with self._lock:
+            if self.ready:
+                self._put_client(client)
+
+    def on_clients(self, clients):
+        with self._lock:
+            if self.ready:
+                for client in clients:
+                    self._put_client(client)
+
+    def on_transaction(self, row: list):
+        with self._lock:
+            if self.ready:
+                self._put_transaction(row[1], row[2], row[3], row[4])
+
+    # --- пересборка ---
+
+    def _catch_up(self, state: dict):
+        # складываем в state["days"], а не в self.days: до подмены в rebuild текущий срез продолжает работать
+        days = state["days"]
+        self.journal.catch_up(
+            state, lambda r: self._fold_day(days, r.get("type"), r.get("amount"), r.get("bonus_delta"), r.get("ts")),
+        )
+
+    @sheets_priority(PRIORITY_BACKGROUND)
+    def rebuild(self, full: bool = False):
+        """Собрать агрегаты проходом по клиентам и журналу (журнал — от сохранённого курсора)."""
+        init_storage()
+        state = self.journal.load(full, days={})
+        # основной объём журнала читаем без блокировок, операции с клиентами в это время работают
+        self._catch_up(state)
+        with PHONE_LOCKS.hold_all():  # под блокировкой только хвост журнала и проход по клиентам
+            flush_writes()
+            self._catch_up(state)
+            with self._lock:
+                self.days = state["days"]
+                self.clients, self.levels, self.liability = {}, {}, 0.0
+                for client in BACKEND.iter_clients():
+                    self._put_client(client)
+                self.ready = True
+            # сохраняем до снятия блокировок: дальше self.days (он же state["days"]) меняют хуки операций
+            self.journal.save(state)
+
+    def report(self, today: str | None = None) -> dict:
+        """Срез для /stats: только арифметика над агрегатами в памяти."""
+        if not self.ready:
+            self.rebuild()
+        today = today or _msk_day(datetime.utcnow().isoformat())
+        with self._lock:
+            days = {d: list(v) for d, v in self.days.items()}
+            levels = dict(self.levels)
+            liability = self.liability
+            clients = len(self.clients)
+        accrued = sum(v[2] for v in days.values())
+        redeemed = sum(v[3] for v in days.values())
+
+        last_days = [(datetime.fromisoformat(today) - timedelta(days=i)).date().isoformat() for i in range(7)]
+        weeks: dict[str, float] = {}
+        for d, v in days.items():
+            if d:
+                year, week, _ = datetime.fromisoformat(d).isocalendar()
+                weeks[f"{year}-W{week:02d}"] = weeks.get(f"{year}-W{week:02d}", 0.0) + v[0]
+        month_ago = (datetime.fromisoformat(today) - timedelta(days=29)).date().isoformat()
+        accrued_30 = sum(v[2] for d, v in days.items() if d >= month_ago)
+        redeemed_30 = sum(v[3] for d, v in days.items() if d >= month_ago)
+        return {
+            "clients": clients,
+            "levels": levels,
+            "liability": liability,
+            "by_day": [(d, days.get(d, [0.0, 0])[0], days.get(d, [0.0, 0])[1]) for d in last_days],
+            "by_week": sorted(weeks.items(), reverse=True)[:8],
+            "redemption_rate": redeemed / accrued if accrued else 0.0,
+            "redemption_rate_30": redeemed_30 / accrued_30 if accrued_30 else 0.0,
+            "accrued": accrued,
+            "redeemed": redeemed,
+        }
+
+
+STATS = LiveStats()
+
+
+def format_stats_report(report: dict) -> str:
+    levels = ", ".join(f"{level}: {n}" for level, n in sorted(report["levels"].items()) if n)
+    lines = [
+        "📊 Статистика",
+        f"Клиентов: {report['clients']} ({levels or '—'})",
+        f"Бонусов на счетах (обязательства): {report['liability']:.0f}",
+        f"Начислено всего: {report['accrued']:.0f}, списано: {report['redeemed']:.0f}",
+        f"Доля списаний: {report['redemption_rate']:.1%} за всё время, {report['redemption_rate_30']:.1%} за 30 дней",
+        "",
+        "Оборот по дням:",
+        *(f"  {d}: {amount:.0f}₽ ({n} покупок)" for d, amount, n in report["by_day"]),
+        "",
+        "Оборот по неделям:",
+        *(f"  {week}: {amount:.0f}₽" for week, amount in report["by_week"]),
+    ]
+    return "\n".join(lines)
+
+
+# === СГОРАНИЕ БОНУСОВ ===
+# Каждое начисление (purchase, promo_review) — партия бонусов со сроком BONUS_TTL_DAYS; списания
+# (redeem и сами bonus_expire) гасят партии по FIFO. Партии — свёртка журнала: она сохраняется
+# в BONUS_LOTS_PATH с курсором, каждый запуск дочитывает только новые строки журнала, а сгоревшие
+# партии достаются из кучи по сроку — без прохода по всем клиентам.
+
+class BonusExpiry:
+    ACCRUALS = ("purchase", "promo_review")
+
+    def __init__(self, path: str = BONUS_LOTS_PATH, ttl_days: int = BONUS_TTL_DAYS,
+                 notice_days: int = BONUS_EXPIRY_NOTICE_DAYS, page_size: int = RECONCILE_PAGE_SIZE):
+        self.journal = JournalFold(path, page_size)
+        self.ttl = timedelta(days=ttl_days)
+        self.notice = timedelta(days=notice_days)
+        self.since = None
+        self._lock = threading.Lock()
+        self.state = None
+        self._expiry_heap: list[tuple[str, str]] = []  # (срок, телефон)
+        self._notice_heap: list[tuple[str, str]] = []
+
+    def _load(self):
+        state = self.journal.load(lots={}, notified={}, last_run=None)
+        # дата включения сгорания: старые начисления отсчитывают срок от неё, а не от своей даты
+        state.setdefault("since", datetime.utcnow().date().isoformat())
+        self.since = datetime.fromisoformat(BONUS_EXPIRY_SINCE or state["since"])
+        self.state = state
+        self._expiry_heap = [(lot[0], phone) for phone, lots in state["lots"].items() for lot in lots]
+        heapq.heapify(self._expiry_heap)
+        self._notice_heap = list(self._expiry_heap)
+
+    def _expires_at(self, ts) -> str:
+        accrued = datetime.fromisoformat(str(ts)[:19])
+        if accrued < self.since:
+            accrued = self.since
+        return (accrued + self.ttl).isoformat(timespec="seconds")
+
+    def _fold(self, r: dict):
+        phone = phone_key(r.get("phone", ""))
+        bonus_delta = _num(r.get("bonus_delta"))
+        if not phone or not bonus_delta:
+            return
+        lots = self.state["lots"]
+        if bonus_delta > 0:
+            if r.get("type") not in self.ACCRUALS:
+                return
+            try:
+                expires_at = self._expires_at(r.get("ts"))
+            except ValueError:
+                return
+            lots.setdefault(phone, []).append([expires_at, bonus_delta])
+            heapq.heappush(self._expiry_heap, (expires_at, phone))
+            heapq.heappush(self._notice_heap, (expires_at, phone))
+            return
+        spend = -bonus_delta
+        queue = lots.get(phone, [])
+        while spend > 0 and queue:
+            used = min(spend, queue[0][1])
+            queue[0][1] -= used
+            spend -= used
+            if queue[0][1] <= 0:
+                queue.pop(0)
+        if not queue:
+            lots.pop(phone, None)
+            self.state["notified"].pop(phone, None)
+
+    def catch_up(self):
+        self.journal.catch_up(self.state, self._fold)
+
+    @staticmethod
+    def _pop_due(heap: list, until: str) -> set[str]:
+        phones = set()
+        while heap and heap[0][0] <= until:
+            phones.add(heapq.heappop(heap)[1])
+        return phones
+
+    def _expire(self, phones: set[str], now: str) -> list[dict]:
+        """Списать сгоревшие партии: одна bonus_expire на клиента, всё — одной пакетной записью."""
+        flush_writes()
+        self.catch_up()  # списания, сделанные до блокировки, гасят старые партии раньше сгорания
+        lots = self.state["lots"]
+        clients, tx_rows, expired = [], [], []
+        for phone in sorted(phones):
+            due = [lot for lot in lots.get(phone, []) if lot[0] <= now]
+            amount = sum(lot[1] for lot in due)
+            client = find_client_by_phone(phone)
+            if not due or client is None:
+                continue
+            balance = _num(client.get("bonus_balance"))
+            amount = round(min(amount, balance), 2)  # баланс правили вручную — в минус не уходим
+            if amount <= 0:
+                continue
+            client["bonus_balance"] = balance - amount
+            clients.append(client)
+            accrued_before = (datetime.fromisoformat(due[-1][0]) - self.ttl + timedelta(hours=3)).strftime("%d.%m.%Y")
+            tx_rows.append([phone, "bonus_expire", 0, -amount, now, f"Сгорание бонусов, начисленных до {accrued_before}"])
+            expired.append({"phone": phone, "amount": amount, "balance": client["bonus_balance"]})
+        if tx_rows:
+            BACKEND.apply_batch(clients, tx_rows)
+            STATS.on_clients(clients)
+            for row in tx_rows:
+                STATS.on_transaction(row)
+            self.catch_up()  # свои bonus_expire гасят партии так же, как списания
+        for phone in phones:  # остаток сгоревших партий сверх баланса просто забываем
+            queue = [lot for lot in lots.get(phone, []) if lot[0] > now]
+            if queue:
+                lots[phone] = queue
+            else:
+                lots.pop(phone, None)
+                self.state["notified"].pop(phone, None)
+        return expired
+
+    def _notices(self, now: str) -> list[dict]:
+        """Партии, которые сгорят в ближайшие notice дней и о которых ещё не предупреждали."""
+        horizon = (datetime.fromisoformat(now) + self.notice).isoformat(timespec="seconds")
+        notified = self.state["notified"]
+        res = []
+        for phone in sorted(self._pop_due(self._notice_heap, horizon)):
+            soon = [lot for lot in self.state["lots"].get(phone, []) if now < lot[0] <= horizon and lot[0] > notified.get(phone, "")]
+            amount = sum(lot[1] for lot in soon)
+            if amount <= 0:
+                continue
+            notified[phone] = soon[-1][0]
+            res.append({"phone": phone, "amount": amount, "expires_at": soon[0][0], "user_ids": get_user_ids_by_phone(phone)})
+        return res
+
+    @sheets_priority(PRIORITY_BACKGROUND)
+    def run(self, now: str | None = None) -> dict:
+        init_storage()
+        now = now or datetime.utcnow().isoformat(timespec="seconds")
+        with self._lock:
+            if self.state is None:
+                self._load()
+            self.catch_up()
+            phones = self._pop_due(self._expiry_heap, now)
+            expired = []
+            if phones:
+                with PHONE_LOCKS.hold_many(phones):
+                    expired = self._expire(phones, now)
+            notices = self._notices(now)
+            self.state["last_run"] = now
+            self.journal.save(self.state)
+        return {"expired": expired, "notices": notices}
+
+
+BONUS_EXPIRY = BonusExpiry()
+
+
+# === ИМПОРТ ПРОДАЖ ИЗ КАССЫ ===
+# Дневная выгрузка кассы (CSV) проводится разом: как если бы каждую покупку ввели через /admin,
+# но бонусы считаются за один проход, а запись — одним пакетом. Повторный импорт того же файла
+# ничего не меняет: проведённые чеки запоминаются в реестре (лист / таблица pos_imports).
+
+POS_COLUMN_ALIASES = {
+    "phone": ("phone", "телефон", "тел", "tel"),
+    "amount": ("amount", "сумма", "sum", "total", "итого"),
+    "ts": ("ts", "date", "datetime", "дата", "время"),
+    "ref": ("ref", "receipt", "check", "чек", "номер чека", "id"),
+}
+POS_TS_FORMATS = ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M")
+
+
+def _parse_amount(text: str) -> float:
+    """ "1 234,50" / "1234.5" -> 1234.5"""
+    return float(re.sub(r"[\s\u00a0₽]", "", text).replace(",", "."))
+
+
+def _parse_pos_ts(text: str) -> str:
+    """Время продажи по Москве из кассы -> UTC ISO, как пишет log_transaction."""
+    text = text.strip()
+    if not text:
+        return datetime.utcnow().isoformat(timespec="seconds")
+    try:
+        local = datetime.fromisoformat(text)
+    except ValueError:
+        for fmt in POS_TS_FORMATS:
+            try:
+                local = datetime.strptime(text, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"не распознана дата {text!r}")
+    return (local - timedelta(hours=3)).isoformat(timespec="seconds")
+
+
+def _pos_columns(first: str, delimiter: str) -> dict[str, int]:
+    """Номера колонок по названиям в первой строке (пусто, если это не заголовок)."""
+    header = [h.strip().lower() for h in next(csv.reader([first], delimiter=delimiter), [])]
+    columns = {}
+    for field, aliases in POS_COLUMN_ALIASES.items():
+        for i, h in enumerate(header):
+            if h in aliases:
+                columns[field] = i
+                break
+    return columns if "phone" in columns and "amount" in columns else {}
+
+
+def _pos_delimiter(first: str) -> str:
+    """Разделитель: из POS_CSV_DELIMITER, иначе тот, с которым первая строка читается как заголовок.
+    Без заголовка ; и табуляция важнее запятой: в «1234,50» запятая — десятичная."""
+    if POS_CSV_DELIMITER:
+        return POS_CSV_DELIMITER
+    for delimiter in (";", "\t", ","):
+        if _pos_columns(first, delimiter):
+            return delimiter
+    for delimiter in (";", "\t"):
+        if delimiter in first:
+            return delimiter
+    return ","
+
+
+def iter_pos_sales(lines):
+    """Разбор выгрузки по одной строке: (номер строки, продажа | None, ошибка | None).
+
+    lines — любой итератор строк (открытый файл), выгрузка читается потоком.
+    Разделитель (; табуляция или ,) — см. _pos_delimiter. Если в первой строке есть названия
+    колонок — берём их, иначе порядок по умолчанию: телефон, сумма, дата, номер чека.
+    """
+    lines = iter(lines)
+    first = next(lines, "")
+    delimiter = _pos_delimiter(first)
+    columns = _pos_columns(first, delimiter)
+    data_lines = lines
+    if not columns:
+        columns = {"phone": 0, "amount": 1, "ts": 2, "ref": 3}
+        data_lines = itertools.chain([first], lines)  # заголовка нет — первая строка тоже продажа
+        start = 1
+    else:
+        start = 2
+
+    for line_no, row in enumerate(csv.reader(data_lines, delimiter=delimiter), start=start):
+        if not any(cell.strip() for cell in row):
+            continue
+
+        def cell(field):
+            i = columns.get(field)
+            return row[i].strip() if i is not None and i < len(row) else ""
+
+        phone = normalize_phone(cell("phone"))
+        if phone is None:
+            yield line_no, None, f"телефон {cell('phone')!r}"
+            continue
+        try:
+            amount = _parse_amount(cell("amount"))
+            ts = _parse_pos_ts(cell("ts"))
+        except ValueError as e:
+            yield line_no, None, str(e) if "дата" in str(e) else f"сумма {cell('amount')!r}"
+            continue
+        if amount <= 0:
+            yield line_no, None, f"сумма {cell('amount')!r}"
+            continue
+        yield line_no, {"phone": phone, "amount": amount, "ts": ts, "ref": cell("ref")}, None
+
+
+def plan_purchases(clients: dict[str, dict], sales: list[dict]) -> tuple[dict[str, dict], list[list]]:
+    """Провести продажи по копиям клиентов за один проход: уровень и процент пересчитываются
+    после каждой покупки телефона (как в apply_purchase), так что смена уровня посреди
+    выгрузки учитывается. Возвращает (новые состояния клиентов, строки журнала)."""
+    state = {phone: dict(c) for phone, c in clients.items()}
+    tx_rows = []
+    for sale in sales:
+        c = state[sale["phone"]]
+        turnover = float(c.get("turnover", 0) or 0) + sale["amount"]
+        level, rate = calc_level_and_rate(turnover)
+        bonus_delta = round(sale["amount"] * rate)
+        c["turnover"] = turnover
+        c["bonus_balance"] = float(c.get("bonus_balance", 0) or 0) + bonus_delta
+        c["level"] = level
+        tx_rows.append([sale["phone"], "purchase", sale["amount"], bonus_delta, sale["ts"], f"Касса, чек {sale['ref']}"])
+    return state, tx_rows
+
+
+def _sale_refs(sales: list[dict]):
+    """Чекам без номера — стабильный номер из содержимого строки (и номера повтора в файле),
+    чтобы повторный импорт того же файла их узнал."""
+    seen = {}
+    for sale in sales:
+        if sale["ref"]:
+            continue
+        key = f"{sale['phone']}|{sale['amount']}|{sale['ts']}"
+        seen[key] = seen.get(key, 0) + 1
+        sale["ref"] = "h" + hashlib.sha1(f"{key}|{seen[key]}".encode()).hexdigest()[:15]
+
+
+@sheets_priority(PRIORITY_ADMIN)
+def import_pos_sales(lines, apply: bool = False) -> dict:
+    """Импорт выгрузки кассы. Без apply — только отчёт (что изменится), ничего не пишет."""
+    init_storage()
+    sales, errors = [], []
+    for line_no, sale, error in iter_pos_sales(lines):
+        if error:
+            errors.append((line_no, error))
+        else:
+            sales.append(sale)
+    _sale_refs(sales)
+
+    known = BACKEND.known_import_refs()
+    fresh, duplicates = [], 0
+    for sale in sales:
+        if sale["ref"] in known:
+            duplicates += 1
+            continue
+        known.add(sale["ref"])  # повтор чека внутри файла — тоже дубль
+        fresh.append(sale)
+
+    phones = list(dict.fromkeys(sale["phone"] for sale in fresh))
+    with PHONE_LOCKS.hold_many(phones):
+        before, new_phones = {}, []
+        for phone in phones:
+            client = find_client_by_phone(phone)
+            if client is None:
+                client = _new_client(phone, "")
+                new_phones.append(phone)
+            before[phone] = client
+        after, tx_rows = plan_purchases(before, fresh)
+        if apply and fresh:
+            now = datetime.utcnow().isoformat(timespec="seconds")
+            BACKEND.apply_import(
+                [after[p] for p in new_phones],
+                [after[p] for p in phones if p not in set(new_phones)],
+                tx_rows,
+                [[sale["ref"], sale["phone"], sale["amount"], now] for sale in fresh],
             )
+            STATS.on_clients(after.values())
+            for row in tx_rows:
+                STATS.on_transaction(row)
+        user_ids = {phone: get_user_ids_by_phone(phone) for phone in phones} if apply else {}
+
+    return {
+        "sales": len(fresh),
+        "duplicates": duplicates,
+        "errors": errors,
+        "new_clients": len(new_phones),
+        "amount": sum(sale["amount"] for sale in fresh),
+        "bonus": sum(row[3] for row in tx_rows),
+        "clients": [
+            {
+                "phone": phone,
+                "turnover": (float(before[phone].get("turnover", 0) or 0), after[phone]["turnover"]),
+                "bonus": (float(before[phone].get("bonus_balance", 0) or 0), after[phone]["bonus_balance"]),
+                "level": (client_level(before[phone]), after[phone]["level"]),
+                "user_ids": user_ids.get(phone, []),
+            }
+            for phone in phones
+        ],
+    }
+
+
+def format_pos_report(report: dict, applied: bool, limit: int = 20) -> str:
+    lines = [
+        ("✅ Импорт проведён" if applied else "🧾 Проверка выгрузки (ничего не записано)"),
+        f"Продаж к проведению: {report['sales']} на {report['amount']:.0f}₽, бонусов: {report['bonus']:.0f}",
+        f"Клиентов: {len(report['clients'])} (новых: {report['new_clients']})",
+    ]
+    if report["duplicates"]:
+        lines.append(f"Уже проведены раньше (пропущены): {report['duplicates']}")
+    for c in report["clients"][:limit]:
+        level = f", {c['level'][0]} → {c['level'][1]}" if c["level"][0] != c["level"][1] else ""
+        lines.append(
+            f"{c['phone']}: оборот {c['turnover'][0]:.0f} → {c['turnover'][1]:.0f}, "
+            f"бонусы {c['bonus'][0]:.0f} → {c['bonus'][1]:.0f}{level}"
+        )
+    if len(report["clients"]) > limit:
+        lines.append(f"… и ещё {len(report['clients']) - limit}")
+    if report["errors"]:
+        lines.append(f"Строк с ошибками: {len(report['errors'])}")
+        lines += [f"  строка {n}: {msg}" for n, msg in report["errors"][:limit]]
+    return "\n".join(lines)
+
+
+def import_pos_cli(args: list[str]) -> int:
+    """python loyalty_bot.py import-pos FILE.csv [--apply]"""
+    paths = [a for a in args if not a.startswith("--")]
+    if not paths:
+        print("usage: python loyalty_bot.py import-pos FILE.csv [--apply]")
+        return 2
+    apply = "--apply" in args
+    with open(paths[0], encoding="utf-8-sig", newline="") as f:
+        report = import_pos_sales(f, apply)
+    print(format_pos_report(report, apply, limit=1000))
+    if BACKEND is not None:
+        BACKEND.close()
+    return 1 if report["errors"] else 0
+
+
+# === СОСТОЯНИЕ ДИАЛОГОВ ===
+
+class SqlitePersistence(BasePersistence):
+    """context.user_data в локальной SQLite: одна строка на пару (user_id, ключ).
+
+    Изменённых пользователей копит сам PTB и раз в update_interval вызывает update_user_data —
+    здесь в базу уходят только ключи, значение которых поменялось с прошлой записи.
+    При старте ничего не читается: данные пользователя подгружаются в refresh_user_data
+    перед его первым апдейтом, так что время старта не зависит от числа пользователей.
+    Значения хранятся в JSON (у нас это флаги, шаги и телефоны). Сами запросы к базе идут
+    в asyncio.to_thread, чтобы fsync и блокировки SQLite не останавливали цикл событий.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        );
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        # что лежит в базе по уже загруженным пользователям: user_id -> {ключ: JSON}
+        self._stored: dict[int, dict[str, str]] = {}
+        self._lock = threading.Lock()  # запросы идут из потоков asyncio.to_thread, соединение одно
+
+    @staticmethod
+    def _encode(value) -> str | None:
+        try:
+            return json.dumps(value, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError):
+            return None  # несериализуемое значение живёт только в памяти
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    def _load(self, user_id: int) -> list[tuple[str, str]]:
+        with self._lock:
+            return self.db.execute("SELECT key, value FROM user_data WHERE user_id = ?", (user_id,)).fetchall()
+
+    def _write(self, user_id: int, changed: dict[str, str], removed: list[str]):
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT INTO user_data (user_id, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value",
+                    [(user_id, key, value) for key, value in changed.items()],
+                )
+                self.db.executemany(
+                    "DELETE FROM user_data WHERE user_id = ? AND key = ?", [(user_id, key) for key in removed],
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            self.db.execute(sql, params)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._stored:
             return
+        rows = await asyncio.to_thread(self._load, user_id)
+        if user_id in self._stored:
+            return  # пока читали, пользователя уже загрузил параллельный апдейт
+        self._stored[user_id] = dict(rows)
+        for key, value in rows:
+            user_data.setdefault(key, json.loads(value))
+
+    async def update_user_data(self, user_id: int, data: dict):
+        stored = self._stored.setdefault(user_id, {})
+        changed = {}
+        for key, value in data.items():
+            encoded = self._encode(value)
+            if encoded is not None and stored.get(str(key)) != encoded:
+                changed[str(key)] = encoded
+        removed = [key for key in stored if key not in {str(k) for k in data}]
+        if not changed and not removed:
+            return
+        await asyncio.to_thread(self._write, user_id, changed, removed)
+        stored.update(changed)
+        for key in removed:
+            stored.pop(key, None)
 
-def log_transaction(phone: str, tx_type: str, amount: float, bonus_delta: float, comment: str = ""):
-    """Запись транзакции в лист transactions."""
-    if TX_WS is None:
-        return
-    ts = datetime.utcnow().isoformat(timespec="seconds")
-    TX_WS.append_row(
-        [phone, tx_type, amount, bonus_delta, ts, comment],
-        value_input_option="RAW",
-    )
+    async def drop_user_data(self, user_id: int):
+        await asyncio.to_thread(self._execute, "DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        self._stored.pop(user_id, None)
 
-def get_transactions_for_phone(phone: str, limit: int = 10) -> list[dict]:
-    """Возвращает последние операции по телефону из листа transactions."""
-    if TX_WS is None:
-        return []
-    records = TX_WS.get_all_records()
-    # фильтруем по телефону
-    filtered = [r for r in records if str(r.get("phone", "")).strip() == phone.strip()]
-    # сортируем по времени, если есть поле ts
-    try:
-        filtered.sort(key=lambda r: r.get("ts", ""), reverse=True)
-    except Exception:
-        pass
-    return filtered[:limit]
+    async def flush(self):
+        # всё уже закоммичено; переносим WAL в основной файл перед остановкой
+        await asyncio.to_thread(self._execute, "PRAGMA wal_checkpoint(TRUNCATE)")
 
+    # chat_data, bot_data, callback_data и ConversationHandler бот не использует
 
-# === ЛОГИКА УРОВНЕЙ И БОНУСОВ ===
+    async def get_chat_data(self) -> dict:
+        return {}
 
-def calc_level_and_rate(turnover: float) -> tuple[str, float]:
-    """Возвращает (уровень, процент_начисления_бонусов)."""
-    if turnover >= 30000:
-        return "platinum", 0.10
-    elif turnover >= 10000:
-        return "gold", 0.07
-    else:
-        return "silver", 0.05
+    async def get_bot_data(self) -> dict:
+        return {}
 
-def describe_level(level: str) -> str:
-    """Описание уровня для клиента (мотивационный текст)."""
-    if level == "platinum":
-        return (
-            "Ваш уровень: Платинум ✨\n"
-            "Вы — VIP гость нашего фото-ателье: 10% от каждой покупки возвращаются к Вам в виде бонусов.\n"
-            "Бонусами можно оплатить до 30% суммы следующей покупки."
-        )
-    elif level == "gold":
-        return (
-            "Ваш уровень: Золото ⭐️\n"
-            "Вы уже в числе наших любимых клиентов: 7% от каждой покупки возвращаются на бонусный счёт.\n"
-            "Бонусами можно оплатить до 20% суммы следующей покупки."
-        )
-    else:
-        return (
-            "Ваш уровень: Серебро 💎\n"
-            "С каждого заказа Вы получаете 5% в виде бонусов.\n"
-            "Бонусами можно оплатить до 10% суммы следующей покупки."
-        )
+    async def get_callback_data(self):
+        return None
 
+    async def get_conversations(self, name: str) -> dict:
+        return {}
 
-def format_client_cabinet(client, phone: str) -> str:
-    """Текст личного кабинета для клиента."""
-    name = client.get("name") or "Клиент"
-    level = client.get("level", "silver")
-    turnover = float(client.get("turnover", 0) or 0)
-    bonus = float(client.get("bonus_balance", 0) or 0)
+    async def update_conversation(self, name, key, new_state):
+        pass
 
-    lvl_text = describe_level(level)
+    async def update_chat_data(self, chat_id, data):
+        pass
 
-    # сколько до следующего уровня
-    if level == "platinum":
-        next_level_line = "Вы уже на максимальном уровне программы лояльности - ПЛАТИНУМ."
-    elif level == "gold":
-        need = max(0, 30000 - turnover)
-        next_level_line = f"Следующий уровень — ПЛАТИНУМ (осталось потратить {need:.0f} рублей)."
-    else:  # silver
-        need = max(0, 10000 - turnover)
-        next_level_line = f"Следующий уровень — ЗОЛОТО (осталось потратить {need:.0f} рублей)."
+    async def update_bot_data(self, data):
+        pass
 
-    text = (
-        f"{name}, добро пожаловать в ваш личный кабинет программы лояльности 📸\n\n"
-        f"Телефон: {phone}\n"
-        f"Всего покупок на сумму: {turnover:.0f}₽\n"
-        f"Бонусный счёт: {bonus:.0f} бонусов\n\n"
-        f"{lvl_text}\n"
-        f"{next_level_line}\n\n"
-        "Каждая печать фото, ксерокс, скан или другая услуга в ателье — это ещё один шаг к новым бонусам.\n"
-        "Вы можете копить их и списывать частично за услуги 😉"
-    )
-    return text
+    async def update_callback_data(self, data):
+        pass
 
-def get_cabinet_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("📜 История", callback_data="history")],
-        [InlineKeyboardButton("📸 Перейти в канал", url="https://t.me/photo_himki_life")],
-        [InlineKeyboardButton("📂 Отправить файл", callback_data="send_file")],
-        [InlineKeyboardButton("💬 Оставить отзыв — +100 бонусов", callback_data="leave_review")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-def get_client_reply_keyboard() -> ReplyKeyboardMarkup:
-    buttons = [[KeyboardButton("Личный кабинет")]]
-    return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
 # === HANDLERS ===
 
+class AlbumCollector:
+    """Собирает части альбома (общий media_group_id): Telegram шлёт их отдельными апдейтами
+    почти одновременно. Через delay секунд после последней части альбом отдаётся целиком.
+    Хендлер при этом не ждёт — апдейты того же пользователя обрабатываются по очереди
+    (см. OrderedUpdateProcessor), и ожидание внутри хендлера задержало бы остальные части.
+
+    После отправки альбома его ключ ещё late_window секунд помнится: опоздавшие части уходят
+    тем же получателям отдельной пачкой с on_ready(..., late=True), а не как новый файл.
+    Отвечаем клиенту на альбом один раз: ключи, по которым уже был ответ, помнятся reply_window секунд.
+    """
+
+    def __init__(self, delay: float = ALBUM_DEBOUNCE, late_window: float = ALBUM_LATE_WINDOW,
+                 reply_window: float = ALBUM_REPLY_WINDOW):
+        self.delay = delay
+        self.late_window = late_window
+        self.reply_window = max(reply_window, late_window)
+        self._albums: dict[tuple[int, str], dict] = {}
+        self._sent: dict[tuple[int, str], tuple[float, object, dict]] = {}  # ключ -> (до когда, on_ready, kwargs)
+        self._replied: dict[tuple[int, str], float] = {}  # альбомы, клиенту по которым уже ответили
+
+    def start(self, message, on_ready, **kwargs):
+        """Первая часть альбома: по готовности будет вызван on_ready(messages, **kwargs)."""
+        key = (message.chat_id, message.media_group_id)
+        self._albums[key] = {"messages": [], "on_ready": on_ready, "kwargs": kwargs, "task": None}
+        self.add(message)
+
+    def add(self, message) -> bool:
+        """Добавить часть начатого (или недавно отправленного) альбома. False — такого альбома не ждём."""
+        key = (message.chat_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            sent = self._sent.get(key)
+            if sent is None or sent[0] < time.monotonic():
+                return False
+            _, on_ready, kwargs = sent
+            album = self._albums[key] = {
+                "messages": [], "on_ready": on_ready, "kwargs": {**kwargs, "late": True}, "task": None,
+            }
+        album["messages"].append(message)
+        if album["task"] is not None:
+            album["task"].cancel()
+        album["task"] = asyncio.create_task(self._fire((message.chat_id, message.media_group_id)))
+        return True
+
+    def reply_once(self, message) -> bool:
+        """Отвечать ли на файл, пришедший вне сценария: одиночный файл — всегда, альбом — если
+        клиенту по нему ещё не отвечали (ни подсказкой, ни ответом на отправленный альбом)."""
+        if not message.media_group_id:
+            return True
+        return self._mark_replied((message.chat_id, message.media_group_id))
+
+    def _mark_replied(self, key) -> bool:
+        now = time.monotonic()
+        self._replied = {k: v for k, v in self._replied.items() if v >= now}
+        if key in self._replied:
+            return False
+        self._replied[key] = now + self.reply_window
+        return True
+
+    async def _fire(self, key):
+        await asyncio.sleep(self.delay)
+        album = self._albums.pop(key)
+        now = time.monotonic()
+        self._sent = {k: v for k, v in self._sent.items() if v[0] >= now}
+        self._sent[key] = (now + self.late_window, album["on_ready"], album["kwargs"])
+        self._mark_replied(key)  # части, опоздавшие и после late_window, второго ответа не получат
+        messages = sorted(album["messages"], key=lambda m: m.message_id)
+        try:
+            await album["on_ready"](messages, **album["kwargs"])
+        except Exception as e:
+            print(f"album delivery error: {e}")
+
+
+ALBUMS = AlbumCollector()
+
+
+async def deliver_client_files(messages: list, bot, caption: str, reply: str, late: bool = False):
+    """Скопировать файлы клиента всем админам разом (одна пачка и одна подпись на админа)
+    и один раз ответить клиенту. late — опоздавшие части уже отправленного альбома:
+    клиенту второй раз не отвечаем."""
+    chat_id = messages[0].chat_id
+    message_ids = [m.message_id for m in messages]
+    if late:
+        caption = f"{caption}\nДополнение к альбому, файлов: {len(messages)}"
+    elif len(messages) > 1:
+        caption = f"{caption}\nФайлов в альбоме: {len(messages)}"
+
+    async def to_admin(admin_id: int):
+        try:
+            await bot.copy_messages(chat_id=admin_id, from_chat_id=chat_id, message_ids=message_ids)
+            await bot.send_message(chat_id=admin_id, text=caption)
+        except Exception as e:
+            print(f"forward client files error to {admin_id}: {e}")
+
+    await asyncio.gather(*(to_admin(admin_id) for admin_id in ADMIN_IDS))
+    if not late:
+        await messages[0].reply_text(reply)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Приветствие клиента."""
     user = update.effective_user
+    get_broadcaster().unblock(user.id)
 
     inline_kb = [
         [InlineKeyboardButton("🔐 Открыть личный кабинет", callback_data="cabinet_open")],
@@ -387,8 +4065,114 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["admin_mode"] = True
     context.user_data["admin_step"] = "await_phone"
 
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем привязанным клиентам (только админ)."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Доступ запрещён.")
+        return
+    broadcaster = get_broadcaster()
+    if broadcaster.running:
+        await update.message.reply_text(
+            "Уже идёт рассылка:\n\n" + broadcaster.progress_text(),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить", callback_data="broadcast_stop")]]),
+        )
+        return
+    await update.message.reply_text(
+        "📣 Рассылка всем клиентам, привязанным к боту.\n"
+        "Отправьте текст сообщения одним сообщением."
+    )
+    context.user_data["admin_mode"] = True
+    context.user_data["admin_step"] = "await_broadcast_text"
+
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reconcile — отчёт о расхождениях, /reconcile fix — исправить (только админ)."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Доступ запрещён.")
+        return
+    fix = bool(context.args) and context.args[0] == "fix"
+    await update.message.reply_text("⏳ Сверяю балансы с журналом операций…")
+    report = await STORAGE.run(Reconciler().run, fix=fix, timeout=600)
+    await update.message.reply_text(format_reconcile_report(report))
+
+async def expire_bonuses_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: сжечь просроченные партии бонусов и предупредить о скором сгорании."""
+    report = await STORAGE.run(BONUS_EXPIRY.run, timeout=600)
+    if report["expired"]:
+        total = sum(e["amount"] for e in report["expired"])
+        print(f"bonus expiry: {len(report['expired'])} clients, {total:.0f} bonuses")
+    for n in report["notices"]:
+        expires_msk = (datetime.fromisoformat(n["expires_at"]) + timedelta(hours=3)).strftime("%d.%m.%Y")
+        notify_text = (
+            f"⏳ {n['amount']:.0f} бонусов сгорят {expires_msk}.\n"
+            "Успейте потратить их при следующем заказе!"
+        )
+        NOTIFIER.notify_many(n["user_ids"], notify_text, tag="notify bonus_expiry")
+
+async def recompute_levels_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: записать в таблицу уровни, изменившиеся после покупок и правок оборота."""
+    changed = await STORAGE.run(recompute_levels, timeout=600)
+    if changed:
+        print(f"levels recomputed: {changed} clients")
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — сводка по клиентам и операциям, /stats rebuild — пересобрать с нуля (только админ)."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Доступ запрещён.")
+        return
+    if context.args and context.args[0] == "rebuild":
+        await update.message.reply_text("⏳ Пересобираю статистику по журналу операций…")
+        await STORAGE.run(STATS.rebuild, full=True, timeout=600)
+    report = await STORAGE.run(STATS.report, timeout=600)
+    await update.message.reply_text(format_stats_report(report))
+
+async def pos_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import — провести выгрузку продаж из кассы (CSV), сначала с проверкой (только админ)."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Доступ запрещён.")
+        return
+    await update.message.reply_text(
+        "🧾 Импорт продаж из кассы.\n"
+        "Пришлите CSV-файл документом: телефон, сумма, дата, номер чека.\n"
+        "Сначала покажу, что изменится, проведу после подтверждения."
+    )
+    context.user_data["admin_mode"] = True
+    context.user_data["admin_step"] = "await_pos_csv"
+
+async def download_pos_file(bot, file_id: str) -> io.TextIOWrapper:
+    """Выгрузка кассы как текстовый поток: строки декодируются по мере разбора, без копии всего файла."""
+    tg_file = await bot.get_file(file_id)
+    buf = io.BytesIO()
+    await tg_file.download_to_memory(buf)
+    buf.seek(0)
+    return io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+
 TG_LINKS_WS = None  # уже есть глобально
 
+async def show_history_page(query, phone: str, offset: int, page_size: int, prefix: str,
+                            title: str, empty_text: str, edit: bool):
+    """Страница истории: новым сообщением или (edit=True) на месте сообщения с кнопками."""
+    txs = await STORAGE.run(load_history, phone, page_size + 1, offset)
+    has_more = len(txs) > page_size
+    txs = txs[:page_size]
+    if not txs:
+        await query.message.reply_text(empty_text)
+        return
+
+    text = format_history(title, txs)
+    markup = get_history_keyboard(prefix, offset, page_size, has_more)
+    if not edit:
+        await query.message.reply_text(text, reply_markup=markup)
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):  # двойное нажатие на ту же кнопку
+            raise
+
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на Inline-кнопки."""
     query = update.callback_query
@@ -399,22 +4183,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Личный кабинет клиента
 
     if data == "cabinet_open":
-        init_gs()
-
         # 1) Пробуем найти телефон по user_id
-        linked_phone = get_phone_by_user_id(user.id)
-
-        if linked_phone:
-            client = find_client_by_phone(linked_phone)
-            if not client:
-                client = upsert_client(linked_phone, user.full_name or "")
-
-            turnover = float(client.get("turnover", 0) or 0)
-            level, _ = calc_level_and_rate(turnover)
-            if client.get("level") != level:
-                client["level"] = level
-                update_client_row(client)
+        found = await STORAGE.run(load_cabinet_by_user, user.id, user.full_name or "")
 
+        if found:
+            linked_phone, client = found
             context.user_data["client_phone"] = linked_phone
             cabinet_text = format_client_cabinet(client, linked_phone)
             await query.message.reply_text(
@@ -459,8 +4232,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # История операций
-    if data == "history":
+    # История операций: "history" из кабинета — первая страница новым сообщением,
+    # "hist:<offset>" — листание в том же сообщении
+    if data == "history" or data.startswith("hist:"):
         phone = context.user_data.get("client_phone")
         if not phone:
             await query.message.reply_text(
@@ -468,40 +4242,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        init_gs()
-        txs = get_transactions_for_phone(phone, limit=10)
-        if not txs:
-            await query.message.reply_text("Пока нет операций по вашему бонусному счёту.")
-            return
-
-        lines = ["История действий:"]
-        for r in txs:
-            ts_raw = r.get("ts", "")
-            try:
-                dt_utc = datetime.fromisoformat(ts_raw)
-                dt_msk = dt_utc + timedelta(hours=3)
-                ts_str = dt_msk.strftime("🗓%Y-%m-%d 🕟 %H:%M:%S")
-            except Exception:
-                ts_str = ts_raw
-
-            tx_type = r.get("type", "")
-            amount = float(r.get("amount", 0) or 0)
-            bonus_delta = float(r.get("bonus_delta", 0) or 0)
-
-            if tx_type == "purchase":
-                line = (
-                    f"{ts_str}: Покупка на {amount:.0f}₽, "
-                    f"начислено бонусов: {bonus_delta:.0f}."
-                )
-            elif tx_type == "redeem":
-                line = f"{ts_str}: Списание бонусов: {abs(bonus_delta):.0f}."
-            elif tx_type == "promo_review":
-                line = f"{ts_str}: Отзыв, бонусы: {bonus_delta:.0f}."
-            else:
-                line = f"{ts_str}: {tx_type}, сумма {amount:.0f}, бонусы {bonus_delta:.0f}."
-            lines.append(line)
-
-        await query.message.reply_text("\n".join(lines))
+        offset = int(data.split(":", 1)[1]) if data != "history" else 0
+        await show_history_page(
+            query, phone, offset, HISTORY_PAGE_SIZE, "hist", "История действий:",
+            "Пока нет операций по вашему бонусному счёту.", edit=data != "history",
+        )
         return
 
     # Отправка файла администратору
@@ -525,76 +4270,114 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Админ: история по клиенту
-    if data == "admin_history":
-        phone = context.user_data.get("admin_client_phone")
+    # Админ: история по клиенту ("ahist:<телефон>:<offset>" — листание)
+    if data == "admin_history" or data.startswith("ahist:"):
+        if user.id not in ADMIN_IDS:
+            await query.message.reply_text("⛔️ Доступ запрещён.")
+            return
+        if data == "admin_history":
+            phone, offset = context.user_data.get("admin_client_phone"), 0
+        else:
+            phone, offset = data.split(":", 1)[1].rsplit(":", 1)
+            offset = int(offset)
         if not phone:
             await query.message.reply_text(
                 "Телефон клиента не найден в сессии. Отправь /admin и введи телефон заново."
             )
             return
 
-        init_gs()
-        txs = get_transactions_for_phone(phone, limit=20)
-        if not txs:
-            await query.message.reply_text("По этому клиенту пока нет операций.")
+        await show_history_page(
+            query, phone, offset, ADMIN_HISTORY_PAGE_SIZE, f"ahist:{phone}", f"История действий по {phone}:",
+            "По этому клиенту пока нет операций.", edit=data != "admin_history",
+        )
+        return
+
+    if data in ("broadcast_confirm", "broadcast_cancel", "broadcast_stop"):
+        if user.id not in ADMIN_IDS:
             return
+        broadcaster = get_broadcaster()
 
-        lines = [f"История действий по {phone}:"]
-        for r in txs:
-            ts_raw = r.get("ts", "")
-            try:
-                dt_utc = datetime.fromisoformat(ts_raw)
-                dt_msk = dt_utc + timedelta(hours=3)
-                ts_str = dt_msk.strftime("🗓%Y-%m-%d 🕟 %H:%M:%S")
-            except Exception:
-                ts_str = ts_raw
+        if data == "broadcast_cancel":
+            context.user_data.pop("broadcast_text", None)
+            context.user_data["admin_step"] = "await_phone"
+            await query.edit_message_text("Рассылка отменена.")
+            return
 
-            tx_type = r.get("type", "")
-            amount = float(r.get("amount", 0) or 0)
-            bonus_delta = float(r.get("bonus_delta", 0) or 0)
+        if data == "broadcast_stop":
+            broadcaster.cancel()
+            await query.message.reply_text("⏹ Рассылка будет остановлена после текущей порции.")
+            return
 
-            if tx_type == "purchase":
-                line = (
-                    f"{ts_str}: Покупка на {amount:.0f}₽, "
-                    f"начислено бонусов: {bonus_delta:.0f}."
-                )
-            elif tx_type == "redeem":
-                line = f"{ts_str}: Списание бонусов: {abs(bonus_delta):.0f}."
-            elif tx_type == "promo_review":
-                line = f"{ts_str}: Отзыв, бонусы: {bonus_delta:.0f}."
-            else:
-                line = f"{ts_str}: {tx_type}, сумма {amount:.0f}, бонусы {bonus_delta:.0f}."
-            lines.append(line)
+        text = context.user_data.pop("broadcast_text", None)
+        if not text:
+            await query.edit_message_text("Текст рассылки не найден. Отправьте /broadcast заново.")
+            return
+        if broadcaster.running:
+            await query.edit_message_text("Уже идёт другая рассылка.")
+            return
+        await query.edit_message_text("📣 Рассылка запущена…")
+        await broadcaster.start(context.bot, text, query.message.chat_id, query.message.message_id)
+        context.user_data["admin_step"] = "await_phone"
+        return
 
-        await query.message.reply_text("\n".join(lines))
+    if data in ("pos_import_confirm", "pos_import_cancel"):
+        if user.id not in ADMIN_IDS:
+            return
+        file_id = context.user_data.pop("pos_file_id", None)
+        context.user_data["admin_step"] = "await_phone"
+        if data == "pos_import_cancel":
+            await query.edit_message_text("Импорт отменён.")
+            return
+        if not file_id:
+            await query.edit_message_text("Файл выгрузки не найден. Отправьте /import заново.")
+            return
+        await query.edit_message_text("⏳ Провожу продажи…")
+        pos_file = await download_pos_file(context.bot, file_id)
+        report = await STORAGE.run(import_pos_sales, pos_file, apply=True, timeout=600)
+        await query.message.reply_text(format_pos_report(report, applied=True))
+
+        for c in report["clients"]:
+            bonus_delta = c["bonus"][1] - c["bonus"][0]
+            if not c["user_ids"] or bonus_delta <= 0:
+                continue
+            notify_text = (
+                f"🧾 Покупки проведены, начислено {bonus_delta:.0f} бонусов.\n"
+                f"Текущий баланс: {c['bonus'][1]:.0f} бонусов."
+            )
+            NOTIFIER.notify_many(c["user_ids"], notify_text, tag="notify pos_import")
         return
 
     # Админские кнопки
-    if data == "admin_bonus_review":
-        phone = context.user_data.get("admin_client_phone")
+    if data == "admin_bonus_review" or data.startswith("admin_bonus_review:"):
+        if user.id not in ADMIN_IDS:
+            return
+        # телефон берём из самой кнопки: ключ операции — из её сообщения, и клиент — тот, чей это профиль
+        if data == "admin_bonus_review":
+            phone = context.user_data.get("admin_client_phone")  # кнопки, отправленные до обновления
+        else:
+            phone = data.split(":", 1)[1]
         if not phone:
             await query.message.reply_text(
                 "❗ Телефон клиента не найден в сессии. Отправь /admin и введи телефон заново."
             )
             return
 
-        init_gs()
-        client = find_client_by_phone(phone)
-        if not client:
+        # двойное нажатие на кнопку того же профиля — та же операция
+        op_id = f"q{query.message.chat_id}:{query.message.message_id}"
+        res = await STORAGE.run(apply_review_bonus, phone, op_id=op_id)
+        if res is None:
             await query.message.reply_text("Клиент не найден (возможно, ошибка номера).")
             context.user_data["admin_step"] = "await_phone"
             return
+        if res["duplicate"]:
+            await query.message.reply_text(
+                "ℹ️ Бонус за отзыв по этому профилю уже начислен, повторно не начисляю.\n"
+                f"Баланс бонусов: {res['new_balance']:.0f}."
+            )
+            return
 
-        bonus_balance = float(client.get("bonus_balance", 0) or 0)
-        bonus_delta = 100.0
-        new_balance = bonus_balance + bonus_delta
-
-        client["bonus_balance"] = new_balance
-        update_client_row(client)
-
-        # логируем как отдельный тип операции
-        log_transaction(phone, "promo_review", 0, bonus_delta, "Бонус за отзыв на Яндекс.Картах")
+        bonus_delta = res["bonus_delta"]
+        new_balance = res["new_balance"]
 
         await query.message.reply_text(
             f"🎁 Начислено +{bonus_delta:.0f} бонусов за отзыв.\n"
@@ -602,7 +4385,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         # Уведомление клиенту, если привязан
-        user_ids = get_user_ids_by_phone(phone)
+        user_ids = res["user_ids"]
         if user_ids:
             now = datetime.now()
             ts_str = now.strftime("%d.%m в %H:%M")
@@ -610,11 +4393,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"{ts_str} вам начислено +{bonus_delta:.0f} бонусов в Фото Химки за отзыв.\n"
                 f"Текущий баланс: {new_balance:.0f} бонусов."
             )
-            for uid in user_ids:
-                try:
-                    await context.bot.send_message(chat_id=uid, text=notify_text)
-                except Exception as e:
-                    print(f"notify promo_review error to {uid}: {e}")
+            NOTIFIER.notify_many(user_ids, notify_text, tag="notify promo_review")
 
         context.user_data["admin_step"] = "menu"
         return
@@ -639,54 +4418,73 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
 
+    # Админ прислал выгрузку кассы после /import
+    if (
+        user.id in ADMIN_IDS
+        and context.user_data.get("admin_step") == "await_pos_csv"
+        and update.message.document
+    ):
+        file_id = update.message.document.file_id
+        pos_file = await download_pos_file(context.bot, file_id)
+        try:
+            report = await STORAGE.run(import_pos_sales, pos_file, timeout=600)
+        except UnicodeDecodeError:  # декодируется по ходу разбора
+            await update.message.reply_text("Файл не в UTF-8. Сохраните выгрузку как CSV (UTF-8) и пришлите снова.")
+            return
+        if not report["sales"]:
+            await update.message.reply_text(format_pos_report(report, applied=False) + "\n\nПроводить нечего.")
+            context.user_data["admin_step"] = "await_phone"
+            return
+        context.user_data["pos_file_id"] = file_id
+        context.user_data["admin_step"] = "await_pos_confirm"
+        keyboard = [
+            [InlineKeyboardButton("✅ Провести", callback_data="pos_import_confirm")],
+            [InlineKeyboardButton("✖️ Отмена", callback_data="pos_import_cancel")],
+        ]
+        await update.message.reply_text(
+            format_pos_report(report, applied=False),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+        return
+
+    message = update.message
+
+    # Очередная часть альбома, первая часть которого уже принята
+    if message.media_group_id and ALBUMS.add(message):
+        return
+
     # Если ждём именно скрин отзыва
     if context.user_data.get("awaiting_review_screenshot"):
         context.user_data["awaiting_review_screenshot"] = False
-
         phone = context.user_data.get("client_phone", "неизвестен")
-        caption_admin = (
+        caption = (
             "Скрин отзыва от клиента.\n"
             f"Телефон: {phone}\n"
             f"Telegram: @{user.username or '—'} (id {user.id})"
         )
-
-        # Пересылаем сообщение (фото/документ) админу
-        for admin_id in ADMIN_IDS:
-            try:
-                forwarded = await update.effective_message.forward(chat_id=admin_id)
-                # можно дополнительно отправить текстом подпись
-                await context.bot.send_message(chat_id=admin_id, text=caption_admin)
-            except Exception as e:
-                print(f"forward review screenshot error to {admin_id}: {e}")
-
-        await update.message.reply_text(
+        reply = (
             "Спасибо за отзыв! 🙌\n"
             "Как только он появится на Яндекс.Картах, мы это проверим и начислим +100 бонусов на Ваш счёт."
         )
-        return
 
     # Если ждём обычный файл для мастера
-    if context.user_data.get("awaiting_file_for_admin"):
+    elif context.user_data.get("awaiting_file_for_admin"):
         context.user_data["awaiting_file_for_admin"] = False
-
         caption = f"Файл от клиента @{user.username or user.id} из бота лояльности."
+        reply = "Файл отправлен администратору. Мы свяжемся с Вами при необходимости."
 
-        for admin_id in ADMIN_IDS:
-            try:
-                await update.effective_message.forward(chat_id=admin_id)
-                await context.bot.send_message(chat_id=admin_id, text=caption)
-            except Exception as e:
-                print(f"forward file error to {admin_id}: {e}")
-
-        await update.message.reply_text(
-            "Файл отправлен администратору. Мы свяжемся с Вами при необходимости."
-        )
+    else:
+        # Если файл пришёл вне ожидаемого сценария — подсказываем, на альбом один раз
+        if ALBUMS.reply_once(message):
+            await update.message.reply_text(
+                "Если вы хотите отправить файл мастеру, нажмите кнопку «Отправить файл» в личном кабинете."
+            )
         return
 
-    # Если файл пришёл вне ожидаемого сценария — можно либо игнорировать, либо что-то ответить
-    await update.message.reply_text(
-        "Если вы хотите отправить файл мастеру, нажмите кнопку «Отправить файл» в личном кабинете."
-    )
+    if message.media_group_id:
+        ALBUMS.start(message, deliver_client_files, bot=context.bot, caption=caption, reply=reply)
+        return
+    await deliver_client_files([message], context.bot, caption, reply)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текстовых сообщений (телефон, суммы и т.д.)."""
@@ -700,23 +4498,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 1) Клиент вводит телефон для личного кабинета
     if context.user_data.get("awaiting_phone_for_cabinet"):
+        phone = normalize_phone(text)
+        if phone is None:
+            await update.message.reply_text(
+                "Не получилось распознать номер. Отправьте телефон в формате +7 999 123-45-67."
+            )
+            return
         context.user_data["awaiting_phone_for_cabinet"] = False
-        phone = text  # сюда можно потом добавить нормализацию
 
-        init_gs()
-        client = find_client_by_phone(phone)
-        if not client:
-            client = upsert_client(phone, user.full_name or "")
-
-        # актуализируем уровень/процент, если что-то поменялось
-        turnover = float(client.get("turnover", 0) or 0)
-        level, _ = calc_level_and_rate(turnover)
-        if client.get("level") != level:
-            client["level"] = level
-            update_client_row(client)
-
-        # ПРИВЯЗЫВАЕМ user_id ↔ phone
-        link_user_to_phone(user, phone)
+        client = await STORAGE.run(load_cabinet_by_phone, user, phone)
         context.user_data["client_phone"] = phone
 
         cabinet_text = format_client_cabinet(client, phone)
@@ -730,28 +4520,38 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("admin_mode"):
         step = context.user_data.get("admin_step")
 
+        # 2.0. Текст рассылки
+        if step == "await_broadcast_text":
+            context.user_data["broadcast_text"] = text
+            total = await STORAGE.run(count_linked_users, frozenset(get_broadcaster().blocked))
+            keyboard = [
+                [InlineKeyboardButton("✅ Отправить", callback_data="broadcast_confirm")],
+                [InlineKeyboardButton("✖️ Отмена", callback_data="broadcast_cancel")],
+            ]
+            await update.message.reply_text(
+                f"Сообщение получат {total} клиентов (без заблокировавших бота):\n\n{text}",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+            )
+            context.user_data["admin_step"] = "await_broadcast_confirm"
+            return
+
         # 2.1. Получаем телефон клиента
         if step == "await_phone":
-            phone = text.strip()
+            phone = normalize_phone(text)
+            if phone is None:
+                await update.message.reply_text("Не похоже на номер телефона. Введи номер клиента, например 89991234567.")
+                return
             context.user_data["admin_client_phone"] = phone
-            init_gs()
-            client = find_client_by_phone(phone)
-            if not client:
-                client = upsert_client(phone, "")
-
+            client = await STORAGE.run(load_client_for_admin, phone)
+            level = client_level(client)
             turnover = float(client.get("turnover", 0) or 0)
-            level, _ = calc_level_and_rate(turnover)
-            if client.get("level") != level:
-                client["level"] = level
-                update_client_row(client)
-
             bonus = float(client.get("bonus_balance", 0) or 0)
             name = client.get("name", "") or "Клиент"
 
             keyboard = [
                 [InlineKeyboardButton("➕ Покупка", callback_data="admin_purchase")],
                 [InlineKeyboardButton("➖ Списать бонусы", callback_data="admin_redeem")],
-                [InlineKeyboardButton("🎁 +100 бонусов (отзыв)", callback_data="admin_bonus_review")],
+                [InlineKeyboardButton("🎁 +100 бонусов (отзыв)", callback_data=f"admin_bonus_review:{phone}")],
             ]
 
             await update.message.reply_text(
@@ -783,27 +4583,23 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⚠️ Неверный формат суммы. Попробуйте ещё раз.")
                 return
 
-            init_gs()
-            client = find_client_by_phone(phone)
-            if not client:
+            op_id = f"m{update.message.chat_id}:{update.message.message_id}"
+            res = await STORAGE.run(apply_purchase, phone, amount, op_id=op_id)
+            if res is None:
                 await update.message.reply_text("Клиент не найден (возможно, ошибка номера).")
                 context.user_data["admin_step"] = "await_phone"
                 return
+            if res["duplicate"]:
+                await update.message.reply_text(
+                    "ℹ️ Эта покупка уже проведена, повторно не записываю.\n"
+                    f"Баланс бонусов: {res['new_balance']:.0f}."
+                )
+                context.user_data["admin_step"] = "menu"
+                return
 
-            turnover = float(client.get("turnover", 0) or 0)
-            bonus_balance = float(client.get("bonus_balance", 0) or 0)
-
-            new_turnover = turnover + amount
-            level, rate = calc_level_and_rate(new_turnover)
-            bonus_delta = round(amount * rate)
-            new_bonus_balance = bonus_balance + bonus_delta
-
-            client["turnover"] = new_turnover
-            client["bonus_balance"] = new_bonus_balance
-            client["level"] = level
-            update_client_row(client)
-
-            log_transaction(phone, "purchase", amount, bonus_delta, "Покупка в ателье")
+            bonus_delta = res["bonus_delta"]
+            new_bonus_balance = res["new_balance"]
+            level = res["level"]
 
             await update.message.reply_text(
                 f"✅ Покупка на {amount:.0f}₽ успешно добавлена.\n"
@@ -813,7 +4609,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
                     # Уведомляем клиента в личном кабинете, если он привязан
-            user_ids = get_user_ids_by_phone(phone)
+            user_ids = res["user_ids"]
             if user_ids:
                 # красивое время
                 now = datetime.now()
@@ -823,11 +4619,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Начислено бонусов: {bonus_delta:.0f}.\n"
                     f"Текущий баланс: {new_bonus_balance:.0f} бонусов."
                 )
-                for uid in user_ids:
-                    try:
-                        await context.bot.send_message(chat_id=uid, text=notify_text)
-                    except Exception as e:
-                        print(f"notify purchase error to {uid}: {e}")
+                NOTIFIER.notify_many(user_ids, notify_text, tag="notify purchase")
 
 
             context.user_data["admin_step"] = "menu"
@@ -849,26 +4641,28 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("⚠️ Неверное число. Попробуй ещё раз.")
                 return
 
-            init_gs()
-            client = find_client_by_phone(phone)
-            if not client:
+            op_id = f"m{update.message.chat_id}:{update.message.message_id}"
+            res = await STORAGE.run(apply_redeem, phone, redeem, op_id=op_id)
+            if res is None:
                 await update.message.reply_text("Клиент не найден (возможно, ошибка номера).")
                 context.user_data["admin_step"] = "await_phone"
                 return
+            if res.get("duplicate"):
+                await update.message.reply_text(
+                    "ℹ️ Это списание уже проведено, повторно не записываю.\n"
+                    f"Баланс бонусов: {res['new_balance']:.0f}."
+                )
+                context.user_data["admin_step"] = "menu"
+                return
 
-            bonus_balance = float(client.get("bonus_balance", 0) or 0)
-            if redeem > bonus_balance:
+            if not res["ok"]:
                 await update.message.reply_text(
                     f"Недостаточно бонусов для списания.\n"
-                    f"Текущий баланс: {bonus_balance:.0f}."
+                    f"Текущий баланс: {res['balance']:.0f}."
                 )
                 return
 
-            new_balance = bonus_balance - redeem
-            client["bonus_balance"] = new_balance
-            update_client_row(client)
-
-            log_transaction(phone, "redeem", 0, -redeem, "Списание бонусов")
+            new_balance = res["new_balance"]
 
             await update.message.reply_text(
                 f"🎁 Списано бонусов: {redeem:.0f}.\n"
@@ -876,7 +4670,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
                     # Уведомляем клиента о списании бонусов
-            user_ids = get_user_ids_by_phone(phone)
+            user_ids = res["user_ids"]
             if user_ids:
                 now = datetime.now()
                 ts_str = now.strftime("%d.%m в %H:%M")
@@ -884,11 +4678,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"{ts_str} в Фото Химки были списаны бонусы: {redeem:.0f}.\n"
                     f"Текущий баланс: {new_balance:.0f} бонусов."
                 )
-                for uid in user_ids:
-                    try:
-                        await context.bot.send_message(chat_id=uid, text=notify_text)
-                    except Exception as e:
-                        print(f"notify redeem error to {uid}: {e}")
+                NOTIFIER.notify_many(user_ids, notify_text, tag="notify redeem")
 
 
             context.user_data["admin_step"] = "menu"
@@ -902,6 +4692,211 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Ошибки хендлеров (таймаут Sheets и т.п.): логируем и коротко отвечаем пользователю."""
+    print(f"handler error: {context.error!r}")
+    if isinstance(update, Update) and update.effective_message:
+        # до Python 3.11 asyncio.wait_for бросает asyncio.TimeoutError, не встроенный TimeoutError
+        if isinstance(context.error, (TimeoutError, asyncio.TimeoutError)):
+            # STORAGE.run перестал ждать, но запись в пуле могла уже начаться и дойти до таблицы
+            if update.effective_user and update.effective_user.id in ADMIN_IDS:
+                text = ("⚠️ Хранилище не ответило вовремя, результат операции неизвестен. "
+                        "Проверьте историю клиента, прежде чем повторять.")
+            else:
+                text = "⚠️ Хранилище не ответило вовремя. Проверьте баланс в кабинете через минуту."
+        elif isinstance(context.error, gspread.exceptions.APIError) and context.error.code in RETRY_STATUSES:
+            text = "⚠️ Google Таблица сейчас перегружена, операция не выполнена. Повторите через минуту."
+        else:
+            text = "⚠️ Не удалось выполнить операцию, попробуйте ещё раз через минуту."
+        try:
+            await update.effective_message.reply_text(text)
+        except Exception as e:
+            print(f"error reply failed: {e}")
+
+
+async def post_init(application: Application):
+    await NOTIFIER.start(application.bot)
+    get_broadcaster().resume(application.bot)  # незаконченная рассылка до рестарта
+
+
+async def post_stop(application: Application):
+    await NOTIFIER.stop()
+
+
+async def post_shutdown(application: Application):
+    # сначала дожидаемся операций в пуле (в том числе тех, чей хендлер уже ушёл по таймауту),
+    # и только потом закрываем хранилище — иначе их записи придут после финального flush
+    STORAGE.shutdown()
+    if BACKEND is not None:
+        BACKEND.close()  # дописываем отложенные изменения до остановки
+
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ===
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно (до UPDATES_CONCURRENCY хендлеров),
+    апдейты одного пользователя — строго по очереди, чтобы admin_step в handle_text не перепутался.
+    Админ дополнительно держит очередь телефона клиента, с которым работает: два админа
+    у кассы над одним клиентом проводят операции по одной.
+
+    Семафор базового класса ограничивает число ожидающих апдейтов (UPDATES_MAX_PENDING),
+    свой — число работающих: апдейт, ждущий своей очереди, слот работы не занимает.
+    """
+
+    def __init__(self, concurrency: int = UPDATES_CONCURRENCY, max_pending: int = UPDATES_MAX_PENDING):
+        super().__init__(max(max_pending, concurrency, 2))
+        self.concurrency = concurrency
+        self.application = None  # для user_data админов, см. bind()
+        self._running = None
+        self._queues: dict[str, list] = {}  # ключ -> [asyncio.Lock, сколько апдейтов держат/ждут]
+
+    def bind(self, application: Application):
+        self.application = application
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def _turn(self, key: str):
+        """Дождаться своей очереди по ключу (asyncio.Lock отдаёт очередь в порядке прихода)."""
+        entry = self._queues.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._queues[key]
+
+    async def _admin_phones(self, update: Update) -> list[str]:
+        """Телефоны клиентов, к которым относится апдейт админа."""
+        user = update.effective_user
+        if self.application is None or user.id not in ADMIN_IDS:
+            return []
+        user_data = self.application.user_data[user.id]
+        persistence = self.application.persistence
+        if persistence is not None and persistence.store_data.user_data:
+            # PTB подгрузит user_data только в process_update, уже после выбора блокировок
+            await persistence.refresh_user_data(user.id, user_data)
+        phones = set()
+        if user_data.get("admin_client_phone"):
+            phones.add(phone_key(user_data["admin_client_phone"]))
+        query = update.callback_query
+        if query is not None and query.data and query.data.startswith("admin_bonus_review:"):
+            phones.add(phone_key(query.data.split(":", 1)[1]))
+        message = update.message
+        if user_data.get("admin_step") == "await_phone" and message is not None and message.text:
+            phone = normalize_phone(message.text)
+            if phone:
+                phones.add(phone)
+        return sorted(phones)
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(self._turn(f"user:{user.id}"))
+            # телефон смотрим, уже дождавшись своей очереди: предыдущий апдейт админа мог его сменить
+            for phone in await self._admin_phones(update):
+                await stack.enter_async_context(self._turn(f"phone:{phone}"))
+            async with self._running:
+                await coroutine
+
+
+# === WEBHOOK-СЕРВЕР ===
+# Свой tornado-сервер вместо Application.run_webhook: на том же PORT нужен ещё и METRICS_PATH.
+
+class RecentIds:
+    """Ограниченное множество недавно виденных id с истечением по времени."""
+
+    def __init__(self, ttl: float = UPDATE_DEDUP_TTL, maxsize: int = UPDATE_DEDUP_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen: dict[int, float] = {}  # id -> когда забыть; порядок вставки = порядок истечения
+
+    def add(self, item_id: int) -> bool:
+        """Запомнить id. False — он уже был за последние ttl секунд."""
+        now = time.monotonic()
+        while self._seen:
+            oldest, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) < self.maxsize:
+                break
+            del self._seen[oldest]
+        if item_id in self._seen:
+            return False
+        self._seen[item_id] = now + self.ttl
+        return True
+
+
+SEEN_UPDATES = RecentIds()
+METRICS.describe("loyalty_telegram_duplicate_updates_total", "counter", "Webhook updates dropped as redeliveries")
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        update_id = data.get("update_id")
+        if update_id is not None and not SEEN_UPDATES.add(update_id):
+            METRICS.inc("loyalty_telegram_duplicate_updates_total")
+            self.set_status(200)  # повторная доставка: Telegram ждёт 200, второй раз не обрабатываем
+            return
+        update = Update.de_json(data, self.bot_app.bot)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(METRICS.render())
+
+
+async def serve_webhook(application: Application, url_path: str, webhook_url: str):
+    """Жизненный цикл как у run_webhook: initialize → post_init → start → ... → post_shutdown."""
+    web_app = tornado.web.Application([
+        (f"/{url_path}", TelegramWebhookHandler, {"bot_app": application}),
+        (METRICS_PATH, MetricsHandler),
+    ])
+    server = tornado.httpserver.HTTPServer(web_app)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    # только то, что разбирают хендлеры из main(): сообщения (команды, текст, файлы) и нажатия кнопок
+    await application.bot.set_webhook(webhook_url, allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY])
+    await application.start()
+    server.listen(PORT, "0.0.0.0")
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
 # === MAIN ===
 
 def main():
@@ -911,33 +4906,68 @@ def main():
     if not BASE_URL:
         raise RuntimeError("BASE_URL is not set in environment")
 
-    init_gs()
+    init_storage()
+
+    application = (
+        Application.builder()
+        .bot(TrackedBot(BOT_TOKEN))
+        .updater(None)
+        .concurrent_updates(OrderedUpdateProcessor())
+        .persistence(SqlitePersistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application.update_processor.bind(application)
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("reconcile", reconcile))
+    application.add_handler(CommandHandler("import", pos_import))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(MessageHandler(
         (filters.PHOTO | filters.Document.ALL | filters.VIDEO) & ~filters.COMMAND,
         handle_file,
     ))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_error_handler(on_error)
+
+    application.job_queue.run_repeating(
+        recompute_levels_job, interval=LEVELS_RECOMPUTE_INTERVAL, first=30, name="recompute_levels",
+    )
+    if BONUS_TTL_DAYS > 0:
+        application.job_queue.run_repeating(
+            expire_bonuses_job, interval=BONUS_EXPIRY_INTERVAL, first=60, name="bonus_expiry",
+        )
 
     # URL, по которому Telegram будет стучаться
     webhook_path = BOT_TOKEN  # можно любое, но токен — удобно
     webhook_url = f"{BASE_URL}/{webhook_path}"
 
     print("Starting loyalty bot with webhook...")
-    print(f"Listening on 0.0.0.0:{PORT}, webhook URL = {webhook_url}")
+    print(f"Listening on 0.0.0.0:{PORT}, webhook URL = {webhook_url}, metrics at {METRICS_PATH}")
 
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=webhook_path,
-        webhook_url=webhook_url,
-    )
+    asyncio.run(serve_webhook(application, webhook_path, webhook_url))
+
+
+def reconcile_cli(args: list[str]) -> int:
+    """python loyalty_bot.py reconcile [--fix] [--full] — сверка без запуска бота."""
+    report = Reconciler().run(fix="--fix" in args, full="--full" in args)
+    print(format_reconcile_report(report))
+    if BACKEND is not None:
+        BACKEND.close()
+    return 1 if report["clients_drift"] and not report["fixed"] else 0
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["reconcile"]:
+        sys.exit(reconcile_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ["merge-phones"]:
+        sys.exit(merge_phones_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ["import-pos"]:
+        sys.exit(import_pos_cli(sys.argv[2:]))
     main()
@@ -0,0 +1,49 @@
+"""Общие фикстуры: бот поверх fake_sheets, без Google и Telegram."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import loyalty_bot as lb  # noqa: E402
+from fake_sheets import CallLog, FakeClient  # noqa: E402
+
+TG_LINKS_HEADER = ["user_id", "username", "first_name", "phone", "linked_at"]
+
+
+@pytest.fixture
+def sheets(monkeypatch):
+    """start(clients, txs, links, partitions) — завести листы и поднять хранилище Sheets; возвращает таблицу.
+    partitions — {"2024-05": строки} для закрытых месяцев журнала (txs — старый лист transactions)."""
+    monkeypatch.setattr(lb, "STORAGE_BACKEND", "sheets")
+    monkeypatch.setattr(lb, "SNAPSHOT_INTERVAL", 0)
+    monkeypatch.setattr(lb, "WB_FLUSH_INTERVAL", 3600)
+    monkeypatch.setattr(lb, "SCHEDULER", lb.SheetsScheduler(
+        reads_per_min=10 ** 9, writes_per_min=10 ** 9, backoff_base=0, backoff_max=0,
+    ))
+    for name in ("BACKEND", "GSCLIENT", "GS_SHEET", "CLIENTS_WS", "TX_WS", "TG_LINKS_WS", "TX_PARTITIONS_WS"):
+        monkeypatch.setattr(lb, name, None)
+    lb.STATS.reset()
+    client = FakeClient(CallLog())
+
+    def start(clients=(), txs=(), links=(), partitions=None):
+        sheet = client.spreadsheet
+        sheet.add("clients", lb.CLIENT_COLUMNS, [list(r) for r in clients])
+        sheet.add("transactions", lb.TX_COLUMNS, [list(r) for r in txs])
+        catalog = []
+        for month, rows in (partitions or {}).items():
+            title = lb.tx_partition_title(month)
+            sheet.add(title, lb.TX_COLUMNS, [list(r) for r in rows])
+            catalog.append([title, month, f"{month}-01T00:00:00"])
+        sheet.add(lb.TX_PARTITIONS_TITLE, lb.TX_PARTITION_COLUMNS, catalog)
+        sheet.add("tg_links", TG_LINKS_HEADER, [list(r) for r in links])
+        lb.init_gs(client=client)
+        lb.init_storage()
+        return sheet
+
+    yield start
+    if lb.BACKEND is not None:
+        lb.BACKEND.close()
+    lb.STATS.reset()
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace as NS
+from unittest.mock import AsyncMock, MagicMock
+
+import loyalty_bot as lb
+
+CLIENT = NS(id=50, username="cli")
+
+
+def part(message_id, group="G"):
+    m = MagicMock()
+    m.chat_id, m.message_id, m.media_group_id = CLIENT.id, message_id, group
+    m.reply_text = AsyncMock()
+    return m
+
+
+async def send(message, context):
+    await lb.handle_file(NS(message=message, effective_user=CLIENT, effective_message=message), context)
+
+
+def test_album_outside_scenario_gets_one_hint(monkeypatch):
+    monkeypatch.setattr(lb, "ALBUMS", lb.AlbumCollector(0.01, late_window=0.05))
+    parts = [part(10), part(11), part(12)]
+    single = part(13, group=None)
+
+    async def scenario():
+        context = NS(user_data={}, bot=AsyncMock())
+        for m in parts + [single]:
+            await send(m, context)
+
+    asyncio.run(scenario())
+    assert [m.reply_text.await_count for m in parts] == [1, 0, 0]
+    assert single.reply_text.await_count == 1
+
+
+def test_late_parts_do_not_get_a_second_reply(monkeypatch):
+    monkeypatch.setattr(lb, "ADMIN_IDS", [1])
+    monkeypatch.setattr(lb, "ALBUMS", lb.AlbumCollector(0.01, late_window=0.05))
+    first, second, late, very_late = part(10), part(11), part(12), part(13)
+
+    async def scenario():
+        context = NS(user_data={"awaiting_file_for_admin": True}, bot=AsyncMock())
+        await send(first, context)
+        await send(second, context)
+        await asyncio.sleep(0.03)
+        await send(late, context)  # в пределах late_window — досылается админам
+        await asyncio.sleep(0.1)
+        await send(very_late, context)  # уже после late_window — просто молчим
+        return context.bot
+
+    bot = asyncio.run(scenario())
+    assert [c.kwargs["message_ids"] for c in bot.copy_messages.call_args_list] == [[10, 11], [12]]
+    assert [m.reply_text.await_count for m in (first, second, late, very_late)] == [1, 0, 0, 0]
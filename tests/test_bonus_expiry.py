@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, timedelta
+
+import loyalty_bot as lb
+
+CLIENTS = [["79990000001", "Анна", "2024-01-01", 3000, 300, "silver"]]
+TXS = [
+    ["79990000001", "purchase", 1000, 100, "2025-01-10T10:00:00", ""],
+    ["79990000001", "purchase", 1000, 100, "2025-06-10T10:00:00", ""],
+    ["79990000001", "redeem", 0, -50, "2025-07-01T10:00:00", ""],
+    ["79990000001", "purchase", 1000, 150, "2025-10-20T10:00:00", ""],
+]
+
+
+def test_fifo_expiry_after_partial_redeem(sheets, monkeypatch, tmp_path):
+    monkeypatch.setattr(lb, "BONUS_EXPIRY_SINCE", "2020-01-01")
+    sheets(clients=CLIENTS, txs=TXS)
+    path = str(tmp_path / "lots.json")
+
+    # списание 50 съело половину самой старой партии — сгорает только остаток
+    report = lb.BonusExpiry(path, ttl_days=365, notice_days=14).run("2026-01-11T00:00:00")
+    assert report["expired"] == [{"phone": "+79990000001", "amount": 50.0, "balance": 250.0}]
+    assert lb.find_client_by_phone("79990000001")["bonus_balance"] == 250
+    assert lb.load_history("79990000001", 1)[0]["type"] == "bonus_expire"
+
+    # после рестарта состояние поднимается из чекпоинта, сгоревшее второй раз не списывается
+    expiry = lb.BonusExpiry(path, ttl_days=365, notice_days=14)
+    assert expiry.run("2026-01-12T00:00:00")["expired"] == []
+    notices = expiry.run("2026-05-30T00:00:00")["notices"]
+    assert [(n["amount"], n["expires_at"]) for n in notices] == [(100.0, "2026-06-10T10:00:00")]
+    assert expiry.run("2026-05-31T00:00:00")["notices"] == []
+
+    assert expiry.run("2026-06-11T00:00:00")["expired"] == [
+        {"phone": "+79990000001", "amount": 100.0, "balance": 150.0},
+    ]
+    assert json.load(open(path))["lots"] == {"+79990000001": [["2026-10-20T10:00:00", 150.0]]}
+
+
+def test_expiry_never_takes_balance_below_zero(sheets, monkeypatch, tmp_path):
+    monkeypatch.setattr(lb, "BONUS_EXPIRY_SINCE", "2020-01-01")
+    sheets(clients=[["79990000002", "Борис", "2024-01-01", 1000, 20, "silver"]],
+           txs=[["79990000002", "promo_review", 0, 100, "2025-02-10T10:00:00", ""]])
+
+    report = lb.BonusExpiry(str(tmp_path / "lots.json"), 365, 14).run("2026-03-01T00:00:00")
+    assert report["expired"] == [{"phone": "+79990000002", "amount": 20.0, "balance": 0.0}]
+
+
+def test_first_run_clamps_old_accruals_to_rollout_date(sheets, monkeypatch, tmp_path):
+    monkeypatch.setattr(lb, "BONUS_EXPIRY_SINCE", "")
+    sheets(clients=CLIENTS, txs=TXS)
+    path = str(tmp_path / "lots.json")
+    today = datetime.utcnow().date()
+
+    report = lb.BonusExpiry(path, 365, 14).run()
+    assert report == {"expired": [], "notices": []}
+    state = json.load(open(path))
+    assert state["since"] == today.isoformat()
+    deadline = (datetime.combine(today, datetime.min.time()) + timedelta(days=365)).isoformat()
+    assert [lot[0] for lot in state["lots"]["+79990000001"]] == [deadline, deadline, deadline]
+
+    # дата включения запоминается: следующий запуск отсчитывает от неё же
+    assert lb.BonusExpiry(path, 365, 14).run((today + timedelta(days=1)).isoformat() + "T00:00:00")["expired"] == []
+    assert json.load(open(path))["since"] == today.isoformat()
@@ -0,0 +1,27 @@
+import pytest
+
+import loyalty_bot as lb
+
+LINKS = [
+    [501, "a", "A", "79990000001", "2024-01-01"],
+    [502, "b", "B", "79990000002", "2024-01-01"],
+    [503, "c", "C", "", "2024-01-01"],  # отвязан
+]
+
+
+@pytest.mark.parametrize("backend", ["sheets", "sqlite"])
+def test_recipient_count_excludes_blocked(sheets, monkeypatch, tmp_path, backend):
+    if backend == "sqlite":
+        monkeypatch.setattr(lb, "STORAGE_BACKEND", "sqlite")
+        monkeypatch.setattr(lb, "SQLITE_PATH", str(tmp_path / "x.db"))
+        monkeypatch.setattr(lb, "SQLITE_MIRROR_SHEETS", True)  # первичная загрузка из таблицы
+    sheets(links=LINKS)
+    assert lb.count_linked_users() == 2
+    assert lb.count_linked_users(frozenset({502, 503, 999})) == 1
+
+
+def test_progress_counts_match_total(tmp_path):
+    broadcaster = lb.Broadcaster(str(tmp_path / "state.json"), str(tmp_path / "blocked.json"))
+    broadcaster.state = {"status": "done", "total": 3, "sent": 2, "failed": 0, "blocked": 1, "skipped": 4}
+    text = broadcaster.progress_text()
+    assert "3 из 3" in text and "пропущено заблокировавших раньше: 4" in text
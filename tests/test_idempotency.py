@@ -0,0 +1,47 @@
+import pytest
+
+import loyalty_bot as lb
+
+CLIENTS = [["79990000001", "Анна", "2024-01-01", 1000, 500, "silver"]]
+# старая история клиента лежит в legacy-листе transactions
+OLD_TXS = [
+    ["79990000001", "purchase", 100, 5, "2023-0%d-01T10:00:00" % m, "Покупка в ателье [op:m1:%d]" % m]
+    for m in range(1, 6)
+]
+
+
+def test_repeated_operations_are_applied_once(sheets):
+    sheets(clients=CLIENTS)
+    first = lb.apply_purchase("79990000001", 1000, op_id="m1:10")
+    again = lb.apply_purchase("79990000001", 1000, op_id="m1:10")
+    assert not first["duplicate"] and again["duplicate"]
+    assert again["bonus_delta"] == first["bonus_delta"]
+
+    assert not lb.apply_redeem("79990000001", 30, op_id="m1:11")["duplicate"]
+    assert lb.apply_redeem("79990000001", 30, op_id="m1:11")["duplicate"]
+    assert not lb.apply_review_bonus("79990000001", op_id="q1:12")["duplicate"]
+    assert lb.apply_review_bonus("79990000001", op_id="q1:12")["duplicate"]
+
+    assert [t["type"] for t in lb.load_history("79990000001", 10)] == ["promo_review", "redeem", "purchase"]
+    assert lb.find_client_by_phone("79990000001")["bonus_balance"] == first["new_balance"] - 30 + 100
+
+
+def test_lookup_stays_in_memory(sheets, monkeypatch):
+    monkeypatch.setattr(lb, "IDEMPOTENCY_LOOKBACK", 3)
+    sheet = sheets(clients=CLIENTS, txs=OLD_TXS)
+    lb.apply_purchase("79990000001", 1000, op_id="m1:10")
+    sheet.log.reset()
+
+    assert lb.apply_purchase("79990000001", 1000, op_id="m1:10")["duplicate"]
+    assert lb.apply_redeem("79990000001", 5, op_id="m1:4")["duplicate"]
+    # ключ старше IDEMPOTENCY_LOOKBACK операций уже вне окна проверки
+    assert not lb.apply_purchase("79990000001", 100, op_id="m1:1")["duplicate"]
+    assert not [c for c in sheet.log.calls if c.op not in ("append_rows", "batch_update")]
+
+
+@pytest.mark.parametrize("op_id", [None, ""])
+def test_operations_without_key_are_never_duplicates(sheets, op_id):
+    sheets(clients=CLIENTS)
+    assert not lb.apply_review_bonus("79990000001", op_id=op_id)["duplicate"]
+    assert not lb.apply_review_bonus("79990000001", op_id=op_id)["duplicate"]
+    assert lb.find_client_by_phone("79990000001")["bonus_balance"] == 700
@@ -0,0 +1,26 @@
+import loyalty_bot as lb
+
+CLIENTS = [
+    ["79990000001", "Анна", "2024-01-01", 15000, 50, "silver"],
+    ["79990000002", "Борис", "2024-01-01", 1000, 50, "platinum"],
+]
+
+
+def test_recompute_levels_writes_through_write_behind(sheets):
+    sheet = sheets(clients=CLIENTS)
+    assert lb.recompute_levels() == 2
+    assert lb.find_client_by_phone("79990000001")["level"] == lb.level_tier(15000)["level"]
+    lb.flush_writes()
+    assert [r[5] for r in sheet.sheets["clients"].data[1:]] == [lb.level_tier(15000)["level"], "silver"]
+    assert lb.recompute_levels() == 0
+
+
+def test_update_levels_skips_clients_whose_turnover_moved(sheets):
+    sheets(clients=CLIENTS)
+    client = lb.find_client_by_phone("79990000001")
+    client["turnover"] = 60000  # покупка прошла после снимка recompute_levels
+    client["level"] = lb.level_tier(60000)["level"]
+    lb.update_client_row(client)
+
+    assert lb.BACKEND.update_levels({"+79990000001": (15000.0, lb.level_tier(15000)["level"])}) == 0
+    assert lb.find_client_by_phone("79990000001")["level"] == lb.level_tier(60000)["level"]
@@ -0,0 +1,53 @@
+import loyalty_bot as lb
+
+PHONE = "79990000001"
+
+
+def tx(month, day, comment):
+    return [PHONE, "purchase", 100, 5, f"{month}-{day:02d}T10:00:00", comment]
+
+
+def start(sheets):
+    return sheets(
+        clients=[[PHONE, "Анна", "2024-01-01", 300, 15, "silver"]],
+        txs=[tx("2023-12", 1, "legacy")],
+        partitions={"2024-01": [tx("2024-01", 1, "jan-1"), tx("2024-01", 2, "jan-2")]},
+    )
+
+
+def test_new_month_starts_a_partition(sheets):
+    sheet = start(sheets)
+    lb.BACKEND.log_transaction(tx("2024-01", 3, "jan-3"))
+    lb.BACKEND.log_transaction(tx("2024-02", 1, "feb-1"))
+    lb.flush_writes()
+
+    assert lb.BACKEND.txs.titles() == ["transactions", "transactions_2024_01", "transactions_2024_02"]
+    assert [r[:2] for r in sheet.sheets[lb.TX_PARTITIONS_TITLE].data[1:]] == [
+        ["transactions_2024_01", "2024-01"], ["transactions_2024_02", "2024-02"],
+    ]
+    assert [r[5] for r in sheet.sheets["transactions_2024_01"].data[1:]] == ["jan-1", "jan-2", "jan-3"]
+    assert [r[5] for r in sheet.sheets["transactions_2024_02"].data[1:]] == ["feb-1"]
+
+
+def test_history_spans_partitions(sheets):
+    start(sheets)
+    lb.BACKEND.log_transaction(tx("2024-02", 1, "feb-1"))
+
+    history = [t["comment"] for t in lb.load_history(PHONE, 10)]
+    assert history == ["feb-1", "jan-2", "jan-1", "legacy"]
+    assert [t["comment"] for t in lb.load_history(PHONE, 2, offset=1)] == ["jan-2", "jan-1"]
+    assert [t["comment"] for t in lb.load_history(PHONE, 5, offset=3)] == ["legacy"]
+
+
+def test_closed_months_are_read_once(sheets):
+    sheet = start(sheets)
+    lb.BACKEND.log_transaction(tx("2024-02", 1, "feb-1"))
+    lb.flush_writes()
+    lb.load_history(PHONE, 10)
+
+    sheet.log.reset()
+    lb.load_history(PHONE, 10)
+    lb.BACKEND.log_transaction(tx("2024-02", 2, "feb-2"))
+    assert [t["comment"] for t in lb.load_history(PHONE, 1)] == ["feb-2"]
+    closed = {"transactions", "transactions_2024_01"}
+    assert [c for c in sheet.log.calls if c.worksheet in closed] == []
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application
+
+import loyalty_bot as lb
+
+ADMIN = 42
+
+
+def admin_message(text):
+    user = User(ADMIN, "Админ", False)
+    return Update(1, message=Message(1, datetime.now(), Chat(ADMIN, Chat.PRIVATE), from_user=user, text=text))
+
+
+def test_user_data_round_trip(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        p = lb.SqlitePersistence(path)
+        data = {}
+        await p.refresh_user_data(1, data)
+        data.update(admin_step="await_purchase_sum", admin_client_phone="79990000001", obj=object())
+        await p.update_user_data(1, data)
+        data["admin_step"] = "await_phone"
+        del data["admin_client_phone"]
+        await p.update_user_data(1, data)
+        await p.flush()
+
+        loaded = {}
+        await lb.SqlitePersistence(path).refresh_user_data(1, loaded)
+        return loaded
+
+    assert asyncio.run(scenario()) == {"admin_step": "await_phone"}  # несериализуемое — только в памяти
+
+
+def test_admin_phone_is_loaded_before_locking(tmp_path, monkeypatch):
+    monkeypatch.setattr(lb, "ADMIN_IDS", [ADMIN])
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        saved = lb.SqlitePersistence(path)
+        await saved.update_user_data(ADMIN, {"admin_client_phone": "79990000001", "admin_step": "menu"})
+
+        # после рестарта user_data админа ещё не загружен: его телефон всё равно должен попасть в блокировки
+        processor = lb.OrderedUpdateProcessor()
+        app = Application.builder().token("1:x").updater(None).persistence(lb.SqlitePersistence(path)).build()
+        processor.bind(app)
+        return await processor._admin_phones(admin_message("покупка"))
+
+    assert asyncio.run(scenario()) == [lb.phone_key("79990000001")]
@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import loyalty_bot as lb
+
+CLIENTS = [["79990000001", "Анна", "2024-01-01", 0, 0, "silver"]]
+
+
+def acquired_elsewhere(lock) -> bool:
+    """Удалось ли взять lock из другого потока (RLock своего потока не показателен)."""
+    result = []
+
+    def probe():
+        ok = lock.acquire(timeout=0.05)
+        if ok:
+            lock.release()
+        result.append(ok)
+
+    t = threading.Thread(target=probe)
+    t.start()
+    t.join()
+    return result[0]
+
+
+def test_same_phone_in_any_format_shares_a_stripe():
+    locks = lb.StripedLocks(64)
+    assert locks.hold("89990000001") is locks.hold("+7 (999) 000-00-01") is locks.hold("79990000001")
+
+
+def test_concurrent_operations_on_one_client_are_serialized(sheets, monkeypatch):
+    sheets(clients=CLIENTS)
+    find_operation = lb.find_operation
+
+    def slow_find_operation(*args):
+        time.sleep(0.001)  # расширяем окно между чтением клиента и записью
+        return find_operation(*args)
+
+    monkeypatch.setattr(lb, "find_operation", slow_find_operation)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: lb.apply_review_bonus("79990000001", bonus_delta=10), range(40)))
+    assert lb.find_client_by_phone("79990000001")["bonus_balance"] == 400
+    assert len(lb.load_history("79990000001", 100)) == 40
+
+
+def test_other_stripes_stay_free():
+    locks = lb.StripedLocks(64)
+    phones = [f"7999000{i:04d}" for i in range(200)]
+    a = phones[0]
+    b = next(p for p in phones if locks.hold(p) is not locks.hold(a))
+    with locks.hold(a):
+        assert not acquired_elsewhere(locks.hold(a))
+        assert acquired_elsewhere(locks.hold(b))
+
+
+def test_hold_many_in_any_order_does_not_deadlock():
+    locks = lb.StripedLocks(4)
+    phones = [f"7999000{i:04d}" for i in range(8)]
+    errors = []
+
+    def worker(keys):
+        try:
+            for _ in range(200):
+                with locks.hold_many(keys):
+                    pass
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(keys,)) for keys in (phones, phones[::-1])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert not any(t.is_alive() for t in threads) and not errors
+
+
+def test_hold_all_blocks_every_phone():
+    locks = lb.StripedLocks(8)
+    with locks.hold_all():
+        assert not any(acquired_elsewhere(locks.hold(f"7999000{i:04d}")) for i in range(20))
+    assert acquired_elsewhere(locks.hold("79990000001"))
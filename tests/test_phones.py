@@ -0,0 +1,75 @@
+import pytest
+
+import loyalty_bot as lb
+
+
+@pytest.mark.parametrize("raw", [
+    "+79991234567", "79991234567", "89991234567", "9991234567",
+    "8 (999) 123-45-67", "+7 999 123 45 67", 79991234567, "79991234567.0",
+])
+def test_normalize_phone_russian_forms(raw):
+    assert lb.normalize_phone(raw) == "+79991234567"
+
+
+@pytest.mark.parametrize("raw", ["", "bad", "12345", "1234567890123456"])
+def test_normalize_phone_rejects_garbage(raw):
+    assert lb.normalize_phone(raw) is None
+
+
+def test_normalize_phone_keeps_foreign_e164():
+    assert lb.normalize_phone("+375 29 123-45-67") == "+375291234567"
+
+
+def test_phone_key_falls_back_to_raw_text():
+    assert lb.phone_key(" 89991234567 ") == "+79991234567"
+    assert lb.phone_key(" abc ") == "abc"
+
+
+def test_phone_variants_cover_legacy_spellings():
+    variants = lb.phone_variants("8 999 123-45-67")
+    assert variants[0] == "+79991234567"
+    assert set(variants) == {"+79991234567", "79991234567", "89991234567", "9991234567", "8 999 123-45-67"}
+
+
+def test_merge_client_records_sums_totals():
+    merged = lb.merge_client_records([
+        {"phone": "89991234567", "name": "", "created_at": "2024-03-01", "turnover": 40000, "bonus_balance": 100},
+        {"phone": "+79991234567", "name": "Анна", "created_at": "2023-05-01", "turnover": "15000", "bonus_balance": ""},
+    ])
+    assert merged == {
+        "phone": "+79991234567",
+        "name": "Анна",
+        "created_at": "2023-05-01",
+        "turnover": 55000.0,
+        "bonus_balance": 100.0,
+        "level": lb.calc_level_and_rate(55000.0)[0],
+    }
+
+
+def test_merge_duplicate_phones_on_sheets(sheets):
+    sheet = sheets(
+        clients=[
+            ["89991234567", "Анна", "2024-01-01", 1000, 50, "silver"],
+            ["79990000001", "Борис", "2024-01-01", 500, 10, "silver"],
+            ["+79991234567", "", "2023-01-01", 2000, 70, "silver"],
+        ],
+        txs=[["89991234567", "purchase", 1000, 50, "2024-01-01T10:00:00", ""]],
+        links=[[501, "anna", "Анна", "9991234567", "2024-01-01"]],
+    )
+
+    report = lb.merge_duplicate_phones()
+    assert report == {
+        "duplicates": [["89991234567", "+79991234567"]],
+        "clients_fixed": 2,
+        "tx_fixed": 1,
+        "links_fixed": 1,
+    }
+    assert sheet.sheets["clients"].data[1][0] == "89991234567"  # без apply ничего не записано
+
+    lb.merge_duplicate_phones(apply=True)
+    client = lb.find_client_by_phone("8 999 123-45-67")
+    assert (client["turnover"], client["bonus_balance"], client["created_at"]) == (3000, 120, "2023-01-01")
+    assert lb.find_client_by_phone("79990000001")["phone"] == "+79990000001"
+    assert sheet.sheets["transactions"].data[1][0] == "+79991234567"
+    assert lb.get_phone_by_user_id(501) == "+79991234567"
+    assert lb.merge_duplicate_phones()["duplicates"] == []
@@ -0,0 +1,72 @@
+import io
+
+import loyalty_bot as lb
+
+CLIENTS = [["79990000001", "Анна", "2024-01-01", 1000, 50, "silver"]]
+
+
+def sales(text):
+    return list(lb.iter_pos_sales(io.StringIO(text, newline="")))
+
+
+def test_semicolon_header_with_decimal_comma():
+    rows = sales("Телефон;Сумма;Дата;Чек\n8 999 000-00-01;1 234,50;01.10.2026 12:00;A1\n")
+    assert rows == [(2, {"phone": "+79990000001", "amount": 1234.5, "ts": "2026-10-01T09:00:00", "ref": "A1"}, None)]
+
+
+def test_decimal_comma_without_header_prefers_semicolon():
+    rows = sales("79990000001;1234,50;01.10.2026\n79990000002;99,9;01.10.2026\n")
+    assert [(n, s["amount"]) for n, s, _ in rows] == [(1, 1234.5), (2, 99.9)]
+
+
+def test_quoted_decimal_comma_in_comma_file():
+    rows = sales('phone,amount,ref\n79990000001,"1234,50",A1\n')
+    assert rows[0][1]["amount"] == 1234.5
+
+
+def test_configured_delimiter_wins(monkeypatch):
+    monkeypatch.setattr(lb, "POS_CSV_DELIMITER", "\t")
+    rows = sales("79990000001\t12,5\t\tA;1\n")
+    assert (rows[0][1]["amount"], rows[0][1]["ref"]) == (12.5, "A;1")
+
+
+def test_bad_lines_are_reported_not_imported():
+    rows = sales("Телефон;Сумма\nbad;100\n79990000001;abc\n79990000001;0\n")
+    assert [(n, e) for n, _, e in rows] == [(2, "телефон 'bad'"), (3, "сумма 'abc'"), (4, "сумма '0'")]
+
+
+def test_duplicate_refs_are_applied_once(sheets):
+    sheet = sheets(clients=CLIENTS)
+    csv_text = (
+        "Телефон;Сумма;Дата;Чек\n"
+        "79990000001;1000,00;01.10.2026 12:00;A1\n"
+        "89990000001;1000,00;01.10.2026 12:00;A1\n"  # тот же чек второй строкой
+        "79990000002;500;01.10.2026 13:00;\n"
+        "79990000002;500;01.10.2026 13:00;\n"  # две одинаковые продажи без номера — два чека
+    )
+
+    dry = lb.import_pos_sales(io.StringIO(csv_text, newline=""))
+    assert (dry["sales"], dry["duplicates"], dry["new_clients"]) == (3, 1, 1)
+    assert lb.find_client_by_phone("79990000002") is None  # проверка ничего не пишет
+
+    report = lb.import_pos_sales(io.StringIO(csv_text, newline=""), apply=True)
+    lb.flush_writes()
+    assert (report["sales"], report["duplicates"], report["amount"]) == (3, 1, 2000.0)
+    assert lb.find_client_by_phone("79990000001")["turnover"] == 2000
+    assert lb.find_client_by_phone("79990000002")["turnover"] == 1000
+    assert len(sheet.sheets[lb.POS_IMPORTS_TITLE].data) == 1 + 3
+
+    again = lb.import_pos_sales(io.StringIO(csv_text, newline=""), apply=True)
+    assert (again["sales"], again["duplicates"]) == (0, 4)
+    assert lb.find_client_by_phone("79990000001")["turnover"] == 2000
+
+
+def test_refs_are_registered_before_journal_rows(sheets, monkeypatch):
+    sheets(clients=CLIENTS)
+    pos_ws = lb.BACKEND.pos_imports_ws
+    calls = []
+    monkeypatch.setattr(pos_ws, "append_rows", lambda rows, **kw: calls.append("refs"))
+    monkeypatch.setattr(lb.BACKEND.txs, "append_many", lambda rows: calls.append("journal"))
+
+    lb.import_pos_sales(["79990000001;100;;A1\n"], apply=True)
+    assert calls == ["refs", "journal"]
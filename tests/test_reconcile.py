@@ -0,0 +1,52 @@
+import json
+
+import loyalty_bot as lb
+
+CLIENTS = [
+    ["79990000001", "Анна", "2024-01-01", 2000, 100, "silver"],
+    ["79990000002", "Борис", "2024-01-01", 999, 0, "silver"],
+]
+TXS = [
+    ["79990000001", "purchase", 1000, 50, "2025-01-10T10:00:00", ""],
+    ["89990000001", "purchase", 1000, 50, "2025-02-10T10:00:00", ""],
+    ["79990000002", "promo_review", 0, 100, "2025-02-11T10:00:00", ""],
+]
+
+
+def test_drift_report_and_fix(sheets, tmp_path):
+    sheet = sheets(clients=CLIENTS, txs=TXS)
+    reconciler = lb.Reconciler(str(tmp_path / "rc.json"), page_size=2)
+
+    report = reconciler.run()
+    assert report["rows"] == 3 and report["fixed"] == 0
+    assert [(d["client"]["phone"], d["expected_turnover"], d["expected_bonus"]) for d in report["clients_drift"]] == [
+        ("79990000002", 0.0, 100.0),
+    ]
+
+    sheet.log.reset()
+    report = reconciler.run(fix=True)
+    assert report["fixed"] == 1
+    # клиентов правим одним batch_update отложенной записи, а не отдельными запросами
+    assert [c.op for c in sheet.log.calls if c.worksheet == "clients"] == ["batch_update"]
+    assert sheet.sheets["clients"].data[2][3:5] == [0.0, 100.0]
+    assert reconciler.run()["clients_drift"] == []
+
+
+def test_checkpoint_resumes_after_cursor(sheets, tmp_path):
+    sheet = sheets(clients=CLIENTS, txs=TXS)
+    path = str(tmp_path / "rc.json")
+    lb.Reconciler(path, page_size=2).run()
+    assert json.load(open(path))["aggregates"]["+79990000001"] == [2000.0, 100.0]
+
+    lb.apply_purchase("79990000001", 1000)
+    lb.flush_writes()
+    sheet.log.reset()
+    report = lb.Reconciler(path, page_size=2).run()  # как после рестарта
+    assert report["rows"] == 4
+    assert report["clients_drift"][0]["client"]["phone"] == "79990000002"
+    assert len(report["clients_drift"]) == 1
+    # прочитаны только строки после курсора, а не весь журнал
+    assert sum(c.rows for c in sheet.log.calls if c.op == "get") == 1
+
+    full = lb.Reconciler(path, page_size=2).run(full=True)
+    assert full["rows"] == 4 and full["clients_drift"] == report["clients_drift"]
@@ -0,0 +1,19 @@
+import loyalty_bot as lb
+
+
+def test_token_bucket_respects_sliding_minute(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(lb.time, "monotonic", lambda: clock[0])
+    bucket = lb.TokenBucket(60, burst_seconds=5)  # после простоя: ведро полное
+
+    sent = []
+    while clock[0] < 1180:
+        bucket.refill()
+        while bucket.tokens >= 1:
+            bucket.tokens -= 1
+            sent.append(clock[0])
+        clock[0] += 0.1
+
+    assert sum(1 for t in sent if t < 1001) == 5  # разом — только burst, а не минутная квота
+    worst = max(sum(1 for t in sent if start <= t < start + 60) for start in sent)
+    assert worst <= 60
@@ -0,0 +1,105 @@
+import asyncio
+import sqlite3
+import threading
+from datetime import datetime
+
+import gspread
+import pytest
+
+import loyalty_bot as lb
+from fake_sheets import _FakeResponse
+
+CLIENTS = [
+    ["79990000001", "Анна", "2024-01-01", 1000, 50, "silver"],
+    ["79990000002", "Борис", "2024-01-01", 1000, 50, "silver"],
+]
+
+
+def hot_partition(sheet):
+    return sheet.sheets[lb.tx_partition_title(datetime.utcnow().strftime("%Y-%m"))]
+
+
+def api_error(status):
+    return gspread.exceptions.APIError(_FakeResponse(status, "error"))
+
+
+def test_updates_merge_until_flush(sheets):
+    sheet = sheets(clients=CLIENTS)
+    lb.apply_purchase("79990000001", 1000)
+    lb.apply_redeem("79990000001", 30)
+    lb.apply_review_bonus("79990000002")
+    assert sheet.sheets["clients"].data[1][4] == 50  # пока ничего не отправлено
+
+    sheet.log.reset()
+    lb.flush_writes()
+    assert sorted((c.worksheet, c.op) for c in sheet.log.calls) == [
+        ("clients", "batch_update"), (hot_partition(sheet).title, "append_rows"),
+    ]
+    anna = lb.find_client_by_phone("79990000001")
+    assert sheet.sheets["clients"].data[1][3:5] == [anna["turnover"], anna["bonus_balance"]]
+    assert [r[1] for r in hot_partition(sheet).data[1:]] == ["purchase", "redeem", "promo_review"]
+    assert lb.BACKEND.writer.sinks and all(s.pending_count() == 0 for s in lb.BACKEND.writer.sinks)
+
+
+def test_transient_error_keeps_rows_queued(sheets, monkeypatch):
+    sheet = sheets(clients=CLIENTS)
+    ws = sheet.sheets["clients"]
+    lb.apply_review_bonus("79990000001")
+    original = ws.batch_update
+    monkeypatch.setattr(ws, "batch_update", lambda *a, **kw: (_ for _ in ()).throw(api_error(503)))
+    lb.BACKEND.writer.flush()  # ошибку WriteBehind только логирует
+    assert lb.BACKEND.clients.pending_count() == 1
+
+    monkeypatch.setattr(ws, "batch_update", original)
+    lb.flush_writes()
+    assert ws.data[1][4] == 150
+
+
+def test_refused_rows_are_dropped(sheets, monkeypatch):
+    sheet = sheets(clients=CLIENTS)
+    lb.apply_review_bonus("79990000001")
+    monkeypatch.setattr(sheet.sheets["clients"], "batch_update",
+                        lambda *a, **kw: (_ for _ in ()).throw(api_error(400)))
+    monkeypatch.setattr(hot_partition(sheet), "append_rows",
+                        lambda *a, **kw: (_ for _ in ()).throw(api_error(403)))
+    lb.BACKEND.writer.flush()
+
+    assert lb.BACKEND.clients.pending_count() == 0
+    assert lb.BACKEND.txs.flush_pending() is None and lb.load_history("79990000001", 5) == []
+    assert lb.find_client_by_phone("79990000001")["bonus_balance"] == 50  # индекс перечитан из листа
+
+
+@pytest.mark.parametrize("backend", ["sheets", "sqlite"])
+def test_shutdown_drains_pool_before_closing_backend(sheets, monkeypatch, tmp_path, backend):
+    if backend == "sqlite":
+        monkeypatch.setattr(lb, "STORAGE_BACKEND", "sqlite")
+        monkeypatch.setattr(lb, "SQLITE_PATH", str(tmp_path / "x.db"))
+        monkeypatch.setattr(lb, "SQLITE_MIRROR_SHEETS", False)
+    sheet = sheets(clients=CLIENTS)
+    if backend == "sqlite":
+        lb.BACKEND.db.execute("INSERT INTO clients VALUES ('+79990000001', 'Анна', '', 1000, 50, 'silver')")
+    storage = lb.AsyncStorage(max_workers=1)
+    monkeypatch.setattr(lb, "STORAGE", storage)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_review():
+        started.set()
+        release.wait()
+        lb.apply_review_bonus("79990000001")
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await storage.run(slow_review, timeout=0.01)  # хендлер ушёл по таймауту, задача осталась в пуле
+        started.wait()
+        threading.Timer(0.05, release.set).start()
+        await lb.post_shutdown(None)
+
+    asyncio.run(scenario())
+    if backend == "sheets":
+        assert sheet.sheets["clients"].data[1][4] == 150
+        assert [r[1] for r in hot_partition(sheet).data[1:]] == ["promo_review"]
+    else:
+        db = sqlite3.connect(tmp_path / "x.db")
+        assert db.execute("SELECT bonus_balance FROM clients").fetchone() == (150,)
+        assert db.execute("SELECT type FROM transactions").fetchall() == [("promo_review",)]
+    monkeypatch.setattr(lb, "BACKEND", None)  # уже закрыт